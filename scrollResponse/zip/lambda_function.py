@@ -1,30 +1,67 @@
 """lambda_function.py: lambda test scrolling skill."""
 import json
+import os
 
 APL_TEMPLATE_FN = "apl_selection_template.json"
+# document saved in the APL authoring tool, like
+#   "doc://alexa/apl/documents/scrollDocument".  When set, RenderDocument
+#   sends a Link to it instead of the whole document body.
+APL_DOCUMENT_LINK = os.environ.get('APL_DOCUMENT_LINK', '')
 with open(APL_TEMPLATE_FN) as f:
     APL_TEMPLATE = json.load(f)
+if APL_DOCUMENT_LINK:
+    APL_DOCUMENT = {"type": "Link", "src": APL_DOCUMENT_LINK}
+else:
+    APL_DOCUMENT = APL_TEMPLATE['document']
+# static part of the RenderDocument directive, built once per container
+RENDER_DIRECTIVE = {
+    "type": "Alexa.Presentation.APL.RenderDocument",
+    "token": "scrollPageToken",
+    "document": APL_DOCUMENT
+}
 
 
 # --------------- entry point -----------------
 def lambda_handler(event, context):
     """App entry point."""
     print(f"DEBUG: in lambda_handler with {event}")
-    request_type = event['request']['type']
-    if (('session' in event and 'new' in event['session'] and
-         event['session']['new']) or request_type == 'LaunchRequest'):
-        return on_launch(event)
-    elif request_type == 'IntentRequest':
-        return on_intent(event)
-    elif event['request']['type'] == 'SessionEndedRequest':
-        return on_session_ended(event)
-    elif request_type == 'Alexa.Presentation.APL.UserEvent':
-        return on_UserEvent(event)
-    else:
-        print("WARNING: Unhandled event in lambda_handler:", event)
-        return stop_response(event)
+    return find_route(event)(event)
+
+
+# --------------- request routing -----------------
+# handlers register with @route for a request type and optionally an
+#   intent name; find_route picks the most specific match.
+ROUTES = {}     # (request type, intent name): handler
+
+
+def route(request_type, intent_name=None):
+    """Register decorated function as handler for matching requests."""
+    def register(handler):
+        ROUTES[(request_type, intent_name)] = handler
+        return handler
+    return register
+
+
+def find_route(event):
+    """Return request handler for event."""
+    request = event['request']
+    request_type = request['type']
+    if event.get('session', {}).get('new'):
+        request_type = 'LaunchRequest'
+    intent_name = request['intent']['name'] if 'intent' in request else None
+    handler = ROUTES.get((request_type, intent_name))
+    if handler is None:
+        handler = ROUTES.get((request_type, None), unhandled_request)
+    return handler
+
 
+def unhandled_request(event):
+    """Stop on a request type nothing is registered for."""
+    print("WARNING: Unhandled event in lambda_handler:", event)
+    return stop_response(event)
 
+
+@route('LaunchRequest')
 def on_launch(event):
     """Start session."""
     # check APL device
@@ -35,16 +72,21 @@ def on_launch(event):
         return service_response({}, response)
     msg = "say scroll right or left. "
     response = ask_response(msg, msg)
-    directive = {
-        "type": "Alexa.Presentation.APL.RenderDocument",
-        "token": "scrollPageToken",
-        "document": APL_TEMPLATE['document'],
-        "datasources": APL_TEMPLATE['datasources']
-    }
-    add_directive(response, directive)
+    add_directive(response, render_directive(APL_TEMPLATE['datasources']))
     return service_response({}, response)
 
 
+def render_directive(datasources):
+    """Return RenderDocument directive showing `datasources`.
+
+    Only the datasources change per request; the document is shared.
+    """
+    directive = dict(RENDER_DIRECTIVE)
+    directive['datasources'] = datasources
+    return directive
+
+
+@route('SessionEndedRequest')
 def on_session_ended(event):
     """Cleanup session."""
     # can't respond to SessionEndedRequest
@@ -54,6 +96,7 @@ def on_session_ended(event):
     }
 
 
+@route('Alexa.Presentation.APL.UserEvent')
 def on_UserEvent(event):
     """Process on_UserEvent event.
 
@@ -68,22 +111,17 @@ def on_UserEvent(event):
         return {}
 
 
+@route('IntentRequest')
 def on_intent(event):
-    """Process intent."""
+    """Process intent with no handler of its own."""
     intent_name = event['request']['intent']['name']
     print(f"on_intent: {intent_name}")
-    if intent_name in ('AMAZON.StopIntent', 'AMAZON.CancelIntent'):
-        return stop_response(event)
-    elif intent_name in ('AMAZON.ScrollLeftIntent',
-                         'AMAZON.ScrollRightIntent'):
-        return scroll_response(event)
-    else:
-        msg = ""
     reprompt = "scroll more or stop. "
-    msg += reprompt
-    return service_response({}, ask_response(msg, reprompt))
+    return service_response({}, ask_response(reprompt, reprompt))
 
 
+@route('IntentRequest', 'AMAZON.ScrollLeftIntent')
+@route('IntentRequest', 'AMAZON.ScrollRightIntent')
 def scroll_response(event):
     """
     Scroll scroll_sequence left or right.
@@ -113,6 +151,8 @@ def scroll_response(event):
     return service_response({}, response)
 
 
+@route('IntentRequest', 'AMAZON.StopIntent')
+@route('IntentRequest', 'AMAZON.CancelIntent')
 def stop_response(event):
     """Give stop message response."""
     response = tell_response("Goodbye!")
@@ -160,7 +200,8 @@ def add_directive(response, directive):
     if 'directives' not in response:
         response['directives'] = []
     response['directives'].append(directive)
-    print("DEBUG: add_directive", directive)
+    # type only, printing a whole APL document costs more than building it
+    print("DEBUG: add_directive", directive.get('type'))
     return response
 
 
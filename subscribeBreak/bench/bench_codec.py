@@ -0,0 +1,136 @@
+"""bench_codec.py: microbenchmark of dynamo_codec on attribute trees.
+
+Compares encode/decode with the recursive helpers they replaced, on a
+realistic attribute blob, a large power-user blob, and pathological wide
+and deep trees.  The old helpers truncated floats to int, far cheaper
+than the Decimal encode makes (and wrong), so trees full of floats (power
+user, wide) favour them.  Run from subscribeBreak:
+`python bench/bench_codec.py`
+"""
+import os
+import sys
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import dynamo_codec  # noqa: E402
+
+
+# --------------- replaced helpers, for comparison -----------------
+def clear_empty_strings(data):
+    """Replace empty strings in data with ' ' (old version)."""
+    for key in data:
+        if data[key] == '':
+            data[key] = ' '
+        if isinstance(data[key], float):
+            data[key] = int(data[key])
+        elif isinstance(data, dict):
+            if data[key] == '':
+                data[key] = ' '
+            if isinstance(data[key], float):
+                data[key] = int(data[key])
+            if isinstance(data[key], (dict, list)):
+                data[key] = clear_empty_strings(data[key])
+    return data
+
+
+def restore_empty_strings(data):
+    """Replace ' ' with empty strings in data (old version)."""
+    for i, key in enumerate(data):
+        if isinstance(data, list):
+            if key == " ":
+                data[i] = ""
+            if isinstance(key, Decimal):
+                data[i] = int(data[i])
+            if isinstance(key, (dict, list)):
+                data[i] = restore_empty_strings(data[i])
+        elif isinstance(data, dict):
+            if data[key] == ' ':
+                data[key] = ''
+            if isinstance(data[key], Decimal):
+                data[key] = int(data[key])
+            if isinstance(data[key], (dict, list)):
+                data[key] = restore_empty_strings(data[key])
+    return data
+
+
+# --------------- attribute trees -----------------
+def realistic():
+    """Return attributes like a regular user's record."""
+    return {
+        'number of visits': 12,
+        'number of free plays': 9,
+        'number of subscriber plays': 3,
+        'is a subscriber': True,
+        'ISP product id': 'amzn1.adg.product.2e9a9736',
+        'index of mix tone': 4,
+        'uuid for filename': '',
+        'cummulative mix duration': 180.0,
+        'target mix duration': 1800.0,
+        'conversation state': 'start state',
+    }
+
+
+def power_user(sessions=500):
+    """Return attributes with a long history of mixes."""
+    data = realistic()
+    data['history'] = {f'session {i}': {'duration': 180.0 + i,
+                                        'sources': {'a': 'tone_a.mp3',
+                                                    'b': ''},
+                                        'hash': ''}
+                       for i in range(sessions)}
+    return data
+
+
+def wide(keys=20000):
+    """Return one flat map with many keys."""
+    return {f'k{i}': ('' if i % 3 == 0 else float(i)) for i in range(keys)}
+
+
+def deep(depth=5000):
+    """Return a chain of nested maps deeper than the recursion limit."""
+    root = node = {}
+    for _ in range(depth):
+        node['v'] = ''
+        node['n'] = {}
+        node = node['n']
+    return root
+
+
+# --------------- runner -----------------
+def bench(label, func, make_tree, number):
+    """Time func on fresh trees, print per-call microseconds."""
+    it = iter([make_tree() for _ in range(number)])
+    try:
+        seconds = timeit.timeit(lambda: func(next(it)), number=number)
+    except RecursionError:
+        print(f"{label:<36} RecursionError")
+        return
+    print(f"{label:<36} {seconds / number * 1e6:10.1f} us")
+
+
+def main():
+    trees = [('realistic', realistic, 2000),
+             ('power user (500 sessions)', power_user, 50),
+             ('wide (20000 keys)', wide, 20),
+             ('deep (5000 levels)', deep, 20)]
+    for name, make_tree, number in trees:
+        print(f"--- {name}")
+        # old clear_empty_strings can't walk lists, trees above have none
+        bench('old clear_empty_strings', clear_empty_strings, make_tree,
+              number)
+        bench('encode', dynamo_codec.encode, make_tree, number)
+        stored = dynamo_codec.encode(make_tree())
+
+        def make_stored():
+            """Return a fresh tree as get_item would return it."""
+            return dynamo_codec.encode(make_tree())
+        bench('old restore_empty_strings', restore_empty_strings,
+              make_stored, number)
+        bench('decode', dynamo_codec.decode, make_stored, number)
+        bench('encode, already encoded', dynamo_codec.encode,
+              lambda: stored, number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""bench_contention.py: many threads writing one user record at once.
+
+Each thread plays `--turns` turns for the same userId, as separate
+devices or containers would: read the record, count a visit, set a key of
+its own and IS_SUBSCRIBER, and save.  Saving is either update_dbdata
+(versioned writes with merge and retry) or, for comparison, a whole-record
+put as the lambda used to do.  Afterwards the record is checked: the
+visit count should equal threads x turns and every thread's last key
+should be there.  Reports turn latency, retries and lost writes.
+Run from subscribeBreak:
+    python bench/bench_contention.py
+    python bench/bench_contention.py --threads 16 --db-latency 2
+"""
+import argparse
+import copy
+import os
+import statistics
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+import dynamo_codec  # noqa: E402
+import fakes  # noqa: E402
+import lambda_function as lf  # noqa: E402
+import user_store  # noqa: E402
+
+USER_ID = 'amzn1.ask.account.CONTENDED'
+
+
+def make_store(kind, latency):
+    """Return a fresh store of kind."""
+    if kind == 'memory':
+        return user_store.MemoryStore()
+    return user_store.DynamoDBStore(
+        'ContentionTable', dynamodb=fakes.FakeDynamoDB(latency=latency))
+
+
+def put_record(store, data):
+    """Save data as a whole item, counters and all, unconditionally."""
+    item = {user_store.USERID: USER_ID,
+            user_store.DATA: dynamo_codec.encode(lf.stored_data(data)),
+            user_store.TIMESTAMP: 'timestamp',
+            user_store.VERSION: data.get(lf.RECORD_VERSION, 0) + 1}
+    for key, name in lf.COUNTERS.items():
+        if key in data:
+            item[name] = data[key]
+    if isinstance(store, user_store.DynamoDBStore):
+        store.table.put_item(Item=item)
+    else:
+        with store.lock:
+            store.items[USER_ID] = item
+
+
+def turn(store, thread, i, mode):
+    """Play one turn of thread, return seconds and result."""
+    start = time.perf_counter()
+    attributes, legacy = lf.read_record(lf.get_dbitem(store, USER_ID))
+    original = copy.deepcopy(attributes)
+    attributes[lf.VISIT_COUNT] = attributes.get(lf.VISIT_COUNT, 0) + 1
+    attributes[f'thread {thread}'] = i
+    attributes[lf.IS_SUBSCRIBER] = i % 2 == 0
+    if mode == 'versioned':
+        result = lf.update_dbdata(store, USER_ID, attributes, original,
+                                  {lf.VISIT_COUNT: 1}, legacy)
+    else:
+        result = put_record(store, attributes)
+    return time.perf_counter() - start, result
+
+
+def run(args, mode, threads):
+    """Return results of threads threads playing args.turns turns."""
+    store = make_store(args.store, args.db_latency / 1000)
+    times, failures = [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def play(thread):
+        barrier.wait()
+        for i in range(args.turns):
+            seconds, result = turn(store, thread, i, mode)
+            with lock:
+                times.append(seconds)
+                if result == "version conflict":
+                    failures.append(thread)
+
+    workers = [threading.Thread(target=play, args=(t,))
+               for t in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    final, _ = lf.read_record(store.get(USER_ID))
+    writes = threads * args.turns
+    ordered = sorted(times)
+    return {
+        'visits lost': writes - final.get(lf.VISIT_COUNT, 0),
+        'keys lost': sum(final.get(f'thread {t}') != args.turns - 1
+                         for t in range(threads)),
+        'retries': store.calls['update'] - writes if mode == 'versioned'
+        else 0,
+        'gave up': len(failures),
+        'p50 ms': statistics.median(times) * 1000,
+        'p99 ms': ordered[min(len(ordered) - 1,
+                              int(0.99 * len(ordered)))] * 1000,
+        'turns/s': writes / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--store', choices=('dynamodb', 'memory'),
+                        default='dynamodb')
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16])
+    parser.add_argument('--turns', type=int, default=50)
+    parser.add_argument('--db-latency', type=float, default=1.0,
+                        help="ms added to each fake DynamoDB call")
+    args = parser.parse_args()
+    columns = ('visits lost', 'keys lost', 'retries', 'gave up', 'p50 ms',
+               'p99 ms', 'turns/s')
+    print(f"{'save':<10} {'threads':>7} " +
+          ' '.join(f'{c:>11}' for c in columns))
+    for mode in ('put', 'versioned'):
+        for threads in args.threads:
+            row = run(args, mode, threads)
+            print(f"{mode:<10} {threads:7d} " + ' '.join(
+                f'{row[c]:11.2f}' if isinstance(row[c], float)
+                else f'{row[c]:11d}' for c in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""bench_encoder.py: MP3 encoding in one ffmpeg vs parallel_encoder.
+
+Mixes fixture tones (bench_mixer's) for each `--seconds` and encodes the
+mix with tone_mixer.mp3_chunks and with ParallelEncoder for each of
+`--workers`, on threads and on a ProcessPoolExecutor.  Reports wall time
+and seconds of audio encoded per wall second.  Also checks the parallel
+output is byte for byte what mp3_chunks makes in one ffmpeg, so chunks
+join with no gap or click and a recipe hash names one file either way.
+Speedup needs as many cores as workers; the cores seen are printed.
+Needs ffmpeg.  Run from subscribeBreak:
+    python bench/bench_encoder.py
+    python bench/bench_encoder.py --seconds 1800 --workers 2 6
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+import bench_mixer  # noqa: E402
+import parallel_encoder  # noqa: E402
+import tone_mixer  # noqa: E402
+
+
+def timed(chunks):
+    """Return (bytes, wall seconds) of joining chunks."""
+    start = time.perf_counter()
+    data = b''.join(chunks)
+    return data, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sources', type=int, default=6)
+    parser.add_argument('--seconds', type=float, nargs='+',
+                        default=[180, 600])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--chunk-seconds', type=float,
+                        default=parallel_encoder.CHUNK_SECONDS)
+    args = parser.parse_args()
+    if not shutil.which(tone_mixer.FFMPEG):
+        sys.exit(f"no {tone_mixer.FFMPEG} on PATH (set FFMPEG)")
+    print(f"{os.cpu_count()} cores")
+    with tempfile.TemporaryDirectory() as folder:
+        fixtures = bench_mixer.make_fixtures(folder, args.sources)
+        tones, _ = bench_mixer.decode_all(fixtures['wav'])
+    print(f"{'encoder':<16} {'mix s':>6} {'wall s':>7} {'x realtime':>10} "
+          f"{'MB':>6}  same as mp3_chunks")
+    for seconds in args.seconds:
+        mix = tone_mixer.Mix([tones[0::2][:3], tones[1::2][:3]], seconds)
+        whole, wall = timed(tone_mixer.mp3_chunks(mix))
+        print(f"{'mp3_chunks':<16} {seconds:6.0f} {wall:7.2f} "
+              f"{seconds / wall:10.0f} {len(whole) / 1e6:6.2f}")
+        for workers in args.workers:
+            for label, pool in (('threads', None),
+                                ('processes', ProcessPoolExecutor(workers))):
+                encoder = parallel_encoder.ParallelEncoder(
+                    workers, args.chunk_seconds, executor=pool)
+                data, wall = timed(encoder(mix))
+                metrics = encoder.metrics()
+                print(f"{f'{workers} {label}':<16} {seconds:6.0f} "
+                      f"{wall:7.2f} {metrics['realtime']:10.0f} "
+                      f"{len(data) / 1e6:6.2f}  {data == whole}")
+                encoder.executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
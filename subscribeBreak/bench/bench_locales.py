@@ -0,0 +1,92 @@
+"""bench_locales.py: cold start cost of the message catalog vs locale count.
+
+Writes 1, 10, 50 and 200 locale files (copies of locales/en-US.json under
+made-up locale names) to a temporary folder and, for each count, in a
+fresh interpreter times the import of message_catalog, the first
+get_message of one locale (what a cold start pays) and of compiling every
+locale up front (what keeping them all in the module would cost), with
+the memory each leaves allocated.  Run from subscribeBreak:
+`python bench/bench_locales.py`
+"""
+import itertools
+import json
+import os
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SUBSCRIBE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SUBSCRIBE_DIR)
+COUNTS = (1, 10, 50, 200)
+
+
+def make_locales(folder, count):
+    """Write count locale files to folder, en-US first.
+
+    Each made-up locale tags its messages with its name so they are
+    distinct strings, like real translations.
+    """
+    source = os.path.join(SUBSCRIBE_DIR, 'locales', 'en-US.json')
+    shutil.copy(source, folder)
+    with open(source, encoding='utf-8') as f:
+        messages = json.load(f)
+    names = (a + b + '-' + c.upper() + d.upper() for a, b, c, d in
+             itertools.product(string.ascii_lowercase, repeat=4))
+    for name in itertools.islice(names, count - 1):
+        with open(os.path.join(folder, name + '.json'), 'w',
+                  encoding='utf-8') as f:
+            json.dump({k: v + name for k, v in messages.items()}, f,
+                      ensure_ascii=False)
+
+
+def child(folder, eager):
+    """In a fresh process: time import and first compile, print JSON."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    import message_catalog
+    import_s = time.perf_counter() - start
+    catalog = message_catalog.MessageCatalog(folder,
+                                             substitutions={'URL_PREFIX': ''})
+    start = time.perf_counter()
+    if eager:
+        catalog.compile_all()
+    else:
+        catalog.get('en-US')
+    compile_s = time.perf_counter() - start
+    print(json.dumps({'import_ms': import_s * 1000,
+                      'compile_ms': compile_s * 1000,
+                      'kb': tracemalloc.get_traced_memory()[0] / 1024}))
+
+
+def run(folder, eager):
+    """Return child result for folder."""
+    command = [sys.executable, os.path.abspath(__file__), folder]
+    if eager:
+        command.append('--eager')
+    output = subprocess.run(command, capture_output=True, text=True,
+                            check=True, cwd=SUBSCRIBE_DIR).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    print(f"{'locales':>8} {'import ms':>10} {'first ms':>9} {'KB':>8}"
+          f" {'all ms':>9} {'all KB':>8}")
+    for count in COUNTS:
+        with tempfile.TemporaryDirectory() as folder:
+            make_locales(folder, count)
+            lazy = run(folder, eager=False)
+            eager = run(folder, eager=True)
+        print(f"{count:8d} {lazy['import_ms']:10.2f} "
+              f"{lazy['compile_ms']:9.2f} {lazy['kb']:8.1f}"
+              f" {eager['compile_ms']:9.2f} {eager['kb']:8.1f}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        child(sys.argv[1], '--eager' in sys.argv)
+    else:
+        main()
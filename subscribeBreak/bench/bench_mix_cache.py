@@ -0,0 +1,111 @@
+"""bench_mix_cache.py: premium sessions with and without the mix cache.
+
+Plays `--sessions` premium sessions of `--users` users spread over
+`--containers` lambda containers: each session calls make_mix for a user
+whose mix index is how many sessions they have had.  Users share
+`--seeds` seeds (MIX_SEEDS, chosen by mix_seed from their id), so a
+recipe recurs when users of one seed reach the same mix index, and when
+the same mix is asked for again: a `--repeats` share of sessions ask
+again from a random container, as a resumed segment or a retried request
+does.  The bucket is a FolderTier in a temporary folder, sources are fake
+WAV tones (fakes.FakeBucket) and mixes are WAV.  Each container remembers
+its own `--cache-names` names, so a recipe another container rendered
+costs one HEAD (here a file lookup; add a real HEAD round trip to the
+remote times).  Reports, per outcome, count and p50 time, and the total
+time against rendering every request.
+Run from subscribeBreak:
+    python bench/bench_mix_cache.py
+    python bench/bench_mix_cache.py --containers 1 --seeds 512
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+import events  # noqa: E402
+import fakes  # noqa: E402
+import lambda_function as lf  # noqa: E402
+import mix_cache  # noqa: E402
+import tone_mixer  # noqa: E402
+
+
+def setup(sources):
+    """Point lambda_function at fake source tones."""
+    bucket = fakes.FakeBucket([f'source/tone_{i}.wav'
+                               for i in range(sources)])
+    lf.SOURCE_LIST._bucket = bucket
+    lf.SOURCE_LIST.manifest_fn = None
+    lf.SOURCE_LIST.invalidate()
+    lf.MIX_FORMAT = 'wav'
+    tone_mixer.load.cache_clear()
+
+
+def play(args, folder, cached):
+    """Return ({outcome: [seconds]}, total seconds, caches)."""
+    remote = mix_cache.FolderTier(os.path.join(folder, 'bucket'))
+    caches = [mix_cache.MixCache(remote, os.path.join(folder, f'tmp{c}'),
+                                 args.cache_names)
+              for c in range(args.containers)]
+    sessions = defaultdict(int)
+    times = defaultdict(list)
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for _ in range(args.sessions):
+        user = rng.randrange(args.users)
+        index = sessions[user]
+        sessions[user] += 1
+        for _ in range(2 if rng.random() < args.repeats else 1):
+            lf.MIX_CACHE = rng.choice(caches)
+            attributes = {lf.MIX_INDEX: index}
+            if not cached:
+                # a fresh recipe every time, as with a new uuid per mix
+                attributes[lf.MIX_INDEX] = rng.randrange(1 << 60)
+            before = dict(lf.MIX_CACHE.stats)
+            began = time.perf_counter()
+            seed = lf.mix_seed(events.base_event(
+                {'type': 'LaunchRequest'}, user_id=f'user{user}'))
+            lf.make_mix(attributes, args.mix_seconds, seed)
+            elapsed = time.perf_counter() - began
+            outcome = next(k for k, v in lf.MIX_CACHE.stats.items()
+                           if k != 'evicted' and v != before.get(k, 0))
+            times[outcome].append(elapsed)
+    return times, time.perf_counter() - start, caches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=400)
+    parser.add_argument('--containers', type=int, default=4)
+    parser.add_argument('--sources', type=int, default=12)
+    parser.add_argument('--mix-seconds', type=float, default=30)
+    parser.add_argument('--seeds', type=int, default=lf.MIX_SEEDS)
+    parser.add_argument('--cache-names', type=int,
+                        default=mix_cache.MIX_CACHE_NAMES)
+    parser.add_argument('--repeats', type=float, default=0.3,
+                        help="share of sessions whose mix is asked again")
+    args = parser.parse_args()
+    lf.MIX_SEEDS = args.seeds
+    for cached in (False, True):
+        with tempfile.TemporaryDirectory() as folder:
+            setup(args.sources)
+            times, total, caches = play(args, folder, cached)
+        label = 'mix cache' if cached else 'render every request'
+        print(f"{label}: {total:.2f} s for {args.sessions} sessions")
+        for outcome, seconds in sorted(times.items()):
+            print(f"  {outcome:<9} {len(seconds):6d} mixes, p50 "
+                  f"{statistics.median(seconds) * 1000:8.2f} ms")
+        evicted = sum(c.stats['evicted'] for c in caches)
+        print(f"  names forgotten {evicted}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""bench_mixer.py: tone_mixer speed and memory vs mix length.
+
+Writes `--sources` fixture tones (20 s WAV files at 44.1 kHz, so decoding
+resamples them, plus MP3 copies when ffmpeg is on the PATH) to a
+temporary folder, then for each mix length and output format times
+rendering a mix of them, two layers of three tones, to a sink that only
+counts bytes.  Reports decode time, render speed as a multiple of real
+time and the peak memory allocated while rendering, which should stay
+flat as mixes get longer.  No S3 is involved.  Run from subscribeBreak:
+    python bench/bench_mixer.py
+    python bench/bench_mixer.py --seconds 60 600 --block 0.25 1 4
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import tone_mixer  # noqa: E402
+
+
+def make_fixtures(folder, count, seconds=20.0, rate=44100):
+    """Write count stereo WAV tones (and MP3 copies), return {ext: [fn]}."""
+    import numpy as np
+    fixtures = {'wav': [], 'mp3': []}
+    times = np.arange(int(seconds * rate)) / rate
+    for i in range(count):
+        pitch = 110 * 2 ** (i / 5)
+        left = np.sin(2 * np.pi * pitch * times)
+        right = np.sin(2 * np.pi * (pitch + 4) * times)     # binaural beat
+        samples = (np.stack([left, right], axis=1) * 0.4 * 32767)
+        fn = os.path.join(folder, f'tone{i}.wav')
+        with wave.open(fn, 'wb') as w:
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(rate)
+            w.writeframes(samples.astype('<i2').tobytes())
+        fixtures['wav'].append(fn)
+        if shutil.which(tone_mixer.FFMPEG):
+            mp3 = fn[:-len('wav')] + 'mp3'
+            subprocess.run([tone_mixer.FFMPEG, '-v', 'error', '-y', '-i', fn,
+                            mp3], check=True)
+            fixtures['mp3'].append(mp3)
+    return fixtures
+
+
+def decode_all(fns):
+    """Return (tones, seconds) decoding fns."""
+    start = time.perf_counter()
+    tones = [tone_mixer.decode(fn) for fn in fns]
+    return tones, time.perf_counter() - start
+
+
+def render(tones, seconds, fmt, block):
+    """Return (bytes, seconds, peak bytes) rendering a mix of tones."""
+    mix = tone_mixer.Mix([tones[0::2][:3], tones[1::2][:3]], seconds)
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = sum(len(chunk) for chunk in tone_mixer.encode(mix, fmt, block))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sources', type=int, default=6)
+    parser.add_argument('--seconds', type=float, nargs='+',
+                        default=[60, 180, 600, 1800])
+    parser.add_argument('--block', type=float, nargs='+',
+                        default=[tone_mixer.BLOCK_SECONDS],
+                        help="BLOCK_SECONDS values to compare")
+    args = parser.parse_args()
+    formats = ['wav'] + (['mp3'] if shutil.which(tone_mixer.FFMPEG) else [])
+    if len(formats) == 1:
+        print(f"no {tone_mixer.FFMPEG} on PATH: WAV sources and output only")
+    with tempfile.TemporaryDirectory() as folder:
+        fixtures = make_fixtures(folder, args.sources)
+        for ext in formats:
+            _, decode_s = decode_all(fixtures[ext])
+            print(f"decode {args.sources} {ext} sources: "
+                  f"{decode_s * 1000:.1f} ms")
+        tones, _ = decode_all(fixtures['wav'])
+        print(f"\n{'format':<7} {'block s':>7} {'mix s':>7} {'render s':>9} "
+              f"{'x realtime':>10} {'MB out':>8} {'peak MB':>8}")
+        for fmt in formats:
+            for block in args.block:
+                for seconds in args.seconds:
+                    size, elapsed, peak = render(tones, seconds, fmt, block)
+                    print(f"{fmt:<7} {block:7.2f} {seconds:7.0f} "
+                          f"{elapsed:9.3f} {seconds / elapsed:10.0f} "
+                          f"{size / 1e6:8.2f} {peak / 1e6:8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""bench_store.py: user_store backends head to head.
+
+Times the operations lambda_function makes on each store: get of a
+record, a diffed update (one DATA key and a counter) and a counter-only
+update, over `--users` records and from `--threads` threads at once.
+DynamoDB is the in-process fake from fakes.py unless `--endpoint` points
+at a real one (e.g. DynamoDB Local on http://localhost:8000, table
+provisioned on each run), so by default its row is client-side cost
+only: add `--db-latency` to include round trips.
+Run from subscribeBreak:
+    python bench/bench_store.py
+    python bench/bench_store.py --threads 8 --endpoint http://localhost:8000
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+import fakes  # noqa: E402
+import user_store  # noqa: E402
+
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+
+def seed(store, users):
+    """Write a record with DATA and counters for each of users users."""
+    for i in range(users):
+        store.update(f'user{i}', user_store.Update(
+            '2020-06-28T14:07:00', replace=True,
+            sets={'is a subscriber': False, 'ISP product id': 'fake',
+                  'conversation state': 'start state'},
+            adds={'visits': 7, 'freePlays': 9}))
+
+
+def make_stores(args, folder):
+    """Return {name: store}."""
+    if args.endpoint:
+        dynamodb = user_store.DynamoDBStore('BenchUserStore', 'us-east-1',
+                                            args.endpoint)
+        dynamodb.provision()
+    else:
+        dynamodb = user_store.DynamoDBStore(
+            'BenchUserStore',
+            dynamodb=fakes.FakeDynamoDB(latency=args.db_latency / 1000))
+    return {'dynamodb': dynamodb,
+            'memory': user_store.MemoryStore(),
+            'file': user_store.FileStore(os.path.join(folder, 'users.jsonl'))}
+
+
+def operations(users):
+    """Return {name: function(store, i)} of the timed operations."""
+    def get(store, i):
+        store.get(f'user{i % users}')
+
+    def update(store, i):
+        store.update(f'user{i % users}', user_store.Update(
+            '2020-06-28T14:08:00', sets={'conversation state': str(i)},
+            adds={'freePlays': 1}))
+
+    def count(store, i):
+        store.update(f'user{i % users}', user_store.Update(
+            '2020-06-28T14:08:00', adds={'visits': 1}))
+    return {'get': get, 'update': update, 'count': count}
+
+
+def run(store, operation, calls, threads):
+    """Return list of seconds per call."""
+    def timed(i):
+        start = time.perf_counter()
+        operation(store, i)
+        return time.perf_counter() - start
+    if threads == 1:
+        return [timed(i) for i in range(calls)]
+    with ThreadPoolExecutor(threads) as pool:
+        return list(pool.map(timed, range(calls)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--db-latency', type=float, default=0.0,
+                        help="ms added to each fake DynamoDB call")
+    parser.add_argument('--endpoint', help="real DynamoDB endpoint url")
+    args = parser.parse_args()
+    print(f"{'store':<10} {'operation':<12} {'p50 us':>9} {'p99 us':>9} "
+          f"{'calls/s':>10}")
+    with tempfile.TemporaryDirectory() as folder:
+        for name, store in make_stores(args, folder).items():
+            seed(store, args.users)
+            for label, operation in operations(args.users).items():
+                start = time.perf_counter()
+                times = run(store, operation, args.calls, args.threads)
+                elapsed = time.perf_counter() - start
+                ordered = sorted(times)
+                p99 = ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))]
+                print(f"{name:<10} {label:<12} "
+                      f"{statistics.median(times) * 1e6:9.1f} "
+                      f"{p99 * 1e6:9.1f} {len(times) / elapsed:10.0f}")
+            if name == 'file':
+                store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""bench_tone_index.py: picking tones from the tone index vs probing them.
+
+Writes `--sources` fixture tones (mono WAV sines of varied pitch, length
+and level) to a temporary folder, indexes them with tone_index and
+reports build time, index size and load time.  Then times `--picks`
+mix picks (a root tone, the tones consonant with it and their gains)
+from the loaded index against the same picks made by probing and
+measuring the files, which is what the lambda would do per mix without
+an index (before any download).  Checks the measured pitch and loudness
+of each fixture against what it was written with.  Run from
+subscribeBreak:
+    python bench/bench_tone_index.py
+    python bench/bench_tone_index.py --sources 200 --picks 50
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import wave
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+import tone_index  # noqa: E402
+
+
+def make_fixtures(folder, count, rate=44100):
+    """Write count tones under folder/source, return [(key, fn, pitch, dB)]."""
+    import numpy as np
+    os.makedirs(os.path.join(folder, 'source'))
+    rng = random.Random(1)
+    fixtures = []
+    for i in range(count):
+        pitch = 110 * 2 ** (rng.randrange(36) / 12)
+        seconds = rng.uniform(10, 30)
+        amplitude = rng.uniform(0.05, 0.8)
+        times = np.arange(int(seconds * rate)) / rate
+        samples = np.sin(2 * np.pi * pitch * times) * amplitude * 32767
+        fn = os.path.join(folder, 'source', f'tone{i}.wav')
+        with wave.open(fn, 'wb') as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(rate)
+            w.writeframes(samples.astype('<i2').tobytes())
+        fixtures.append((f'source/tone{i}.wav', fn, pitch,
+                         20 * math.log10(amplitude / math.sqrt(2))))
+    return fixtures
+
+
+def pick(index, keys, rng):
+    """Return (root, [(key, gain)]) picked from index."""
+    root = rng.choice(index.select(keys, min_seconds=8))
+    return root, [(key, index.gain(key))
+                  for key in index.compatible(root, keys)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sources', type=int, default=60)
+    parser.add_argument('--picks', type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as folder:
+        fixtures = make_fixtures(folder, args.sources)
+        keys = [key for key, _, _, _ in fixtures]
+        fn = os.path.join(folder, os.path.basename(tone_index.TONE_INDEX_FN))
+
+        start = time.perf_counter()
+        index = tone_index.build_index(tone_index.folder_files(folder))
+        size = index.save(fn)
+        print(f"build {len(index)} tones: "
+              f"{time.perf_counter() - start:.2f} s, {size} bytes "
+              f"({size / len(index):.0f} per tone)")
+        start = time.perf_counter()
+        loaded = tone_index.ToneIndex.load(fn)
+        print(f"load: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+        misses = [(key, abs(loaded.get(key)['pitch'] - pitch),
+                   abs(loaded.get(key)['loudness'] - db))
+                  for key, _, pitch, db in fixtures]
+        print(f"worst pitch error {max(m[1] for m in misses):.2f} Hz, "
+              f"loudness error {max(m[2] for m in misses):.2f} dB")
+
+        start = time.perf_counter()
+        picks = [pick(loaded, keys, random.Random(i))
+                 for i in range(args.picks)]
+        indexed = (time.perf_counter() - start) / args.picks
+
+        start = time.perf_counter()
+        for i in range(args.picks):
+            probed = tone_index.build_index(
+                (key, fn) for key, fn, _, _ in fixtures)
+            assert pick(probed, keys, random.Random(i)) == picks[i]
+        probing = (time.perf_counter() - start) / args.picks
+        print(f"pick a mix: {indexed * 1000:.3f} ms from the index, "
+              f"{probing * 1000:.1f} ms probing every tone "
+              f"({probing / indexed:.0f}x)")
+        pools = [len(tones) for _, tones in picks]
+        print(f"consonant pool: {min(pools)}-{max(pools)} of "
+              f"{len(keys)} tones")
+
+
+if __name__ == '__main__':
+    main()
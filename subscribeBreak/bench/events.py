@@ -0,0 +1,140 @@
+"""events.py: Alexa request corpora for the replay harness.
+
+`synthetic_corpus` builds one event of every kind a skill receives from
+its model.json: LaunchRequest, an IntentRequest per intent (with and
+without session attributes), Connections.Response for Buy, Cancel and
+Upsell with each purchaseResult, SessionEndedRequest and, given an
+`audio_token`, a subscriber's TimeIntent and the AudioPlayer events of
+the segment with that token.  Recorded
+events can be replayed instead with `load_corpus` (one JSON event per
+line, as copied from the lambda's debug log).
+"""
+import copy
+import json
+
+USER_ID = 'amzn1.ask.account.BENCHMARKUSER'
+API_ENDPOINT = 'https://api.amazonalexa.com'
+PURCHASE_RESULTS = ('ACCEPTED', 'DECLINED', 'ALREADY_PURCHASED', 'ERROR')
+# first segment of a 10 minute session, as
+#   segment_planner.SegmentPlan(600, 300, 0, 60).token(0)
+AUDIO_TOKEN = 'segments:1:0:0:600:300:60'
+AUDIO_EVENTS = ('PlaybackStarted', 'PlaybackNearlyFinished',
+                'PlaybackFinished', 'PlaybackStopped')
+
+# session attributes of a returning free user, as the skill echoes them
+ATTRIBUTES = {
+    'number of visits': 7,
+    'number of free plays': 9,
+    'number of subscriber plays': 0,
+    'is a subscriber': False,
+    'ISP product id': 'amzn1.adg.product.fake',
+    'conversation state': 'answer TONE_FOLLOWUP state',
+}
+
+
+def base_event(request, attributes=None, new=False, user_id=USER_ID):
+    """Return an Alexa event wrapping `request`."""
+    session = {'new': new,
+               'sessionId': 'amzn1.echo-api.session.BENCHMARK',
+               'application': {'applicationId': 'amzn1.ask.skill.BENCH'},
+               'user': {'userId': user_id}}
+    if attributes is not None:
+        session['attributes'] = copy.deepcopy(attributes)
+    request = dict({'requestId': 'amzn1.echo-api.request.BENCHMARK',
+                    'timestamp': '2020-06-28T14:07:00Z',
+                    'locale': 'en-US'}, **request)
+    return {
+        'version': '1.0',
+        'session': session,
+        'context': {'System': {
+            'application': {'applicationId': 'amzn1.ask.skill.BENCH'},
+            'user': {'userId': user_id},
+            'device': {'deviceId': 'amzn1.ask.device.BENCHMARK',
+                       'supportedInterfaces': {
+                           'AudioPlayer': {},
+                           'Alexa.Presentation.APL': {'runtime': {
+                               'maxVersion': '1.4'}}}},
+            'apiEndpoint': API_ENDPOINT,
+            'apiAccessToken': 'BENCHMARK.TOKEN'}},
+        'request': request,
+    }
+
+
+def intent_names(model_fn):
+    """Return intent names defined in model.json."""
+    with open(model_fn) as f:
+        model = json.load(f)
+    return [i['name'] for i in
+            model['interactionModel']['languageModel']['intents']]
+
+
+def synthetic_corpus(model_fn, attributes=ATTRIBUTES, isp=True,
+                     audio_token=None):
+    """Return list of (name, event) covering every request kind."""
+    corpus = [('LaunchRequest',
+               base_event({'type': 'LaunchRequest'}, new=True))]
+    for intent in intent_names(model_fn):
+        request = {'type': 'IntentRequest',
+                   'intent': {'name': intent, 'confirmationStatus': 'NONE',
+                              'slots': {}}}
+        corpus.append((f'IntentRequest:{intent}',
+                       base_event(request, attributes)))
+        if attributes:
+            corpus.append((f'IntentRequest:{intent} (no session)',
+                           base_event(request)))
+    if isp:
+        for name in ('Buy', 'Cancel', 'Upsell'):
+            for result in PURCHASE_RESULTS:
+                request = {'type': 'Connections.Response', 'name': name,
+                           'status': {'code': '200', 'message': 'OK'},
+                           'payload': {'purchaseResult': result,
+                                       'productId': attributes[
+                                           'ISP product id']},
+                           'token': 'subscriptionToken'}
+                corpus.append((f'Connections.Response:{name}:{result}',
+                               base_event(request, attributes)))
+    corpus.append(('SessionEndedRequest',
+                   base_event({'type': 'SessionEndedRequest',
+                               'reason': 'USER_INITIATED'}, attributes)))
+    if audio_token:
+        corpus.extend(audio_corpus(attributes, audio_token))
+    return corpus
+
+
+def audio_corpus(attributes, token):
+    """Return (name, event) of a segmented session playing token."""
+    subscriber = dict(attributes, **{'is a subscriber': True})
+    request = {'type': 'IntentRequest',
+               'intent': {'name': 'TimeIntent', 'confirmationStatus': 'NONE',
+                          'slots': {'duration': {'name': 'duration',
+                                                 'value': 'PT10M'}}}}
+    corpus = [('IntentRequest:TimeIntent PT10M (subscriber)',
+               base_event(request, subscriber))]
+    for name in AUDIO_EVENTS:
+        event = base_event({'type': f'AudioPlayer.{name}', 'token': token,
+                            'offsetInMilliseconds': 55000})
+        del event['session']
+        event['context']['AudioPlayer'] = {
+            'token': token, 'offsetInMilliseconds': 55000,
+            'playerActivity': 'PLAYING'}
+        corpus.append((f'AudioPlayer.{name}', event))
+    return corpus
+
+
+def load_corpus(fn):
+    """Return list of (name, event) from a file of one event per line."""
+    corpus = []
+    with open(fn) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            event = json.loads(line)
+            request = event['request']
+            name = request['type']
+            if 'intent' in request:
+                name += ':' + request['intent']['name']
+            elif 'name' in request:
+                name += ':' + request['name']
+            corpus.append((name, event))
+    return corpus
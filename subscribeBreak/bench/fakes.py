@@ -0,0 +1,363 @@
+"""fakes.py: in-process stand-ins for DynamoDB, S3 and the ISP endpoint.
+
+Just enough of each API for lambda_function to run without AWS.  Every
+fake counts its calls and can add a fixed `latency` (seconds) per call to
+imitate a network round trip.
+"""
+import copy
+import math
+import os
+import re
+import struct
+import threading
+import time
+import wave
+import zlib
+from collections import Counter
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+
+def client_error(code, message, operation):
+    """Return ClientError like botocore raises."""
+    return ClientError({'Error': {'Code': code, 'Message': message}},
+                       operation)
+
+
+def as_stored(value):
+    """Return value the way boto3 hands it back: numbers as Decimal."""
+    if isinstance(value, dict):
+        return {k: as_stored(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [as_stored(v) for v in value]
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types "
+                        "instead.")
+    if isinstance(value, int) and not isinstance(value, bool):
+        return Decimal(value)
+    return value
+
+
+# --------------- DynamoDB -----------------
+class FakeTable:
+    """DynamoDB Table with get_item, put_item and update_item.
+
+    update_item understands SET (including if_not_exists and +/-), REMOVE
+    and ADD clauses, and conditions built from attribute_exists,
+    attribute_not_exists, = and <> joined by AND / OR.
+    """
+
+    def __init__(self, name='ToneTherapyTable', key='userId', latency=0.0):
+        self.name = name
+        self.table_name = name
+        self.key = key
+        self.latency = latency
+        self.items = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def _call(self, operation):
+        self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_item(self, Key, **kwargs):
+        self._call('get_item')
+        with self.lock:
+            item = self.items.get(Key[self.key])
+            if item is None:
+                return {}
+            return {'Item': as_stored(copy.deepcopy(item))}
+
+    def put_item(self, Item, ConditionExpression=None,
+                 ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, **kwargs):
+        self._call('put_item')
+        as_stored(Item)     # raises on floats like boto3
+        with self.lock:
+            old = self.items.get(Item[self.key])
+            if ConditionExpression and not _condition(
+                    ConditionExpression, old or {},
+                    ExpressionAttributeNames or {},
+                    ExpressionAttributeValues or {}):
+                raise client_error('ConditionalCheckFailedException',
+                                   'The conditional request failed',
+                                   'PutItem')
+            self.items[Item[self.key]] = copy.deepcopy(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None,
+                    ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues=None,
+                    **kwargs):
+        self._call('update_item')
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        as_stored(values)
+        with self.lock:
+            old = self.items.get(Key[self.key])
+            if ConditionExpression and not _condition(
+                    ConditionExpression, old or {}, names, values):
+                raise client_error('ConditionalCheckFailedException',
+                                   'The conditional request failed',
+                                   'UpdateItem')
+            item = copy.deepcopy(old) if old else dict(Key)
+            _update(UpdateExpression, item, names, values)
+            self.items[Key[self.key]] = item
+            if ReturnValues == 'ALL_NEW':
+                return {'Attributes': as_stored(copy.deepcopy(item))}
+        return {}
+
+
+class FakeDynamoDB:
+    """DynamoDB service resource holding FakeTables."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {}
+        self.calls = Counter()
+
+    def Table(self, name):
+        if name not in self.tables:
+            self.tables[name] = FakeTable(name, latency=self.latency)
+        return self.tables[name]
+
+
+# --------------- expressions -----------------
+_CLAUSE = re.compile(r'\b(SET|REMOVE|ADD|DELETE)\b')
+
+
+def _split(text, sep=','):
+    """Split text on sep outside parentheses."""
+    parts, depth, start = [], 0, 0
+    for i, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == sep and depth == 0:
+            parts.append(text[start:i].strip())
+            start = i + 1
+    parts.append(text[start:].strip())
+    return [p for p in parts if p]
+
+
+def _path(text, names):
+    """Return list of attribute names for a document path."""
+    return [names.get(part, part) for part in text.strip().split('.')]
+
+
+def _get(item, path):
+    """Return value at path in item, or raise KeyError."""
+    for name in path:
+        item = item[name]
+    return item
+
+
+def _set(item, path, value):
+    """Set value at path, parent must exist."""
+    for name in path[:-1]:
+        item = item[name]
+    item[path[-1]] = value
+
+
+def _operand(text, item, names, values):
+    """Evaluate a SET operand."""
+    text = text.strip()
+    match = re.fullmatch(r'(.+?)\s*([+-])\s*(:\w+)', text)
+    if match:
+        left = _operand(match.group(1), item, names, values)
+        right = values[match.group(3)]
+        return left + right if match.group(2) == '+' else left - right
+    if text.startswith('if_not_exists('):
+        path_text, default = _split(text[len('if_not_exists('):-1])
+        try:
+            return _get(item, _path(path_text, names))
+        except KeyError:
+            return _operand(default, item, names, values)
+    if text.startswith(':'):
+        return copy.deepcopy(values[text])
+    return _get(item, _path(text, names))
+
+
+def _update(expression, item, names, values):
+    """Apply UpdateExpression to item in place."""
+    pieces = _CLAUSE.split(expression)
+    for action, body in zip(pieces[1::2], pieces[2::2]):
+        for part in _split(body):
+            if action == 'SET':
+                target, operand = part.split('=', 1)
+                value = _operand(operand, item, names, values)
+                try:
+                    _set(item, _path(target, names), value)
+                except KeyError:
+                    raise client_error(
+                        'ValidationException', 'The document path provided '
+                        'in the update expression is invalid for update',
+                        'UpdateItem')
+            elif action == 'REMOVE':
+                path = _path(part, names)
+                try:
+                    parent = _get(item, path[:-1])
+                    parent.pop(path[-1], None)
+                except KeyError:
+                    pass
+            elif action == 'ADD':
+                target, value_name = part.split()
+                path = _path(target, names)
+                try:
+                    current = _get(item, path)
+                except KeyError:
+                    current = 0
+                _set(item, path, current + values[value_name])
+            else:
+                raise NotImplementedError(action)
+
+
+def _condition(expression, item, names, values):
+    """Return truth of ConditionExpression for item."""
+    return any(all(_comparison(term, item, names, values)
+                   for term in re.split(r'\s+AND\s+', clause))
+               for clause in re.split(r'\s+OR\s+', expression))
+
+
+def _comparison(term, item, names, values):
+    """Return truth of one condition term."""
+    term = term.strip()
+    if term.startswith('(') and term.endswith(')'):
+        term = term[1:-1].strip()
+    match = re.fullmatch(r'(attribute_exists|attribute_not_exists)\((.+)\)',
+                         term)
+    if match:
+        try:
+            _get(item, _path(match.group(2), names))
+            exists = True
+        except KeyError:
+            exists = False
+        return exists == (match.group(1) == 'attribute_exists')
+    match = re.fullmatch(r'(\S+)\s*(=|<>)\s*(:\w+)', term)
+    if not match:
+        raise NotImplementedError(term)
+    try:
+        current = as_stored(_get(item, _path(match.group(1), names)))
+    except KeyError:
+        return match.group(2) == '<>'
+    equal = current == as_stored(values[match.group(3)])
+    return equal if match.group(2) == '=' else not equal
+
+
+# --------------- S3 -----------------
+class _Object:
+    def __init__(self, key):
+        self.key = key
+
+
+class _StoredObject:
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+
+    def load(self):
+        self.bucket._call('head_object')
+        if self.key not in self.bucket.keys:
+            raise client_error('404', 'Not Found', 'HeadObject')
+
+
+class _Objects:
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def filter(self, Prefix=''):
+        self.bucket._call('list_objects')
+        return [_Object(k) for k in sorted(self.bucket.keys)
+                if k.startswith(Prefix)]
+
+
+class FakeBucket:
+    """S3 Bucket resource listing a fixed set of keys.
+
+    download_file writes a short WAV sine tone, its pitch from the key, in
+    place of the object; upload_file keeps the size of what was uploaded.
+    """
+
+    def __init__(self, keys=(), latency=0.0, tone_seconds=2.0):
+        self.keys = list(keys)
+        self.latency = latency
+        self.tone_seconds = tone_seconds
+        self.uploads = {}
+        self.calls = Counter()
+        self.objects = _Objects(self)
+
+    def Object(self, key):
+        return _StoredObject(self, key)
+
+    def download_file(self, Key, Filename, **kwargs):
+        self._call('get_object')
+        if Key not in self.keys:
+            raise client_error('404', 'Not Found', 'HeadObject')
+        write_tone(Filename, 110 + zlib.crc32(Key.encode()) % 770,
+                   self.tone_seconds)
+
+    def upload_file(self, Filename, Key, ExtraArgs=None, **kwargs):
+        self._call('put_object')
+        self.uploads[Key] = os.path.getsize(Filename)
+        if Key not in self.keys:
+            self.keys.append(Key)
+
+    def _call(self, operation):
+        self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def write_tone(fn, frequency, seconds, rate=22050):
+    """Write a mono 16 bit WAV sine tone of frequency Hz to fn."""
+    samples = [int(12000 * math.sin(2 * math.pi * frequency * i / rate))
+               for i in range(int(seconds * rate))]
+    with wave.open(fn, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(struct.pack(f'<{len(samples)}h', *samples))
+
+
+# --------------- ISP endpoint -----------------
+class FakeResponse:
+    """requests.Response with a JSON body."""
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+        self.text = str(body)
+
+    def json(self):
+        return copy.deepcopy(self._body)
+
+
+class FakeISPSession:
+    """requests.Session answering the in-skill products endpoint."""
+
+    def __init__(self, product_id='amzn1.adg.product.fake', entitled=False,
+                 status_code=200, latency=0.0, error=None):
+        self.product_id = product_id
+        self.entitled = entitled
+        self.status_code = status_code
+        self.latency = latency
+        self.error = error      # exception raised instead of answering
+        self.calls = Counter()
+
+    def get(self, url, headers=None, timeout=None, **kwargs):
+        self.calls['get'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        body = {'inSkillProducts': [{
+            'productId': self.product_id,
+            'referenceName': 'premium_content',
+            'type': 'SUBSCRIPTION',
+            'entitled': 'ENTITLED' if self.entitled else 'NOT_ENTITLED',
+            'purchasable': 'PURCHASABLE',
+        }]}
+        return FakeResponse(self.status_code, body)
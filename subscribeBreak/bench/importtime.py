@@ -0,0 +1,79 @@
+"""importtime.py: per-module import cost of a lambda, from -X importtime.
+
+Imports the module in a fresh interpreter with `python -X importtime` and
+sums the self time of everything it pulls in by top-level package, so the
+cost of each dependency on a cold start is one line.  Also used by
+replay.py.
+
+Run from subscribeBreak:
+    python bench/importtime.py
+    python bench/importtime.py --module isp_client --top 20
+"""
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+SUBSCRIBE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module, cwd=SUBSCRIBE_DIR, env=None):
+    """Return list of (self us, cumulative us, depth, name) for module."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=cwd, env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return rows
+
+
+def subtree(rows, module):
+    """Return rows imported by module, module last.
+
+    -X importtime prints children before their parent and indented
+    deeper, so they are the rows just above the module's own row.
+    """
+    end = next(i for i, row in enumerate(rows) if row[3] == module)
+    depth = rows[end][2]
+    start = end
+    while start > 0 and rows[start - 1][2] > depth:
+        start -= 1
+    return rows[start:end + 1]
+
+
+def by_package(rows):
+    """Return {top-level package: total self us}, largest first."""
+    totals = defaultdict(int)
+    for self_us, _, _, name in rows:
+        totals[name.split('.')[0]] += self_us
+    return dict(sorted(totals.items(), key=lambda kv: -kv[1]))
+
+
+def report(module, cwd=SUBSCRIBE_DIR, top=10, env=None):
+    """Print import cost of module, return {package: ms}."""
+    rows = subtree(import_times(module, cwd, env), module)
+    total = rows[-1][1]
+    packages = by_package(rows)
+    print(f"import {module}: {total / 1000:.1f} ms")
+    for package, self_us in list(packages.items())[:top]:
+        print(f"  {package:<28} {self_us / 1000:8.1f} ms "
+              f"{100 * self_us / total:5.1f}%")
+    return {package: us / 1000 for package, us in packages.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='lambda_function')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+    report(args.module, top=args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+"""replay.py: replay Alexa events through lambda_handler without AWS.
+
+Runs a corpus of events against in-process stand-ins for DynamoDB, S3 and
+the ISP endpoint (see fakes.py) and reports, per event kind, p50/p99
+latency, backend calls and peak allocation, then per handler the import
+cost and cold (first call in a fresh process) vs warm latency, and which
+packages the import time goes to (see importtime.py).
+
+Run from subscribeBreak:
+    python bench/replay.py
+    python bench/replay.py --skill scroll
+    python bench/replay.py --corpus events.jsonl --rounds 500 --db-latency 5
+    python bench/replay.py --json before.json
+"""
+import argparse
+import contextlib
+import copy
+import importlib
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SUBSCRIBE_DIR = os.path.dirname(HERE)
+SCROLL_DIR = os.path.join(os.path.dirname(SUBSCRIBE_DIR), 'scrollResponse')
+sys.path.insert(0, HERE)
+import events  # noqa: E402
+import fakes  # noqa: E402
+import importtime  # noqa: E402
+
+# skill: (code folder, module, model.json, working folder)
+SKILLS = {
+    'subscribe': (SUBSCRIBE_DIR, 'lambda_function',
+                  os.path.join(SUBSCRIBE_DIR, 'model.json'), SUBSCRIBE_DIR),
+    'scroll': (SCROLL_DIR, 'full_lambda_function',
+               os.path.join(SCROLL_DIR, 'model.json'),
+               os.path.join(SCROLL_DIR, 'zip')),
+}
+
+
+# --------------- setup -----------------
+def load_skill(skill):
+    """Import and return the lambda module for skill."""
+    code_dir, module_name, _, work_dir = SKILLS[skill]
+    sys.path.insert(0, code_dir)
+    os.chdir(work_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return importlib.import_module(module_name)
+
+
+def install_fakes(module, args):
+    """Point module at fakes, return dict of fakes by name."""
+    installed = {}
+    if hasattr(module, 'STORE'):
+        store = make_store(module, args)
+        store.update(events.USER_ID, sys.modules['user_store'].Update(
+            '2020-06-28T14:07:00', sets=dict(events.ATTRIBUTES), replace=True))
+        store.calls.clear()
+        if args.store == 'dynamodb':
+            installed['db'] = store.table
+            installed['dynamodb'] = store.dynamodb
+        else:
+            installed['store'] = store
+        cache_size = module.USER_CACHE_SIZE if args.cache_size is None \
+            else args.cache_size
+        if cache_size:
+            store = sys.modules['user_store'].CachedStore(
+                store, cache_size, module.USER_CACHE_TTL)
+        module.STORE = store
+    if hasattr(module, 'FREE_LIST'):
+        bucket = fakes.FakeBucket(
+            [f'free/free_{i}.mp3' for i in range(3)] +
+            [f'source/source_{i}.mp3' for i in range(12)],
+            latency=args.s3_latency)
+        for catalog in (module.FREE_LIST, module.SOURCE_LIST,
+                        getattr(module, 'MIX_LIST', None)):
+            if catalog is None:
+                continue
+            catalog._bucket = bucket
+            catalog.manifest_fn = None
+            catalog.invalidate()
+        installed['s3'] = bucket
+    if hasattr(module, 'MIX_SECONDS'):
+        module.MIX_SECONDS = args.mix_seconds
+        module.MIX_FOLDER = tempfile.mkdtemp(prefix='mixes')
+        module.MIX_CACHE = None
+        # tone_mixer's FFMPEG, without importing it before the cold start
+        if shutil.which(os.environ.get('FFMPEG', 'ffmpeg')) is None:
+            module.MIX_FORMAT = 'wav'
+    if 'isp_client' in sys.modules:
+        session = fakes.FakeISPSession(status_code=args.isp_status,
+                                       latency=args.isp_latency)
+        sys.modules['isp_client'].SESSION = session
+        installed['isp'] = session
+    return installed
+
+
+def make_store(module, args):
+    """Return a user_store store of kind args.store for module."""
+    user_store = sys.modules['user_store']
+    if args.store == 'memory':
+        return user_store.MemoryStore()
+    if args.store == 'file':
+        fn = os.path.join(tempfile.mkdtemp(), 'users.jsonl')
+        return user_store.FileStore(fn)
+    return user_store.DynamoDBStore(
+        module.DB_TABLE_NAME,
+        dynamodb=fakes.FakeDynamoDB(latency=args.db_latency))
+
+
+def get_corpus(args):
+    """Return list of (name, event) to replay."""
+    if args.corpus:
+        return events.load_corpus(args.corpus)
+    model_fn = SKILLS[args.skill][2]
+    if args.skill == 'scroll':
+        return events.synthetic_corpus(model_fn, attributes=None, isp=False)
+    return events.synthetic_corpus(model_fn, audio_token=events.AUDIO_TOKEN)
+
+
+def handler_name(module, event):
+    """Return name of the handler that event is routed to."""
+    if not hasattr(module, 'find_route'):
+        return 'lambda_handler'
+    with contextlib.redirect_stdout(io.StringIO()):
+        return module.find_route(copy.deepcopy(event)).__name__
+
+
+def call(module, event):
+    """Run lambda_handler on a copy of event, return elapsed seconds."""
+    event = copy.deepcopy(event)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        module.lambda_handler(event, None)
+        return time.perf_counter() - start
+
+
+# --------------- measurements -----------------
+def percentile(samples, fraction):
+    """Return the fraction percentile of samples."""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure_latency(module, corpus, installed, rounds):
+    """Return {name: {'times': [...], 'calls': Counter}}."""
+    results = defaultdict(lambda: {'times': [], 'calls': Counter()})
+    for _ in range(rounds):
+        for name, event in corpus:
+            before = {k: Counter(f.calls) for k, f in installed.items()}
+            results[name]['times'].append(call(module, event))
+            for key, fake in installed.items():
+                for op, n in (fake.calls - before[key]).items():
+                    results[name]['calls'][f'{key}.{op}'] += n
+    return results
+
+
+def measure_allocations(module, corpus):
+    """Return {name: peak KB allocated while handling the event}."""
+    peaks = {}
+    tracemalloc.start()
+    for name, event in corpus:
+        event = copy.deepcopy(event)
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        with contextlib.redirect_stdout(io.StringIO()):
+            module.lambda_handler(event, None)
+        peaks[name] = (tracemalloc.get_traced_memory()[1] - base) / 1024
+    tracemalloc.stop()
+    return peaks
+
+
+def measure_cold(args, corpus, module):
+    """Return {handler: child result} from one fresh process per handler."""
+    first = {}
+    for index, (name, event) in enumerate(corpus):
+        first.setdefault(handler_name(module, event), index)
+    results = {}
+    for handler, index in first.items():
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--child', str(index), '--skill', args.skill,
+                   '--isp-status', str(args.isp_status),
+                   '--store', args.store,
+                   '--mix-seconds', str(args.mix_seconds)]
+        if args.cache_size is not None:
+            command += ['--cache-size', str(args.cache_size)]
+        if args.corpus:
+            command += ['--corpus', args.corpus]
+        output = subprocess.run(command, capture_output=True, text=True,
+                                check=True, env=child_env(args)).stdout
+        results[handler] = json.loads(output.strip().splitlines()[-1])
+    return results
+
+
+def child_env(args):
+    """Return environment for child processes."""
+    env = dict(os.environ)
+    env.setdefault('LOG_LEVEL', args.log_level)
+    return env
+
+
+def run_child(args):
+    """In a fresh process: time import, first call and warm calls."""
+    start = time.perf_counter()
+    module = load_skill(args.skill)
+    import_s = time.perf_counter() - start
+    installed = install_fakes(module, args)
+    name, event = get_corpus(args)[args.child]
+    cold_s = call(module, event)
+    warm = [call(module, event) for _ in range(20)]
+    print(json.dumps({'event': name, 'import_ms': import_s * 1000,
+                      'cold_ms': cold_s * 1000,
+                      'warm_ms': statistics.median(warm) * 1000,
+                      'fakes': sorted(installed)}))
+
+
+# --------------- report -----------------
+def report(latency, allocations, cold, rounds):
+    """Print tables, return the numbers as a dict."""
+    numbers = {'events': {}, 'handlers': cold, 'imports': {}}
+    print(f"{'event':<48} {'p50 ms':>8} {'p99 ms':>8} {'peak KB':>8}  "
+          "calls per event")
+    for name, result in latency.items():
+        times = result['times']
+        calls = {op: n / rounds for op, n in sorted(result['calls'].items())}
+        numbers['events'][name] = {
+            'p50_ms': percentile(times, 0.5) * 1000,
+            'p99_ms': percentile(times, 0.99) * 1000,
+            'peak_kb': allocations.get(name),
+            'calls': calls}
+        row = numbers['events'][name]
+        call_text = ' '.join(f'{op}={n:g}' for op, n in calls.items())
+        print(f"{name[:48]:<48} {row['p50_ms']:8.3f} {row['p99_ms']:8.3f} "
+              f"{row['peak_kb'] or 0:8.1f}  {call_text}")
+    if cold:
+        print()
+        print(f"{'handler':<28} {'import ms':>10} {'cold ms':>9} "
+              f"{'warm ms':>9}")
+        for handler, row in cold.items():
+            print(f"{handler:<28} {row['import_ms']:10.1f} "
+                  f"{row['cold_ms']:9.3f} {row['warm_ms']:9.3f}")
+    return numbers
+
+
+def parse_args(argv=None):
+    """Return parsed command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--skill', choices=sorted(SKILLS),
+                        default='subscribe')
+    parser.add_argument('--corpus', help="file of one JSON event per line")
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--db-latency', type=float, default=0.0,
+                        help="ms added to each DynamoDB call")
+    parser.add_argument('--s3-latency', type=float, default=0.0,
+                        help="ms added to each S3 call")
+    parser.add_argument('--isp-latency', type=float, default=0.0,
+                        help="ms added to each ISP call")
+    parser.add_argument('--isp-status', type=int, default=200,
+                        help="HTTP status the ISP endpoint answers with")
+    parser.add_argument('--log-level', default='ERROR')
+    parser.add_argument('--store', choices=('dynamodb', 'memory', 'file'),
+                        default='dynamodb',
+                        help="USER_STORE: fake DynamoDB or a local store")
+    parser.add_argument('--cache-size', type=int,
+                        help="USER_CACHE_SIZE, 0 for no user cache")
+    parser.add_argument('--mix-seconds', type=float, default=5.0,
+                        help="MIX_SECONDS, length of each rendered mix")
+    parser.add_argument('--no-cold', action='store_true',
+                        help="skip the per-handler fresh process runs")
+    parser.add_argument('--json', help="also save numbers to this file")
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    for name in ('db_latency', 's3_latency', 'isp_latency'):
+        setattr(args, name, getattr(args, name) / 1000)
+    # load_skill changes folder
+    for name in ('corpus', 'json'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ.setdefault('LOG_LEVEL', args.log_level)
+    if args.child is not None:
+        return run_child(args)
+    module = load_skill(args.skill)
+    installed = install_fakes(module, args)
+    corpus = get_corpus(args)
+    latency = measure_latency(module, corpus, installed, args.rounds)
+    allocations = measure_allocations(module, corpus)
+    cold = {} if args.no_cold else measure_cold(args, corpus, module)
+    numbers = report(latency, allocations, cold, args.rounds)
+    if hasattr(module, 'store_metrics') and module.store_metrics():
+        numbers['user_cache'] = module.store_metrics()
+        print(f"\nuser cache: {numbers['user_cache']}")
+    if getattr(module, 'MIX_CACHE', None):
+        numbers['mix_cache'] = module.MIX_CACHE.metrics()
+        print(f"mix cache: {numbers['mix_cache']}")
+    if not args.no_cold:
+        code_dir, module_name, _, work_dir = SKILLS[args.skill]
+        print()
+        numbers['imports'] = importtime.report(
+            module_name, work_dir, env=dict(child_env(args),
+                                            PYTHONPATH=code_dir))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(numbers, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""dynamo_codec.py: convert attribute trees to and from DynamoDB values.
+
+DynamoDB (through boto3) rejects floats and returns every number as a
+Decimal, and the table has historically stored empty strings as ' '.
+`encode` and `decode` make those conversions in one pass over the tree
+without recursion, so depth is not limited by the recursion limit.
+The input is never modified: containers are copied only when something
+inside them changes, and unchanged subtrees are shared with the result.
+"""
+from decimal import Decimal
+
+EMPTY_STRING = ' '      # stored in place of ''
+_SCALARS = {int, bool, float, Decimal, type(None)}  # never containers
+
+
+def encode(data):
+    """Return `data` ready for put_item/update_item."""
+    return _transform(data, '', EMPTY_STRING, float, _float_to_decimal)
+
+
+def decode(data):
+    """Return `data` from get_item as plain python values."""
+    return _transform(data, EMPTY_STRING, '', Decimal, _decimal_to_number)
+
+
+def _float_to_decimal(value):
+    """Return Decimal for float `value`."""
+    return Decimal(repr(value))
+
+
+def _decimal_to_number(value):
+    """Return int for whole Decimal `value`, float otherwise."""
+    if value == value.to_integral_value():
+        return int(value)
+    return float(value)
+
+
+def _transform(data, old_str, new_str, number_type, convert):
+    """Return data with old_str and number_type values replaced.
+
+    Strings equal to old_str become new_str and numbers of exactly
+    number_type go through convert.  Containers are visited in one flat
+    loop, parents before children (nodes[i] is (container, index of its
+    parent, key in parent)); a container's copy is made when something
+    inside it is replaced, then copies are passed up children first.
+    """
+    if not isinstance(data, (dict, list)):
+        return _scalar(data, old_str, new_str, number_type, convert)
+    nodes = [(data, None, None)]
+    copies = []
+    for index, (node, _, _) in enumerate(nodes):
+        copy = None
+        for key, value in (node.items() if isinstance(node, dict)
+                           else enumerate(node)):
+            kind = value.__class__
+            if kind is str:
+                if value != old_str:
+                    continue
+                new = new_str
+            elif kind is number_type:
+                new = convert(value)
+            elif kind is dict or kind is list or \
+                    kind not in _SCALARS and isinstance(value, (dict, list)):
+                nodes.append((value, index, key))
+                continue
+            else:
+                continue
+            if copy is None:
+                copy = _copy(node)
+            copy[key] = new
+        copies.append(copy)
+    for index in range(len(nodes) - 1, 0, -1):
+        done = copies[index]
+        if done is not None:
+            _, parent, key = nodes[index]
+            if copies[parent] is None:
+                copies[parent] = _copy(nodes[parent][0])
+            copies[parent][key] = done
+    return data if copies[0] is None else copies[0]
+
+
+def _scalar(value, old_str, new_str, number_type, convert):
+    """Return replacement for a top-level scalar."""
+    if value.__class__ is str and value == old_str:
+        return new_str
+    if value.__class__ is number_type:
+        return convert(value)
+    return value
+
+
+def _copy(node):
+    """Return shallow copy of a dict or list."""
+    return dict(node) if isinstance(node, dict) else list(node)
@@ -0,0 +1,215 @@
+"""isp_client.py: in-skill product lookups for the Alexa monetization API.
+
+Uses one keep-alive `requests.Session` for the life of the container
+(created, and `requests` imported, on first use) with explicit timeouts
+and a few quick retries of 5xx answers and timeouts, so a slow endpoint
+can't hold the lambda.  Lookups can run on a background thread
+(`submit_products`) while the handler reads the database, `wait_products`
+gives up on them after `ISP_DEADLINE`, and results are cached per user
+and product for `ENTITLEMENT_TTL` seconds.  After `BREAKER_THRESHOLD`
+failed lookups in a row the endpoint is left alone for `BREAKER_COOLDOWN`
+seconds and lookups return None straight away, so callers can fall back
+to what they last saved.
+"""
+import threading
+import time
+
+import skill_log as log
+
+ISP_ENDPOINT = "/v1/users/~current/skills/~current/inSkillProducts/" # noqa
+ISP_TIMEOUT = (1.0, 2.5)        # (connect, read) seconds per attempt
+ISP_RETRIES = 2                 # extra attempts after 5xx or timeout
+ISP_RETRY_STATUS = (500, 502, 503, 504)
+ISP_BACKOFF = 0.1               # urllib3 backoff_factor, seconds
+ISP_DEADLINE = 2.0              # seconds wait_products waits for a lookup
+ENTITLEMENT_TTL = 5 * 60        # seconds to trust a cached entitlement
+BREAKER_THRESHOLD = 3           # failed lookups in a row to open circuit
+BREAKER_COOLDOWN = 30.0         # seconds circuit stays open
+
+ISP_WORKERS = 2                 # background lookups, and pooled connections
+
+SESSION = None      # pooled requests.Session, see get_session
+EXECUTOR = None     # background lookups, see get_executor
+
+# {userId: {productId: (expires, product)}}
+_ENTITLEMENTS = {}
+_LOCK = threading.Lock()
+
+
+def get_products(api_endpoint, token, locale, userId):
+    """Return in-skill products response for user.
+
+    {} if the skill has no products for the user (any 4xx answer), None
+    if the endpoint failed or the circuit is open.
+    """
+    cached = cached_products(userId)
+    if cached is not None:
+        log.debug("cached isp products", count=len(cached))
+        return {'inSkillProducts': cached}
+    if not BREAKER.allow():
+        log.debug("isp circuit open")
+        return None
+    url = f"{api_endpoint}{ISP_ENDPOINT}"
+    log.debug("checking isp", url=url)
+    headers = {'Authorization': f'Bearer {token}',
+               'Accept-Language': f'{locale}',
+               'Accept': 'application/json'}
+    import requests
+    try:
+        r = get_session().get(url=url, headers=headers, timeout=ISP_TIMEOUT)
+    except requests.exceptions.Timeout:
+        log.warning("timeout error in get_products")
+        BREAKER.failure()
+        return None
+    except requests.exceptions.RequestException as e:
+        # includes retries used up on timeouts or 5xx
+        log.warning("connection error in get_products", error=e)
+        BREAKER.failure()
+        return None
+    if r.status_code == requests.codes.ok:
+        BREAKER.success()
+        isp = r.json()
+        log.debug("get_products response", isp=isp)
+        cache_products(userId, isp.get('inSkillProducts', []))
+        return isp
+    log.warning("bad request in get_products", status=r.status_code,
+                text=r.text)
+    if r.status_code >= 500:
+        BREAKER.failure()
+        return None
+    BREAKER.success()
+    return {}
+
+
+def get_session():
+    """Return the pooled session, creating it on first use."""
+    global SESSION
+    if SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        retry = Retry(total=ISP_RETRIES, status_forcelist=ISP_RETRY_STATUS,
+                      allowed_methods=frozenset(['GET']),
+                      backoff_factor=ISP_BACKOFF, raise_on_status=False)
+        SESSION = requests.Session()
+        SESSION.mount('https://', HTTPAdapter(
+            max_retries=retry, pool_maxsize=ISP_WORKERS))
+    return SESSION
+
+
+def get_executor():
+    """Return the pool background lookups run on, creating it on first use."""
+    global EXECUTOR
+    if EXECUTOR is None:
+        from concurrent.futures import ThreadPoolExecutor
+        EXECUTOR = ThreadPoolExecutor(max_workers=ISP_WORKERS)
+    return EXECUTOR
+
+
+def submit_products(api_endpoint, token, locale, userId):
+    """Start `get_products` in the background and return its Future."""
+    return get_executor().submit(get_products, api_endpoint, token, locale,
+                                 userId)
+
+
+def wait_products(future, timeout=None):
+    """Return result of a `submit_products` Future, None if not in time.
+
+    Waits `timeout` seconds, ISP_DEADLINE by default.  A lookup given up
+    on keeps running and still fills the cache.
+    """
+    from concurrent.futures import TimeoutError as FutureTimeout
+    if timeout is None:
+        timeout = ISP_DEADLINE
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeout:
+        log.warning("isp lookup past deadline", seconds=timeout)
+        return None
+
+
+# --------------- circuit breaker -----------------
+class CircuitBreaker:
+    """Stop calling an endpoint that keeps failing.
+
+    After `threshold` failures in a row the circuit opens and `allow`
+    returns False for `cooldown` seconds.  Then one call is let through:
+    success closes the circuit, failure keeps it open for another
+    cooldown.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD,
+                 cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None      # time.monotonic() circuit opened
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a call may be made now."""
+        with self._lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened < self.cooldown:
+                return False
+            # trial call; others wait out another cooldown
+            self.opened = time.monotonic()
+            return True
+
+    def success(self):
+        """Record a call that worked, closing the circuit."""
+        with self._lock:
+            if self.opened is not None:
+                log.info("isp circuit closed")
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        """Record a failed call, opening the circuit at threshold."""
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened is None:
+                    log.warning("isp circuit open", failures=self.failures)
+                self.opened = time.monotonic()
+
+
+BREAKER = CircuitBreaker()
+
+
+# --------------- entitlement cache -----------------
+def cache_products(userId, products):
+    """Remember `products` for userId for ENTITLEMENT_TTL seconds."""
+    if not products:
+        return
+    expires = time.monotonic() + ENTITLEMENT_TTL
+    with _LOCK:
+        _ENTITLEMENTS[userId] = {p['productId']: (expires, p)
+                                 for p in products}
+
+
+def cached_products(userId):
+    """Return cached product list for userId, or None if stale/missing."""
+    now = time.monotonic()
+    with _LOCK:
+        products = _ENTITLEMENTS.get(userId)
+        if not products:
+            return None
+        if any(expires <= now for expires, _ in products.values()):
+            del _ENTITLEMENTS[userId]
+            return None
+        return [p for _, p in products.values()]
+
+
+def invalidate(userId, productId=None):
+    """Forget cached entitlements of user for productId (or any product).
+
+    The whole product list for the user is dropped so the next lookup
+    fetches a complete, current answer.
+    """
+    with _LOCK:
+        products = _ENTITLEMENTS.get(userId)
+        if products is not None and (productId is None or
+                                     productId in products):
+            del _ENTITLEMENTS[userId]
@@ -1,17 +1,21 @@
 """lambda_function.py: lambda test ffmpeg skill."""
+import copy
+import json
+import os
 import random
+import time
 from datetime import datetime
-from decimal import Decimal
-import requests
-import json
-import boto3
-from botocore.exceptions import ClientError
+import dynamo_codec
+import isp_client
+import skill_log as log
+import user_store
+from user_store import DATA, VERSION
+from message_catalog import MessageCatalog, SPEECH_LIMIT
+from tone_catalog import ToneCatalog
 
 __version__ = '0.2.0'
 __author__ = 'Milton Huang'
 
-PRINT_LIMIT = 33    # to shorten debug output
-
 # --------------- context keys -----------------
 # CONTEXT keys, values don't matter but must be consistent in code
 START_STATE = 'start state'
@@ -22,6 +26,9 @@ TONE_FOLLOWUP_STATE = 'answer TONE_FOLLOWUP state'
 BUY_INTENT = 'BuyIntent'
 CAN_BUY_INTENT = 'CanBuyIntent'
 REFUND_INTENT = 'RefundIntent'
+# sent while the AudioPlayer plays, in a new session that isn't a launch
+AUDIO_INTENTS = ('AMAZON.PauseIntent', 'AMAZON.ResumeIntent',
+                 'AMAZON.StopIntent', 'AMAZON.CancelIntent')
 
 # --------------- slots names -----------------
 # must match the name of the slot in model.json
@@ -38,152 +45,187 @@ SUBSCRIBER_COUNT = 'number of subscriber plays'
 IS_SUBSCRIBER = 'is a subscriber'
 ISP_ID = 'ISP product id'
 MIX_INDEX = 'index of mix tone'
-MIX_HASH = 'uuid for filename'
+MIX_HASH = 'uuid for filename'    # recipe hash of the last mix
 CURRENT_PLAYTIME = 'cummulative mix duration'
 TARGET_DURATION = 'target mix duration'
 STATE = 'conversation state'
+RECORD_VERSION = 'record version'   # VERSION of the record when read
 
 # --------------- DynamoDB names -----------------
-USERID = 'userId'   # table key
-DATA = 'data'       # table record
-TIMESTAMP = 'timestamp'       # table record
-
-# local version
-# DYNAMODB = boto3.resource('dynamodb', region_name='us-east-1',
-#                           endpoint_url='http://localhost:8000')
-DYNAMODB = boto3.resource('dynamodb', region_name='us-east-1')
-DB_TABLE_NAME = 'ToneTherapyTable'
-DB_TABLE = DYNAMODB.Table(DB_TABLE_NAME)
-
-TONE_BUCKET = boto3.resource('s3').Bucket('solutonetherapytones')
-TONE_CLIENT = boto3.client('s3')
-URL_PREFIX = "https://solutonetherapytones.s3.amazonaws.com/"
-FREE_LIST = [x.key[5:] for x in TONE_BUCKET.objects.filter(Prefix='free')
-             if x.key != 'free/']
-SOURCE_LIST = [x.key[7:] for x in TONE_BUCKET.objects.filter(Prefix='source')
-               if x.key != 'source/']
-print(f"Free list:{FREE_LIST}\nSource list:{SOURCE_LIST}")
+# USERID (table key), DATA, TIMESTAMP and VERSION (table record) are in
+#   user_store
+# counters are top-level number attributes so they can be ADDed to
+#   without rewriting DATA; older records keep them inside DATA
+COUNTERS = {
+    VISIT_COUNT: 'visits',
+    FREE_COUNT: 'freePlays',
+    SUBSCRIBER_COUNT: 'subscriberPlays',
+}
+
+# USER_STORE: 'dynamodb', or 'memory' / 'file' to run without AWS (see
+#   user_store).  The store, and boto3, are created on first use
+#   (get_store), not at import, to keep lambda init short
+USER_STORE = os.environ.get('USER_STORE', 'dynamodb')
+USER_STORE_FILE = os.environ.get('USER_STORE_FILE', '/tmp/users.jsonl')
+# records read are kept across warm invocations (user_store.CachedStore);
+#   USER_CACHE_SIZE 0 turns that off
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '1000'))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '300'))  # seconds
+DB_REGION = 'us-east-1'
+DB_ENDPOINT = None      # local version: 'http://localhost:8000'
+DB_TABLE_NAME = 'ToneTherapyTable'     # made by `python user_store.py`
+# records not written for USER_TTL_DAYS are deleted by the table's time to
+#   live; 0 writes no EXPIRES, so records are kept
+USER_TTL_DAYS = float(os.environ.get('USER_TTL_DAYS', '365'))
+STORE = None
+OCC_RETRIES = 3     # merges and retries of a write that lost a race
+OCC_BACKOFF = (0.01, 0.1)   # base, cap seconds of jittered wait before one
 
-ISP_ENDPOINT = "/v1/users/~current/skills/~current/inSkillProducts/" # noqa
+URL_PREFIX = "https://solutonetherapytones.s3.amazonaws.com/"
+# listed from S3 (or tone_manifest.json) on first use, not at import
+FREE_LIST = ToneCatalog('free')
+SOURCE_LIST = ToneCatalog('source')
+MIX_LIST = ToneCatalog('mixes')     # rendered mixes are uploaded here
+
+# --------------- mix settings -----------------
+# a mix is MIX_LAYERS layers played at once, each MIX_TONES source tones
+#   crossfaded one into the next (see tone_mixer)
+MIX_SECONDS = 180       # SSML audio may total 240 s per response
+MIX_LAYERS = 2
+MIX_TONES = 3
+# 'mp3' for Alexa; 'wav' needs no ffmpeg, for local runs
+MIX_FORMAT = os.environ.get('MIX_FORMAT', 'mp3')
+# mixes are rendered into MIX_FOLDER (None for mix_cache.MIX_CACHE_FOLDER),
+#   uploaded to MIX_LIST and removed; the names of MIX_CACHE_NAMES are
+#   remembered so they aren't looked for again
+# mixing modules (tone_mixer, mix_cache, tone_index, parallel_encoder,
+#   segment_planner) are imported when a mix is first made, not on cold
+#   start
+MIX_FOLDER = None
+MIX_CACHE_NAMES = int(os.environ.get('MIX_CACHE_NAMES', '10000'))
+MIX_CACHE = None
+# users share MIX_SEEDS tone picking seeds, a hash of their id choosing
+#   one, so mixes differ between users yet recur in the mix cache
+MIX_SEEDS = int(os.environ.get('MIX_SEEDS', '64'))
+# MP3 mixes are encoded in parallel_encoder.CHUNK_SECONDS chunks by
+#   ENCODE_WORKERS ffmpegs at once (lambda has a vCPU per 1769 MB of
+#   memory); 1 encodes in one ffmpeg (tone_mixer.mp3_chunks)
+ENCODE_WORKERS = int(os.environ.get('ENCODE_WORKERS', os.cpu_count() or 1))
+ENCODER = None
+# duration, loudness and pitch of every tone, built offline (see
+#   tone_index) and loaded once per container: mixes take a root tone and
+#   tones consonant with it, levelled to tone_index.TARGET_LOUDNESS
+TONE_INDEX_FN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'tone_index.bin')
+TONE_INDEX = None
+# TimeIntent sessions play through the AudioPlayer as a queue of
+#   SEGMENT_SECONDS mixes, each made when the one before nearly finishes
+#   (see segment_planner, whose SEGMENT_SECONDS None stands for); the
+#   first is shorter so playback starts sooner
+SEGMENT_SECONDS = None
+FIRST_SEGMENT_SECONDS = 60
 
 SHORT_PAUSE = "<break time='1s'/> "
 
-VOCAB = {
-    'en-US': {
-        'messages': {
-            'WELCOME_MESSAGE': "Welcome to Tone Therapy. When you return to "
-                               "this skill in the future, I’ll play a three "
-                               "minute session of peaceful, healing tones. "
-                               "These are free samples that have been "
-                               "pre-recorded. If you would like to hear "
-                               "tone sessions created for you in the moment "
-                               "just say, what can I buy? ",
-            'STOP_MESSAGE': "Ok. Goodbye! ",
-            'FREE_HELP': "One of three, free, pre-recorded, Tone Therapy "
-                         "sessions will play for three minutes each time you "
-                         "say Alexa, open tone therapy. The premium version "
-                         "of Tone Therapy offers Tone Therapy sessions that "
-                         "are composed in the moment just for you, and "
-                         "they never repeat. And, you won’t hear my voice "
-                         "every time. You can learn more by saying, tell "
-                         "me about premium. Now, ",
-            'SUBSCRIBER_HELP': "When I ask, Just say, play for, the number "
-                               "of minutes or hours you want to play. ",
-            'CONFUSED_TIME': "I’m confused about how long you want the "
-                             "tones to play. Please try again. ",
-            'CONFUSED_YES': "I’m sorry, but I don't understand what you are "
-                            "saying yes for. ",
-            'CONFUSED_NO': "I’m sorry, but I don't understand what you are "
-                           "saying no for. ",
-            'FREE_FALLBACK': "I'm sorry, I don't understand what you want. "
-                             "You can say, Alexa, help, for more help. Here "
-                             "is another free tone. ",
-            'FALLBACK_MESSAGE': "I'm sorry, I don't understand what you want. "
-                                "Try again. ",
-            'FALLBACK_REPROMPT': "Please try asking that a different way. ",
-            'BAD_PROBLEM': "I'm sorry, something happened that shouldn't "
-                           "have. Please Try again. ",
-            'BAD_GENERATOR': "Sorry, there is something wrong with my mixing "
-                             "system. Please try again later. Goodbye.",
-            'FREE_INTRO_1': "<audio src=\"" + URL_PREFIX +
-                            "messages/this_is_ruane_for_solu.mp3\" /> ",
-            'FREE_INTRO_2': "<audio src=\"" + URL_PREFIX +
-                            "messages/Created_on_Marthas_Vineyard.mp3\" /> ",
-            'FREE_INTRO_3': "<audio src=\"" + URL_PREFIX +
-                            "messages/If_you_want_to_learn_more.mp3\" /> ",
-            'FREE_INTRO_4': "<audio src=\"" + URL_PREFIX +
-                            "messages/Tone_Therapy_3_minutes.mp3\" /> ",
-            'FREE_INTRO_5': "This is free play intro message number 5. ",
-            'FREE_INTRO_6': "This is free play intro message number 6. ",
-            'MIX_INTRO_1': "Welcome to Tone Therapy Premium. Take a deep "
-                           "breath, relax, and,<break time='1s'/> just "
-                           "listen. ",
-            'MIX_INTRO_2': "Welcome back. Remember you can ask for help. "
-                           "Just say, Alexa, help. As the tones play, don’t "
-                           "worry if your mind wanders, just bring your "
-                           "focus back to the tones. Now take a deep breath. "
-                           "Relax. <break time='1s'/> Here you go. ",
-            'MIX_INTRO_3': "Great job. You’re learning to be a focused "
-                           "listener! Oh, if after 7 days you decide Tone "
-                           "Therapy Premium is not for you, just say, "
-                           "cancel my subscription. And this is the last "
-                           "time you’ll hear my voice before your Tone "
-                           "Therapy premium sessions. Remember, you can "
-                           "say, exit, help, or, cancel my subscription, if "
-                           "you interrupt the tone by saying, Alexa. "
-                           "<break time='1s'/> Now here’s your Tone Therapy "
-                           "session. ",
-            'CAN_BUY': "You can buy a subscription to Tone Therapy premium. "
-                       "<break time='0.5s'/> Each time you open Tone Therapy "
-                       "Premium you’ll hear a different tone session. "
-                       "There’s no repetition. Just say, I want tone therapy "
-                       "premium. Until then ",
-            'UPSELL_MESSAGE': "Tone Therapy premium offers Tone Therapy "
-                              "sessions that never repeat, they’re composed "
-                              "in the moment, just for you. And you won’t "
-                              "hear my voice before each tone therapy "
-                              "session. Do you want to learn more? ",
-            'ALREADY_SUBSCRIBE': "Congratulations, you already have a "
-                                 "subscription. ",
-            'FREE_TONE': "<audio src=\"" + URL_PREFIX +
-                         "messages/OK_here_is_session.mp3\" /> ",
-            'FREE_FOLLOWUP': "<break time='5s'/><audio src=\"" + URL_PREFIX +
-                             "messages/AnotherSession1.mp3\" /> ",
-            'TONE_FOLLOWUP': "<break time='5s'/><prosody volume='-3dB'>"
-                             "<amazon:effect name='whispered'>Again?"
-                             "</amazon:effect></prosody> ",
-            'NO_ISP': "Sorry, I can't seem to connect to the Amazon "
-                      "purchasing service right now. ",
-        }
-    },
-}
+# messages are in locales/<locale>.json, each validated and compiled on
+#   first get_message for that locale, falling back to en-US
+MESSAGES = MessageCatalog(substitutions={'URL_PREFIX': URL_PREFIX})
 
 
 # --------------- entry point -----------------
 def lambda_handler(event, context):
     """App entry point."""
-    print(f"DEBUG: in lambda_handler with {event}")
-    request_type = event['request']['type']
-    if event['request']['type'] == 'Connections.Response':
-        return process_isp_response(event)
-    elif (('session' in event and 'new' in event['session'] and
-           event['session']['new']) or request_type == 'LaunchRequest'):
-            return on_launch(event)
-    elif request_type == 'IntentRequest':
-        return on_intent(event)
-    elif event['request']['type'] == 'SessionEndedRequest':
-        return on_session_ended(event)
-    else:
-        print("WARNING: Unhandled event in lambda_handler:", event)
-        return stop_response(event)
+    log.start_invocation()
+    log.info("lambda_handler", request=lambda: request_summary(event))
+    log.debug("lambda_handler event", event=event)
+    begin_turn(event)
+    try:
+        response = dispatch_event(event)
+    except ResponseTooLarge as e:
+        log.error("response too large", part=e.part, size=e.size,
+                  limit=e.limit)
+        messages = get_message(get_locale(event))
+        response = service_response({},
+                                    tell_response(messages['BAD_PROBLEM']))
+    return fit_session(response, end_turn(event))
+
+
+def dispatch_event(event):
+    """Send event to its request handler, timing the handler."""
+    handler = find_route(event)
+    start = time.perf_counter()
+    response = handler(event)
+    elapsed = (time.perf_counter() - start) * 1000
+    log.info("handled", handler=handler.__name__, ms=round(elapsed, 1))
+    return response
+
+
+# --------------- request routing -----------------
+# handlers register with @route for a request type, optionally an intent
+#   name, and optionally a conversation STATE; find_route picks the most
+#   specific match with dict lookups.
+ROUTES = {}         # (request type, intent name, STATE): handler
+STATE_ROUTES = set()    # (request type, intent name) with STATE handlers
+ISP_RESULTS = {}    # (Connections.Response name, purchaseResult): handler
+
+
+def route(request_type, intent_name=None, state=None):
+    """Register decorated function as handler for matching requests."""
+    def register(handler):
+        ROUTES[(request_type, intent_name, state)] = handler
+        if state is not None:
+            STATE_ROUTES.add((request_type, intent_name))
+        return handler
+    return register
+
+
+def isp_result(name, *purchase_results):
+    """Register decorated function for Connections.Response results.
+
+    With no purchase_results it handles any result not otherwise
+    registered for `name`.  Handlers take (event, attributes, messages)
+    and return speechmessage, or None for a confused response.
+    """
+    def register(handler):
+        for purchase_result in purchase_results or (None,):
+            ISP_RESULTS[(name, purchase_result)] = handler
+        return handler
+    return register
+
+
+def find_route(event):
+    """Return request handler for event."""
+    request = event['request']
+    request_type = request['type']
+    intent_name = request['intent']['name'] if 'intent' in request else None
+    if (request_type != 'Connections.Response' and
+            intent_name not in AUDIO_INTENTS and
+            event.get('session', {}).get('new')):
+        request_type = 'LaunchRequest'
+    handler = None
+    if (request_type, intent_name) in STATE_ROUTES:
+        state = get_attributes(event).get(STATE)
+        handler = ROUTES.get((request_type, intent_name, state))
+    if handler is None:
+        handler = ROUTES.get((request_type, intent_name, None))
+    if handler is None:
+        handler = ROUTES.get((request_type, None, None), unhandled_request)
+    return handler
+
+
+def unhandled_request(event):
+    """Stop on a request type nothing is registered for."""
+    log.warning("unhandled event in lambda_handler", event=event)
+    return stop_response(event)
 
 
 # --------------- request handlers -----------------
+@route('LaunchRequest')
 def on_launch(event):
     """Start session."""
-    userId = get_userId(event)
-    attributes = get_dbdata(DB_TABLE, userId)
-    print(f"DEBUG: in on_launch with {event}")
+    # entitlement lookup runs while the user record is read
+    isp_future = submit_isp(event)
+    attributes = get_attributes(event, fresh=True)
     messages = get_message(get_locale(event))
     speechmessage = ""
     if attributes is None or VISIT_COUNT not in attributes:
@@ -193,10 +235,15 @@ def on_launch(event):
         attributes[SUBSCRIBER_COUNT] = 0
         attributes[IS_SUBSCRIBER] = False
         speechmessage = messages['WELCOME_MESSAGE'] + SHORT_PAUSE
-    attributes[VISIT_COUNT] += 1
+    add_count(event, VISIT_COUNT)
     attributes[STATE] = START_STATE
-    isp_response = get_isp(event)
-    if isp_response == {}:
+    isp_response = isp_client.wait_products(isp_future)
+    if isp_response is None:
+        # ISP API down or slow: keep the subscription saved in the record
+        log.warning("isp unavailable, using saved subscription",
+                    is_subscriber=attributes[IS_SUBSCRIBER])
+        attributes.setdefault(ISP_ID, "")
+    elif isp_response == {}:
         # can't buy or sell
         attributes[ISP_ID] = ""
     else:
@@ -206,117 +253,141 @@ def on_launch(event):
             attributes[IS_SUBSCRIBER] = True
         else:
             attributes[IS_SUBSCRIBER] = False
-    print(f"DEBUG: updated_subscription {attributes}")
-    put_dbdata(DB_TABLE, userId, attributes)
+    log.debug("updated_subscription", attributes=attributes)
     if not attributes[IS_SUBSCRIBER]:
         return play_free_tone(event, speechmessage)
     return play_mix_tone(event)
 
 
+@route('Connections.Response')
 def process_isp_response(event):
     """Manage Connections.Response response."""
-    print(f"DEBUG: got Connections.Response:{event}")
-    userId = get_userId(event)
+    log.debug("got Connections.Response", request=event['request'])
     attributes = get_attributes(event)
     messages = get_message(get_locale(event))
-    if 'purchaseResult' not in event['request']['payload']:
-        print("ERROR: no purchaseResult in isp_response")
-        speechmessage = SHORT_PAUSE
-    purchase_result = event['request']['payload']['purchaseResult']
-    if event['request']['name'] == 'Buy':
-        if purchase_result == "ACCEPTED":
-            attributes[IS_SUBSCRIBER] = True
-            speechmessage = SHORT_PAUSE
-            # need messages['SUBSCRIBE_SUCCESS'] if Amazon doesn't say it
-        elif purchase_result == "DECLINED":
-            attributes[IS_SUBSCRIBER] = False
-            # need messages['DECLINED_RESPONSE'] if Amazon doesn't say it
-            speechmessage = SHORT_PAUSE
-        elif purchase_result == "ALREADY_PURCHASED":
-            if not attributes[IS_SUBSCRIBER]:
-                print("ERROR: ALREADY_PURCHASED when not IS_SUBSCRIBER",
-                      attributes)
-                attributes[IS_SUBSCRIBER] = True
-            speechmessage = messages['ALREADY_SUBSCRIBE']
-        elif purchase_result == "ERROR":
-            speechmessage = messages['NO_ISP'] + SHORT_PAUSE
-            print("WARNING: ERROR for Buy in process_isp_response")
-        else:
-            print("ERROR: illegal value from purchase transaction",
-                  purchase_result)
-            return confused_response(event)
-    elif event['request']['name'] == 'Cancel':
-        if purchase_result == "ACCEPTED":
-            speechmessage = SHORT_PAUSE
-            attributes[IS_SUBSCRIBER] = False
-        elif purchase_result == "DECLINED":
-            speechmessage = SHORT_PAUSE
-        elif purchase_result == "ALREADY_PURCHASED":
-            # can this even happen?
-            print("got ALREADY_PURCHASED from ISP Cancel request")
-            speechmessage = SHORT_PAUSE
-        elif purchase_result == "ERROR":
-            print("WARNING: ERROR for Cancel in process_isp_response")
-            speechmessage = messages['NO_ISP'] + SHORT_PAUSE
-        else:
-            speechmessage = SHORT_PAUSE
-            print("ERROR: illegal value in Cancel transaction",
-                  purchase_result)
-    elif event['request']['name'] == 'Upsell':
-        if purchase_result == "ACCEPTED":
-            speechmessage = SHORT_PAUSE
-        elif purchase_result == "DECLINED":
-            speechmessage = SHORT_PAUSE
-        elif purchase_result == "ALREADY_PURCHASED":
-            speechmessage = SHORT_PAUSE
-        elif purchase_result == "ERROR":
-            print("WARNING: ERROR for Upsell in process_isp_response")
-            speechmessage = messages['NO_ISP'] + SHORT_PAUSE
-        else:
-            speechmessage = SHORT_PAUSE
-            print("ERROR: illegal value in Upsell transaction",
-                  purchase_result)
-    else:
-        print("WARNING: unhandled request name in process_isp_response",
-              event['request'])
+    name = event['request']['name']
+    purchase_result = event['request']['payload'].get('purchaseResult')
+    if purchase_result is None:
+        log.error("no purchaseResult in isp_response")
+    handler = ISP_RESULTS.get((name, purchase_result),
+                              ISP_RESULTS.get((name, None)))
+    if handler is None:
+        log.warning("unhandled request name in process_isp_response",
+                    request=event['request'])
+        return confused_response(event)
+    speechmessage = handler(event, attributes, messages)
+    if speechmessage is None:
         return confused_response(event)
-    put_dbdata(DB_TABLE, userId, attributes)
     return choice_ending(event, speechmessage)
 
 
-def on_intent(event):
-    """Process intent."""
-    intent_name = event['request']['intent']['name']
-    print(f"on_intent: {intent_name}")
-    if intent_name in ('AMAZON.StopIntent', 'AMAZON.CancelIntent'):
-        return stop_response(event)
-    elif intent_name == 'AMAZON.HelpIntent':
-        return help_response(event)
-    elif intent_name == CAN_BUY_INTENT:
-        return process_upsell(event)
-    elif intent_name == BUY_INTENT:
-        return process_purchase(event)
-    elif intent_name == REFUND_INTENT:
-        return process_refund(event)
-    elif intent_name == 'AMAZON.YesIntent':
-        return process_yes(event)
-    elif intent_name == 'AMAZON.NoIntent':
-        return process_no(event)
-    else:
-        print("WARNING: unhandled intent in on_intent", intent_name)
-        return confused_response(event)
+@isp_result('Buy', 'ACCEPTED')
+def buy_accepted(event, attributes, messages):
+    """Record new subscription."""
+    forget_entitlement(event, attributes)
+    attributes[IS_SUBSCRIBER] = True
+    # need messages['SUBSCRIBE_SUCCESS'] if Amazon doesn't say it
+    return SHORT_PAUSE
+
+
+@isp_result('Buy', 'DECLINED')
+def buy_declined(event, attributes, messages):
+    """Record declined subscription."""
+    attributes[IS_SUBSCRIBER] = False
+    # need messages['DECLINED_RESPONSE'] if Amazon doesn't say it
+    return SHORT_PAUSE
+
+
+@isp_result('Buy', 'ALREADY_PURCHASED')
+def buy_already_purchased(event, attributes, messages):
+    """Fix IS_SUBSCRIBER if Amazon says we already have it."""
+    if not attributes[IS_SUBSCRIBER]:
+        log.error("ALREADY_PURCHASED when not IS_SUBSCRIBER",
+                  attributes=attributes)
+        attributes[IS_SUBSCRIBER] = True
+    return messages['ALREADY_SUBSCRIBE']
+
+
+@isp_result('Buy')
+def buy_illegal(event, attributes, messages):
+    """Be confused by unknown Buy result."""
+    log.error("illegal value from purchase transaction",
+              purchaseResult=event['request']['payload'].get('purchaseResult'))
+    return None
+
+
+@isp_result('Cancel', 'ACCEPTED')
+def cancel_accepted(event, attributes, messages):
+    """Record cancelled subscription."""
+    forget_entitlement(event, attributes)
+    attributes[IS_SUBSCRIBER] = False
+    return SHORT_PAUSE
+
+
+@isp_result('Cancel', 'ALREADY_PURCHASED')
+def cancel_already_purchased(event, attributes, messages):
+    """Note unexpected Cancel result."""
+    # can this even happen?
+    log.warning("got ALREADY_PURCHASED from ISP Cancel request")
+    return SHORT_PAUSE
+
+
+@isp_result('Cancel', 'DECLINED')
+@isp_result('Upsell', 'ACCEPTED', 'DECLINED', 'ALREADY_PURCHASED')
+def isp_acknowledged(event, attributes, messages):
+    """Nothing changed, just continue."""
+    return SHORT_PAUSE
+
 
+@isp_result('Buy', 'ERROR')
+@isp_result('Cancel', 'ERROR')
+@isp_result('Upsell', 'ERROR')
+def isp_error(event, attributes, messages):
+    """Tell user purchasing isn't working."""
+    log.warning("ERROR in process_isp_response",
+                name=event['request']['name'])
+    return messages['NO_ISP'] + SHORT_PAUSE
 
+
+@isp_result('Cancel')
+@isp_result('Upsell')
+def isp_illegal(event, attributes, messages):
+    """Log unknown Cancel or Upsell result and continue."""
+    log.error("illegal value in ISP transaction",
+              name=event['request']['name'],
+              purchaseResult=event['request']['payload'].get('purchaseResult'))
+    return SHORT_PAUSE
+
+
+def forget_entitlement(event, attributes):
+    """Drop cached entitlement after an ACCEPTED Buy or Cancel."""
+    product_id = event['request']['payload'].get('productId',
+                                                 attributes.get(ISP_ID))
+    isp_client.invalidate(get_userId(event), product_id)
+
+
+@route('IntentRequest')
+def unhandled_intent(event):
+    """Be confused by an intent nothing is registered for."""
+    log.warning("unhandled intent",
+                intent=event['request']['intent']['name'])
+    return confused_response(event)
+
+
+@route('IntentRequest', 'AMAZON.StopIntent')
+@route('IntentRequest', 'AMAZON.CancelIntent')
 def stop_response(event):
-    """Give stop message response."""
-    userId = get_userId(event)
+    """Give stop message response, or stop the AudioPlayer if it plays."""
+    player = event.get('context', {}).get('AudioPlayer', {})
+    if player.get('playerActivity') == 'PLAYING':
+        return audio_response(event, {'type': 'AudioPlayer.Stop'})
     attributes = get_attributes(event)
     messages = get_message(get_locale(event))
-    put_dbdata(DB_TABLE, userId, attributes)
     response = tell_response(messages['STOP_MESSAGE'])
     return service_response(attributes, response)
 
 
+@route('IntentRequest', 'AMAZON.HelpIntent')
 def help_response(event):
     """Give help response."""
     messages = get_message(get_locale(event))
@@ -350,39 +421,49 @@ def choice_ending(event, speechmessage=""):
         return play_free_tone(event, speechmessage)
 
 
+@route('IntentRequest', 'AMAZON.YesIntent', TONE_FOLLOWUP_STATE)
+def yes_to_followup(event):
+    """Play another tone after TONE_FOLLOWUP."""
+    attributes = get_attributes(event)
+    attributes[STATE] = START_STATE
+    if not attributes[IS_SUBSCRIBER]:
+        return play_free_tone(event)
+    return play_mix_tone(event)
+
+
+@route('IntentRequest', 'AMAZON.YesIntent')
 def process_yes(event):
-    """Process YesIntent."""
+    """Process YesIntent in a state that didn't ask a question."""
     attributes = get_attributes(event)
     messages = get_message(get_locale(event))
-    print(f"entering process_yes with {attributes}")
-    if attributes[STATE] == TONE_FOLLOWUP_STATE:
-        attributes[STATE] = START_STATE
-        if not attributes[IS_SUBSCRIBER]:
-            return play_free_tone(event)
-        return play_mix_tone(event)
-    else:
-        print("WARNING: unhandled _state in process_yes", attributes[STATE])
-        speechmessage = messages['CONFUSED_YES']
+    log.warning("unhandled _state in process_yes", state=attributes.get(STATE))
+    speechmessage = messages['CONFUSED_YES']
     if not attributes[IS_SUBSCRIBER]:
         return play_free_tone(event, speechmessage)
     return play_mix_tone(event, speechmessage)
 
 
+@route('IntentRequest', 'AMAZON.NoIntent', TONE_FOLLOWUP_STATE)
+def no_to_followup(event):
+    """Stop after TONE_FOLLOWUP."""
+    attributes = get_attributes(event)
+    attributes[STATE] = START_STATE
+    return stop_response(event)
+
+
+@route('IntentRequest', 'AMAZON.NoIntent')
 def process_no(event):
-    """Process NoIntent."""
+    """Process NoIntent in a state that didn't ask a question."""
     attributes = get_attributes(event)
     messages = get_message(get_locale(event))
-    if attributes[STATE] == TONE_FOLLOWUP_STATE:
-        attributes[STATE] = START_STATE
-        return stop_response(event)
-    else:
-        print(f"WARNING: unhandled _state in process_no {attributes[STATE]}")
-        speechmessage = messages['CONFUSED_NO']
+    log.warning("unhandled _state in process_no", state=attributes.get(STATE))
+    speechmessage = messages['CONFUSED_NO']
     if not attributes[IS_SUBSCRIBER]:
         return play_free_tone(event, speechmessage)
     return play_mix_tone(event, speechmessage)
 
 
+@route('IntentRequest', CAN_BUY_INTENT)
 def process_upsell(event):
     """Process CAN_BUY_INTENT."""
     attributes = get_attributes(event)
@@ -394,11 +475,11 @@ def process_upsell(event):
     return play_free_tone(event, speechmessage)
 
 
+@route('IntentRequest', BUY_INTENT)
 def process_purchase(event):
     """Process BuyIntent."""
-    userId = get_userId(event)
     attributes = get_attributes(event)
-    print(f"DEBUG: in process_purchase with {attributes}")
+    log.debug("in process_purchase", attributes=attributes)
     messages = get_message(get_locale(event))
     # this hands off to Amazon
     if attributes[IS_SUBSCRIBER]:
@@ -410,39 +491,139 @@ def process_purchase(event):
     response = tell_response("")
     response = add_directive(response,
                              isp_directive(event, 'Buy', attributes[ISP_ID]))
-    put_dbdata(DB_TABLE, userId, attributes)
     return service_response(attributes, response)
 
 
+@route('IntentRequest', REFUND_INTENT)
 def process_refund(event):
     """Process RefundIntent."""
-    userId = get_userId(event)
     attributes = get_attributes(event)
-    print(f"DEBUG: in process_refund with {attributes}")
+    log.debug("in process_refund", attributes=attributes)
     response = tell_response("")
     response = add_directive(response,
                              isp_directive(event,
                                            'Cancel', attributes[ISP_ID]))
-    put_dbdata(DB_TABLE, userId, attributes)
     return service_response(attributes, response)
 
 
+@route('IntentRequest', 'TimeIntent')
+def play_for_duration(event):
+    """Start a mix session as long as the duration slot asks for."""
+    import segment_planner
+    import tone_mixer
+    attributes = get_attributes(event)
+    messages = get_message(get_locale(event))
+    if not attributes[IS_SUBSCRIBER]:
+        return play_free_tone(event)
+    try:
+        seconds = segment_planner.parse_duration(
+            get_slot_value(event, DURATION_SLOT))
+    except ValueError as e:
+        log.info("unusable duration", error=str(e))
+        response = ask_response(messages['CONFUSED_TIME'],
+                                messages['SUBSCRIBER_HELP'])
+        return service_response(attributes, response)
+    index = attributes.get(MIX_INDEX, 0)
+    plan = segment_planner.SegmentPlan(
+        seconds, SEGMENT_SECONDS or segment_planner.SEGMENT_SECONDS, index,
+        FIRST_SEGMENT_SECONDS)
+    try:
+        url, mix_hash = mix_url(plan.mix_index(0), plan[0],
+                                mix_seed(event))
+    except (tone_mixer.MixError, OSError) as e:
+        log.error("mix failed", error=str(e))
+        return service_response(attributes,
+                                tell_response(messages['BAD_GENERATOR']))
+    log.debug("segment plan", plan=repr(plan))
+    attributes[MIX_INDEX] = index + len(plan)
+    attributes[MIX_HASH] = mix_hash
+    attributes[TARGET_DURATION] = plan.total
+    attributes[CURRENT_PLAYTIME] = plan[0]
+    return audio_response(event, play_directive(url, plan.token(0)))
+
+
+@route('AudioPlayer.PlaybackNearlyFinished')
+def enqueue_next_segment(event):
+    """Make the next segment of a session and queue it behind this one."""
+    import segment_planner
+    import tone_mixer
+    token = event['request'].get('token')
+    plan, index = segment_planner.SegmentPlan.from_token(token)
+    if plan is None or index + 1 >= len(plan):
+        return audio_response(event)
+    index += 1
+    try:
+        url, _ = mix_url(plan.mix_index(index), plan[index], mix_seed(event))
+    except (tone_mixer.MixError, OSError) as e:
+        log.error("segment mix failed", error=str(e), segment=index)
+        return audio_response(event)
+    # the token carries the plan: no user record is read or written
+    return audio_response(event, play_directive(
+        url, plan.token(index), 'ENQUEUE', previous_token=token))
+
+
+@route('IntentRequest', 'AMAZON.ResumeIntent')
+@route('PlaybackController.PlayCommandIssued')
+def resume_segment(event):
+    """Play the segment that was stopped from where it stopped."""
+    import segment_planner
+    import tone_mixer
+    player = event['context'].get('AudioPlayer', {})
+    plan, index = segment_planner.SegmentPlan.from_token(player.get('token'))
+    if plan is None or index >= len(plan):
+        if event['request']['type'] == 'IntentRequest':
+            return confused_response(event)
+        return audio_response(event)
+    try:
+        url, _ = mix_url(plan.mix_index(index), plan[index],
+                         mix_seed(event))
+    except (tone_mixer.MixError, OSError) as e:
+        log.error("segment mix failed", error=str(e), segment=index)
+        return audio_response(event)
+    return audio_response(event, play_directive(
+        url, player['token'], offset=player.get('offsetInMilliseconds', 0)))
+
+
+@route('IntentRequest', 'AMAZON.PauseIntent')
+@route('PlaybackController.PauseCommandIssued')
+def pause_segment(event):
+    """Stop the AudioPlayer; Resume carries on from the same place."""
+    return audio_response(event, {'type': 'AudioPlayer.Stop'})
+
+
+@route('AudioPlayer.PlaybackStarted')
+@route('AudioPlayer.PlaybackStopped')
+@route('AudioPlayer.PlaybackFinished')
+@route('PlaybackController.NextCommandIssued')
+@route('PlaybackController.PreviousCommandIssued')
+def audio_event(event):
+    """Acknowledge an AudioPlayer event that needs nothing done."""
+    return audio_response(event)
+
+
+@route('AudioPlayer.PlaybackFailed')
+def audio_failed(event):
+    """Log why a segment couldn't be played."""
+    log.warning("playback failed", error=event['request'].get('error'),
+                token=event['request'].get('token'))
+    return audio_response(event)
+
+
+@route('SessionEndedRequest')
 def on_session_ended(event):
     """Cleanup session."""
     attributes = get_attributes(event)
-    userId = get_userId(event)
-    print("on_session_ended: ", attributes)
-    put_dbdata(DB_TABLE, userId, attributes)
+    log.debug("on_session_ended", attributes=attributes,
+              reason=event['request'].get('reason'))
     # can't respond to SessionEndedRequest
 
 
 # ------------------------------ request helpers -----------------
 def play_free_tone(event, speechmessage=""):
     """Play tone from free folder on S3."""
-    userId = get_userId(event)
     attributes = get_attributes(event)
     messages = get_message(get_locale(event))
-    attributes[FREE_COUNT] += 1
+    add_count(event, FREE_COUNT)
     speechmessage += messages['FREE_TONE']
     output = ("<audio src=\"https://solutones.s3.amazonaws.com/"
               "subscriptiontest.mp3\" />")
@@ -451,53 +632,156 @@ def play_free_tone(event, speechmessage=""):
     #     response = add_directive(response,
     #                              isp_directive(event,
     #                                            'Upsell', attributes[ISP_ID]))
-    #     put_dbdata(DB_TABLE, userId, attributes)
     #     return service_response(attributes, response)
     attributes[STATE] = TONE_FOLLOWUP_STATE
     output += messages['FREE_FOLLOWUP']
     reprompt = messages['FREE_FOLLOWUP']
-    put_dbdata(DB_TABLE, userId, attributes)
     response = ask_response(output, reprompt)
     return service_response(attributes, response)
 
 
 def play_mix_tone(event, speechmessage=""):
     """Play tone mix using source folder on S3."""
+    import tone_mixer
     attributes = get_attributes(event)
+    try:
+        url = make_mix(attributes, MIX_SECONDS, mix_seed(event))
+    except (tone_mixer.MixError, OSError) as e:     # incl. TransferError
+        log.error("mix failed", error=str(e))
+        messages = get_message(get_locale(event))
+        return service_response(attributes,
+                                tell_response(messages['BAD_GENERATOR']))
+    attributes[TARGET_DURATION] = MIX_SECONDS
+    attributes[CURRENT_PLAYTIME] = MIX_SECONDS
     reprompt = "Do you want to try again?"
-    response = ask_response("<audio src=\"https://solutones.s3.amazonaws.com/"
-                            "subscriptiontest.mp3\" />", reprompt)
+    response = ask_response(speechmessage + f"<audio src=\"{url}\" />",
+                            reprompt)
     return service_response(attributes, response)
 
 
+def make_mix(attributes, seconds, seed):
+    """Return URL of the user's next mix, moving MIX_INDEX on."""
+    index = attributes.get(MIX_INDEX, 0)
+    url, mix_hash = mix_url(index, seconds, seed)
+    attributes[MIX_INDEX] = index + 1
+    attributes[MIX_HASH] = mix_hash
+    return url
+
+
+def mix_seed(event):
+    """Return which of the MIX_SEEDS seeds the user's mixes are picked by."""
+    import hashlib
+    digest = hashlib.sha256(get_userId(event).encode()).hexdigest()
+    return int(digest[:16], 16) % MIX_SEEDS
+
+
+def mix_url(index, seconds, seed):
+    """
+    Return (URL, MIX_HASH) of the user's mix number index.
+
+    Args:
+    index -- the user's MIX_INDEX for this mix
+    seconds -- length of the mix
+    seed -- mix_seed of the user
+    """
+    import mix_cache
+    import tone_mixer
+    layers = pick_tones(random.Random(f'{seed}:{index}'))
+    levels = get_tone_index()
+    gains = [[round(levels.gain(f'{SOURCE_LIST.prefix}/{tone}'), 3)
+              for tone in layer] for layer in layers]
+    mix_hash = mix_cache.recipe_hash(mix_recipe(layers, seconds, gains))
+    name = f'{mix_hash}.{MIX_FORMAT}'
+
+    def render(fn):
+        tones = [[tone_mixer.load(SOURCE_LIST.fetch(tone)) for tone in layer]
+                 for layer in layers]
+        tone_mixer.write(tone_mixer.Mix(tones, seconds, gains=gains), fn,
+                         MIX_FORMAT, encoder=get_encoder())
+
+    cache = get_mix_cache()
+    found = cache.get(name, render, tone_mixer.CONTENT_TYPES[MIX_FORMAT])
+    log.debug("mix", name=name, found=found, cache=cache.metrics,
+              encoder=lambda: ENCODER.metrics() if ENCODER else None)
+    return f'{URL_PREFIX}{MIX_LIST.prefix}/{name}', mix_hash
+
+
+def pick_tones(picker):
+    """
+    Return MIX_LAYERS lists of MIX_TONES source tone names.
+
+    With a tone index, picker chooses a root among the indexed tones long
+    enough for a turn and every tone comes from those consonant with it;
+    without one, any source tone.
+    """
+    import tone_mixer
+    names = list(SOURCE_LIST)
+    if not names:
+        raise tone_mixer.MixError("no source tones")
+    index = get_tone_index()
+    keys = index.select([f'{SOURCE_LIST.prefix}/{name}' for name in names],
+                        min_seconds=tone_mixer.CROSSFADE * 2)
+    if keys:
+        root = picker.choice(keys)
+        prefix = len(SOURCE_LIST.prefix) + 1
+        names = [key[prefix:] for key in index.compatible(root, keys)]
+    return [[picker.choice(names) for _ in range(MIX_TONES)]
+            for _ in range(MIX_LAYERS)]
+
+
+def mix_recipe(layers, seconds, gains=None):
+    """Return everything that decides the bytes of a mix of layers."""
+    import tone_mixer
+    return {'layers': layers, 'gains': gains, 'seconds': seconds,
+            'format': MIX_FORMAT, 'rate': tone_mixer.SAMPLE_RATE,
+            'channels': tone_mixer.CHANNELS,
+            'crossfade': tone_mixer.CROSSFADE, 'fade': tone_mixer.FADE,
+            'bitrate': tone_mixer.MP3_BITRATE,
+            'mixer': tone_mixer.MIXER_VERSION}
+
+
+def get_tone_index():
+    """Return the ToneIndex of TONE_INDEX_FN, loading it on first use."""
+    global TONE_INDEX
+    if TONE_INDEX is None:
+        import tone_index
+        TONE_INDEX = tone_index.ToneIndex.load(TONE_INDEX_FN)
+        log.info("tone index", fn=TONE_INDEX_FN, tones=len(TONE_INDEX))
+    return TONE_INDEX
+
+
+def get_encoder():
+    """Return the ParallelEncoder for MP3 mixes, None for tone_mixer's."""
+    global ENCODER
+    if MIX_FORMAT != 'mp3' or ENCODE_WORKERS < 2:
+        return None
+    if ENCODER is None:
+        import parallel_encoder
+        ENCODER = parallel_encoder.ParallelEncoder(ENCODE_WORKERS)
+    return ENCODER
+
+
+def get_mix_cache():
+    """Return the MixCache in front of MIX_LIST, creating it on first use."""
+    global MIX_CACHE
+    if MIX_CACHE is None:
+        import mix_cache
+        MIX_CACHE = mix_cache.MixCache(
+            MIX_LIST, MIX_FOLDER or mix_cache.MIX_CACHE_FOLDER,
+            MIX_CACHE_NAMES)
+    return MIX_CACHE
+
+
 def get_isp(event):
-    """Get in-skill products list."""
+    """Get in-skill products list, None if the ISP API is unavailable."""
+    return isp_client.wait_products(submit_isp(event))
+
+
+def submit_isp(event):
+    """Start in-skill products lookup, return Future of its response."""
     api_endpoint = event['context']['System']['apiEndpoint']
-    locale = get_locale(event)
-    token = get_access_token(event)
-    url = f"{api_endpoint}{ISP_ENDPOINT}"
-    print(f"checking isp at {url}")
-    headers = {'Authorization': f'Bearer {token}',
-               'Accept-Language': f'{locale}',
-               'Accept': 'application/json'}
-    try:
-        r = requests.get(url=url, headers=headers)
-    except requests.exceptions.Timeout:
-        # consider retry vs message
-        print("Timeout error in get_isp")
-        return {}
-    except requests.exceptions.ConnectionError as e:
-        print("Connection error in get_isp:", e)
-        # connection error message
-        return {}
-    if r.status_code == requests.codes.ok:
-        isp = json.loads(r.text)
-        print("in get_isp, got response:", isp)
-        return isp
-    else:
-        print("bad request in get_isp that did not raise exception:",
-              r.text)
-        return {}
+    return isp_client.submit_products(api_endpoint, get_access_token(event),
+                                      get_locale(event), get_userId(event))
 
 
 def isp_directive(event, request_type, product_id):
@@ -506,7 +790,8 @@ def isp_directive(event, request_type, product_id):
     request_type should be 'Buy', 'Cancel', or 'Upsell'
     see https://developer.amazon.com/docs/in-skill-purchase/add-isps-to-a-skill.html#cancel-requests # noqa
     """
-    print(f"DEBUG: sending isp_directive {request_type} for {product_id}")
+    log.debug("sending isp_directive", request_type=request_type,
+              product_id=product_id)
     directive = {
         "type": "Connections.SendRequest",
         "name": request_type,
@@ -524,9 +809,20 @@ def isp_directive(event, request_type, product_id):
 
 
 # ------------------------------ request helpers -----------------
+def request_summary(event):
+    """Return the fields of event worth logging on every request."""
+    request = event['request']
+    summary = {'type': request['type']}
+    if 'intent' in request:
+        summary['intent'] = request['intent']['name']
+    if 'name' in request:
+        summary['name'] = request['name']
+    return summary
+
+
 def get_message(locale):
-    """Get message strings for `locale`."""
-    return VOCAB[locale]['messages']
+    """Get compiled message strings for `locale`."""
+    return MESSAGES.get(locale)
 
 
 def get_locale(event):
@@ -539,165 +835,293 @@ def get_locale(event):
     return locale
 
 
+def get_slot_value(event, name):
+    """Return value of slot name of the intent, None if not filled."""
+    slots = event['request']['intent'].get('slots') or {}
+    return slots.get(name, {}).get('value')
+
+
 def get_userId(event):
     """Get userId from event."""
-    userId = event['context']['System']['user']['userId']
-    print("userId: ", userId)
-    return userId
+    return event['context']['System']['user']['userId']
 
 
 def get_access_token(event):
     """Get api access token from request."""
     if 'apiAccessToken' in event['context']['System']:
         token = event['context']['System']['apiAccessToken']
-        print("get_access_token: ", token)
         if token:
             return token
-    print("ERROR: no token in get_access_token:", event)
+    log.error("no token in get_access_token", event=event)
     return ""
 
 
-def get_attributes(event, attr=''):
-    """Return session['attributes'] object."""
-    if 'session' not in event or 'attributes' not in event['session']:
-        userId = get_userId(event)
-        attributes = get_dbdata(DB_TABLE, userId)
-        if attributes is not None:
-            return attributes
-        return {}
-    return event['session']['attributes']
+def get_attributes(event, attr='', fresh=False):
+    """Return session['attributes'] object.
+
+    Falls back to the database when the session has none; either way the
+    same dict is returned for the rest of the event.  `fresh` prefers the
+    database over session attributes (used at launch).
+    """
+    return get_turn(event).load(fresh)
+
+
+# --------------- per-event user record -----------------
+class Turn:
+    """Unit of work for the user record of one event.
+
+    The record is read at most once per event and every helper gets the
+    same dict, so changes made by one handler are seen by the next.
+    """
+
+    def __init__(self, event):
+        self.event = event
+        self.attributes = None
+        self.original = None    # copy of attributes as loaded
+        self.from_db = False
+        self.db_reads = 0
+        self.increments = {}    # COUNTERS key: amount added this turn
+        self.legacy = {}        # COUNTERS key: value found inside DATA
+
+    def load(self, fresh=False):
+        """Return attributes, reading session or database only once."""
+        if self.attributes is not None and (self.from_db or not fresh):
+            return self.attributes
+        session = self.event.get('session', {})
+        if not fresh and session.get('attributes'):
+            # empty when fit_session left them out to save space
+            attributes = session['attributes']
+        else:
+            attributes, self.legacy = read_record(
+                get_dbitem(get_store(), get_userId(self.event)))
+            self.db_reads += 1
+            self.from_db = True
+        self.attributes = attributes
+        self.original = copy.deepcopy(attributes)
+        return attributes
+
+    @property
+    def changed(self):
+        """Return True if attributes differ from what was loaded."""
+        return self.attributes is not None and \
+            self.attributes != self.original
+
+    def add_count(self, key, amount=1):
+        """Add amount to counter key, to be saved with ADD."""
+        attributes = self.load()
+        attributes[key] = attributes.get(key, 0) + amount
+        self.increments[key] = self.increments.get(key, 0) + amount
+
+
+_TURN = None    # Turn for the event being handled
+
+
+def begin_turn(event):
+    """Start a new Turn for `event`."""
+    global _TURN
+    _TURN = Turn(event)
+    return _TURN
+
+
+def get_turn(event):
+    """Return the Turn for `event`, starting one if needed."""
+    if _TURN is None or _TURN.event is not event:
+        return begin_turn(event)
+    return _TURN
+
+
+def add_count(event, key, amount=1):
+    """Add amount to counter key of the user record for `event`."""
+    get_turn(event).add_count(key, amount)
+
+
+def end_turn(event):
+    """Finish the Turn for `event`, saving the record if it changed.
+
+    Returns True if the store holds the record as the turn left it: it
+    was read from the store and not changed, or it was saved.
+    """
+    global _TURN
+    turn = get_turn(event)
+    log.debug("end_turn", reads=turn.db_reads, changed=turn.changed,
+              cache=store_metrics)
+    if turn.changed:
+        saved = not isinstance(
+            update_dbdata(get_store(), get_userId(event), turn.attributes,
+                          turn.original, turn.increments, turn.legacy), str)
+    else:
+        saved = turn.from_db
+    _TURN = None
+    return saved
 
 
 # --------------- data helpers -----------------
-def clear_empty_strings(data):
-    """Replace empty strings in data with ' '."""
-    for key in data:
-        if data[key] == '':
-            data[key] = ' '
-        if isinstance(data[key], float):
-            data[key] = int(data[key])
-        elif isinstance(data, dict):
-            if data[key] == '':
-                data[key] = ' '
-            if isinstance(data[key], float):
-                data[key] = int(data[key])
-            if isinstance(data[key], (dict, list)):
-                data[key] = clear_empty_strings(data[key])
-    return data
-
-
-def restore_empty_strings(data):
-    """Replace ' ' with empty strings in data."""
-    for i, key in enumerate(data):
-        if isinstance(data, list):
-            if key == " ":
-                data[i] = ""
-            if isinstance(key, Decimal):
-                data[i] = int(data[i])
-            if isinstance(key, (dict, list)):
-                data[i] = restore_empty_strings(data[i])
-        elif isinstance(data, dict):
-            if data[key] == ' ':
-                data[key] = ''
-            if isinstance(data[key], Decimal):
-                data[key] = int(data[key])
-            if isinstance(data[key], (dict, list)):
-                data[key] = restore_empty_strings(data[key])
-    return data
-
-
-def get_dbdata(table, id):
+def get_store():
+    """Return the USER_STORE store, creating it on first use."""
+    global STORE
+    if STORE is None:
+        if USER_STORE == 'memory':
+            STORE = user_store.MemoryStore()
+        elif USER_STORE == 'file':
+            STORE = user_store.FileStore(USER_STORE_FILE)
+        else:
+            STORE = user_store.DynamoDBStore(DB_TABLE_NAME, DB_REGION,
+                                             DB_ENDPOINT)
+        if USER_CACHE_SIZE:
+            STORE = user_store.CachedStore(STORE, USER_CACHE_SIZE,
+                                           USER_CACHE_TTL)
+    return STORE
+
+
+def store_metrics():
+    """Return user cache hit/miss metrics, {} if there is no cache."""
+    if isinstance(STORE, user_store.CachedStore):
+        return STORE.metrics()
+    return {}
+
+
+# values are converted with dynamo_codec.encode / decode
+def get_dbdata(store, id):
     """
     Fetch data for user.
 
     Args:
-    table -- dynamodb table
+    store -- user_store store
     id -- userId to fetch
     """
-    # TODO: if Requested resource not found, handle it
+    return read_record(get_dbitem(store, id))[0]
+
+
+def get_dbitem(store, id):
+    """Return the stored item for user, {} if missing or unreadable."""
     try:
-        response = table.get_item(
-            Key={
-                USERID: id
-            }
-        )
-        print("get response:", response)
-    except ClientError as e:
-        error_msg = e.response['Error']['Message']
-        print("WARNING: error in get_dbdata:", error_msg)
-        if error_msg == "Requested resource not found":
-            # no table
-            print("WARNING: creatng new table in get_dbdata")
-            table = make_dynamodb_table(DB_TABLE_NAME)
-        item = {}
-    else:
-        if 'Item' not in response:
-            print("Creating since No Item in get_dbdata:", response)
-            put_dbdata(table, id, {})
-            return {}
-        if DATA in response['Item']:
-            item = response['Item'][DATA]
-            item = restore_empty_strings(item)
-            print("GetItem succeeded: ", item)
-        else:
-            item = {}
+        item = store.get(id)
+    except user_store.StoreError as e:
+        log.warning("error in get_dbdata", error=str(e))
+        return {}
+    if not item:
+        # record is created by the first update_dbdata
+        log.debug("no Item in get_dbdata", userId=id)
+        return {}
+    log.debug("GetItem succeeded", item=item)
     return item
 
 
-def put_dbdata(table, id, data):
+def read_record(item):
+    """
+    Return (attributes, legacy counters) of a table item.
+
+    Each counter is its top-level attribute (0 if never ADDed to) plus any
+    value left inside DATA by records written before COUNTERS moved out
+    of it.  legacy holds those DATA values so the next update_dbdata can
+    fold them into the top-level attributes.  RECORD_VERSION is the item's
+    VERSION, 0 if there is no item.
+    """
+    attributes = dynamo_codec.decode(item.get(DATA, {}))
+    legacy = {}
+    for key, name in COUNTERS.items():
+        if key in attributes:
+            legacy[key] = attributes[key]
+        if item:
+            attributes[key] = attributes.get(key, 0) + int(item.get(name, 0))
+    attributes[RECORD_VERSION] = int(item.get(VERSION, 0))
+    return attributes, legacy
+
+
+def expiry():
+    """Return EXPIRES for a record written now, None if USER_TTL_DAYS 0."""
+    if not USER_TTL_DAYS:
+        return None
+    return int(time.time() + USER_TTL_DAYS * 86400)
+
+
+def stored_data(data):
+    """Return data without the keys kept outside DATA."""
+    return {k: v for k, v in data.items()
+            if k not in COUNTERS and k != RECORD_VERSION}
+
+
+def update_dbdata(store, id, data, original=None, increments=None,
+                  legacy=None):
     """
-    Save data for user.
+    Save the changes in data since original, version checked.
+
+    Conflicts are merged onto the record as it is now and retried (see
+    Saving user records in the README); on success data[RECORD_VERSION]
+    is the new version.
 
     Args:
-    table -- dynamodb table
+    store -- user_store store
     id -- userId to save to
+    data -- attributes to save
+    original -- attributes as last read from or written to the store
+    increments -- {COUNTERS key: amount added since original}
+    legacy -- {COUNTERS key: value stored inside DATA}, from read_record
 
     Returns:
-    response
+    response, None if there was nothing to write, or error message
 
     """
-    data = clear_empty_strings(data)
-    try:
-        response = table.put_item(
-            Item={
-                USERID: id,
-                DATA: data,
-                TIMESTAMP: datetime.utcnow().isoformat()
-            }
-        )
-    except ClientError as e:
-        error_msg = e.response['Error']['Message']
-        print("WARNING: error in put_dbdata:", error_msg)
-        # if error_msg == "Requested resource not found":
-        # no table TODO: make this work
-        return e.response['Error']['Message']
-    else:
-        print("PutItem succeeded: " + id[0:PRINT_LIMIT])
+    increments = {k: v for k, v in (increments or {}).items() if v}
+    legacy = legacy or {}
+    version = data.get(RECORD_VERSION)
+    new = stored_data(data)
+    if original is not None:
+        original = stored_data(original)
+    if new == original and not increments and not legacy:
+        return None
+    original = original or {}
+    changed = {k: v for k, v in new.items()
+               if k not in original or original[k] != v}
+    removed = [k for k in original if k not in new]
+    for attempt in range(OCC_RETRIES + 1):
+        update = merged_update(original, new, changed, removed, increments,
+                               legacy,
+                               version if attempt < OCC_RETRIES else None)
+        try:
+            response = store.update(id, update)
+        except user_store.ConditionFailed:
+            # lost a race: merge onto the record as it is now
+            base, cap = OCC_BACKOFF
+            time.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+            original, legacy = read_record(get_dbitem(store, id))
+            version = original.pop(RECORD_VERSION, 0)
+            original = stored_data(original)
+            log.debug("version conflict in update_dbdata", attempt=attempt,
+                      version=version)
+            continue
+        except user_store.StoreError as e:
+            log.warning("error in update_dbdata", error=str(e))
+            return str(e)
+        if version is not None:
+            data[RECORD_VERSION] = version + 1
+        log.debug("UpdateItem succeeded", userId=id, version=version)
         return response
+    log.warning("update_dbdata gave up after version conflicts", userId=id)
+    return "version conflict"
 
 
-def make_dynamodb_table(name):
-    """Return a new DynamoDB table."""
-    return DYNAMODB.create_table(
-        TableName=name,
-        KeySchema=[
-            {
-                'AttributeName': 'userId',
-                'KeyType': 'HASH'
-            }
-        ],
-        AttributeDefinitions=[
-            {
-                'AttributeName': 'userId',
-                'AttributeType': 'S'
-            },
+def merged_update(original, new, changed, removed, increments, legacy,
+                  version):
+    """Return user_store.Update applying changes to original at version."""
+    timestamp = datetime.utcnow().isoformat()
+    expires = expiry()
+    counts = dict(increments)
+    for key, value in legacy.items():
+        counts[key] = counts.get(key, 0) + value
+    if not original:
+        return user_store.Update(timestamp, sets=dynamo_codec.encode(new),
+                                 adds=counter_adds(counts), replace=True,
+                                 version=version, expires=expires)
+    return user_store.Update(
+        timestamp, sets=dynamo_codec.encode(changed),
+        removes=removed + list(legacy), adds=counter_adds(counts),
+        expect=legacy, version=version, expires=expires)
 
-        ],
-        ProvisionedThroughput={
-            'ReadCapacityUnits': 5,
-            'WriteCapacityUnits': 5
-        }
-    )
+
+def counter_adds(counts):
+    """Return {top-level attribute: amount} for {COUNTERS key: amount}."""
+    return {COUNTERS[key]: amount for key, amount in counts.items()}
 
 
 # --------------- speech response handlers -----------------
@@ -705,6 +1129,50 @@ def make_dynamodb_table(name):
 # https://developer.amazon.com/public/solutions/alexa/alexa-skills-kit/docs/alexa-skills-kit-interface-reference
 # response text cannot exceed 8000 characters
 # response size cannot exceed 24 kilobytes
+# SPEECH_LIMIT (characters in each outputSpeech) is from message_catalog
+RESPONSE_LIMIT = 24 * 1024          # bytes of the encoded response
+SESSION_ECHO_LIMIT = 4 * 1024       # most bytes of sessionAttributes to echo
+RESPONSE_ENCODER = json.JSONEncoder(ensure_ascii=False,
+                                    separators=(',', ':'), default=str)
+
+
+class ResponseTooLarge(Exception):
+    """Response Alexa would reject.
+
+    part -- which part is too big ('outputSpeech', 'reprompt', 'response')
+    size -- its size, in characters for speech and bytes otherwise
+    limit -- the limit it is over
+    """
+
+    def __init__(self, part, size, limit):
+        super().__init__(f"{part} is {size}, limit is {limit}")
+        self.part = part
+        self.size = size
+        self.limit = limit
+
+
+def encoded_size(data, limit=None):
+    """Return bytes of data as compact JSON.
+
+    Counts chunk by chunk as the encoder produces them and stops once
+    past `limit`, so the result is only exact when it is <= limit.
+    """
+    size = 0
+    for chunk in RESPONSE_ENCODER.iterencode(data):
+        size += len(chunk.encode('utf-8'))
+        if limit is not None and size > limit:
+            break
+    return size
+
+
+def check_speech(response):
+    """Raise ResponseTooLarge if any speech in response is too long."""
+    speeches = [('outputSpeech', response.get('outputSpeech')),
+                ('reprompt', response.get('reprompt', {}).get('outputSpeech'))]
+    for part, speech in speeches:
+        if speech and len(speech.get('ssml', '')) > SPEECH_LIMIT:
+            raise ResponseTooLarge(part, len(speech['ssml']), SPEECH_LIMIT)
+
 
 def tell_response(output):
     """Create a simple json tell response."""
@@ -734,6 +1202,28 @@ def ask_response(output, reprompt):
     }
 
 
+def play_directive(url, token, behavior='REPLACE_ALL', previous_token=None,
+                   offset=0):
+    """Return AudioPlayer.Play directive for the stream at url."""
+    stream = {'url': url, 'token': token, 'offsetInMilliseconds': offset}
+    if previous_token:
+        stream['expectedPreviousToken'] = previous_token
+    return {'type': 'AudioPlayer.Play', 'playBehavior': behavior,
+            'audioItem': {'stream': stream}}
+
+
+def audio_response(event, directive=None):
+    """Return response with only directive, for the AudioPlayer.
+
+    AudioPlayer and PlaybackController requests allow no speech; after an
+    intent the session ends so the AudioPlayer can play.
+    """
+    response = {}
+    if event['request']['type'] == 'IntentRequest':
+        response['shouldEndSession'] = True
+    return service_response({}, add_directive(response, directive))
+
+
 def add_directive(response, directive):
     """Append directive to response field in response."""
     if not directive:
@@ -741,7 +1231,7 @@ def add_directive(response, directive):
     if 'directives' not in response:
         response['directives'] = []
     response['directives'].append(directive)
-    print("DEBUG: add_directive", directive)
+    log.debug("add_directive", directive=directive)
     return response
 
 
@@ -751,9 +1241,53 @@ def service_response(attributes, response):
     uses one of the speech_responses (`tell_response`, `ask_response`)
     can also create response from `add_directive`
     returns json for an Alexa service response
+
+    attributes too big to echo are trimmed by fit_session once end_turn
+    has saved them.  Raises ResponseTooLarge if the response can't fit
+    even without them.
     """
+    check_speech(response)
+    size = encoded_size(response, RESPONSE_LIMIT)
+    if size > RESPONSE_LIMIT:
+        raise ResponseTooLarge('response', size, RESPONSE_LIMIT)
     return {
         'version': '1.0',
         'sessionAttributes': attributes,
         'response': response
     }
+
+
+def fit_session(response, saved):
+    """
+    Return response with sessionAttributes trimmed to fit.
+
+    They must fit in SESSION_ECHO_LIMIT and the rest of RESPONSE_LIMIT.
+
+    Args:
+    response -- from service_response
+    saved -- True if the store holds the attributes (end_turn), so they
+        can all be left out and the next request reads them from there;
+        otherwise the largest values are left out until the rest fit
+    """
+    if not response:
+        return response     # e.g. SessionEndedRequest takes no response
+    attributes = response.get('sessionAttributes') or {}
+    size = encoded_size(response['response'], RESPONSE_LIMIT)
+    # envelope: {"version":"1.0","sessionAttributes":,"response":}
+    budget = min(SESSION_ECHO_LIMIT, RESPONSE_LIMIT - size - 48)
+    attributes_size = encoded_size(attributes, budget)
+    if attributes_size <= budget:
+        return response
+    kept = {}
+    if not saved:
+        kept = dict(attributes)
+        for key in sorted(attributes, reverse=True,
+                          key=lambda k: encoded_size(attributes[k])):
+            if encoded_size(kept, budget) <= budget:
+                break
+            del kept[key]
+        log.warning("echoing part of unsaved attributes",
+                    dropped=sorted(set(attributes) - set(kept)))
+    log.debug("not echoing attributes", size=attributes_size, saved=saved)
+    response['sessionAttributes'] = kept
+    return response
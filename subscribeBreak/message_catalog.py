@@ -0,0 +1,143 @@
+"""message_catalog.py: compiled, validated SSML messages per locale.
+
+Messages live in one JSON file per locale (`locales/en-US.json`, ...),
+{key: SSML fragment}.  A locale's file is read and compiled the first
+time that locale is asked for and kept for the life of the container, so
+shipping more locales adds nothing to import time or to the memory of a
+container that never hears them.  Keys a locale doesn't have, and locales
+with no file, fall back to `DEFAULT_LOCALE`.
+
+Compiling fills in `{NAME}` substitutions (e.g. `{URL_PREFIX}`), checks
+that every fragment is well formed SSML and that it fits in one
+outputSpeech (`SPEECH_LIMIT` characters including the `<speak>` wrapper),
+and interns the strings so every response shares the same objects.  A bad
+message raises `CatalogError` naming every problem in the locale at once.
+
+Check all locales before zipping the lambda:
+    python message_catalog.py
+"""
+import json
+import os
+import re
+import sys
+
+import skill_log as log
+
+SPEECH_LIMIT = 8000     # characters in each outputSpeech, <speak> included
+SPEAK_OPEN = '<speak>'
+SPEAK_CLOSE = '</speak>'
+# prefixes Alexa allows in SSML, declared so fragments parse as XML
+SSML_NAMESPACES = {'amazon': 'https://developer.amazon.com/alexa/ssml'}
+
+LOCALE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'locales')
+DEFAULT_LOCALE = 'en-US'
+LOCALE_PATTERN = re.compile(r'[a-z]{2}-[A-Z]{2}')
+
+
+class CatalogError(ValueError):
+    """Messages of a locale that Alexa would reject."""
+
+    def __init__(self, locale, problems):
+        super().__init__(f"{locale}: " + '; '.join(problems))
+        self.locale = locale
+        self.problems = problems
+
+
+def ssml_problem(fragment, limit=SPEECH_LIMIT):
+    """Return what is wrong with SSML fragment, or None if it is fine."""
+    from xml.etree import ElementTree
+    size = len(SPEAK_OPEN) + len(fragment) + len(SPEAK_CLOSE)
+    if size > limit:
+        return f"{size} characters, limit is {limit}"
+    declarations = ''.join(f' xmlns:{prefix}="{uri}"'
+                           for prefix, uri in SSML_NAMESPACES.items())
+    try:
+        ElementTree.fromstring(f'<speak{declarations}>{fragment}</speak>')
+    except ElementTree.ParseError as e:
+        return f"not well formed SSML ({e})"
+    return None
+
+
+def compile_messages(locale, messages, limit=SPEECH_LIMIT,
+                     substitutions=None):
+    """Return messages validated and interned, raise CatalogError if bad."""
+    compiled = {}
+    problems = []
+    for key, fragment in messages.items():
+        for name, value in (substitutions or {}).items():
+            fragment = fragment.replace('{' + name + '}', value)
+        problem = ssml_problem(fragment, limit)
+        if problem:
+            problems.append(f"{key} is {problem}")
+        compiled[sys.intern(key)] = sys.intern(fragment)
+    if problems:
+        raise CatalogError(locale, problems)
+    return compiled
+
+
+class MessageCatalog:
+    """Messages of every locale file in `folder`, compiled on demand.
+
+    substitutions -- {NAME: value} filled in where messages say {NAME}
+    """
+
+    def __init__(self, folder=LOCALE_DIR, default_locale=DEFAULT_LOCALE,
+                 substitutions=None, limit=SPEECH_LIMIT):
+        self.folder = folder
+        self.default_locale = default_locale
+        self.substitutions = substitutions or {}
+        self.limit = limit
+        self._compiled = {}
+
+    def get(self, locale):
+        """Return {key: fragment} for locale, compiling on first use."""
+        compiled = self._compiled.get(locale)
+        if compiled is None:
+            compiled = self._compile(locale)
+            self._compiled[locale] = compiled
+        return compiled
+
+    def _compile(self, locale):
+        """Return compiled messages of locale over the default locale's."""
+        if locale == self.default_locale:
+            messages = self._read(locale)
+            if messages is None:
+                raise CatalogError(locale, ["no messages file"])
+            return compile_messages(locale, messages, self.limit,
+                                    self.substitutions)
+        default = self.get(self.default_locale)
+        messages = None
+        if LOCALE_PATTERN.fullmatch(locale or ''):
+            messages = self._read(locale)
+        if messages is None:
+            log.info("no messages for locale", locale=locale,
+                     using=self.default_locale)
+            return default
+        compiled = dict(default)
+        compiled.update(compile_messages(locale, messages, self.limit,
+                                         self.substitutions))
+        return compiled
+
+    def _read(self, locale):
+        """Return {key: fragment} from locale's file, or None."""
+        fn = os.path.join(self.folder, locale + '.json')
+        try:
+            with open(fn, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def locales(self):
+        """Return locales that have a messages file."""
+        return sorted(fn[:-len('.json')] for fn in os.listdir(self.folder)
+                      if fn.endswith('.json'))
+
+    def compile_all(self):
+        """Compile every locale, return {locale: number of messages}."""
+        return {locale: len(self.get(locale)) for locale in self.locales()}
+
+
+if __name__ == '__main__':
+    from lambda_function import MESSAGES
+    print(MESSAGES.compile_all())
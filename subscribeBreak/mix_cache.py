@@ -0,0 +1,119 @@
+"""mix_cache.py: rendered mixes kept by the hash of their recipe.
+
+A mix's recipe (its source tones, length, format and mixer settings) says
+everything about its bytes, so `recipe_hash` of it names the file and two
+users with the same recipe share one render.  `MixCache` looks for a name
+in two tiers before rendering:
+
+- local: names of mixes this container has rendered or found in the
+  remote tier, least recently used forgotten past `max_names`.  A hit
+  costs no request.
+- remote: where mixes are played from, the tone bucket (a `ToneCatalog`)
+  or `FolderTier` in tests and benchmarks.  A hit costs one HEAD request.
+
+A miss renders to a file in `folder` (/tmp), uploads it to the remote
+tier and removes it: mixes are played from the bucket, so a local copy
+would only fill /tmp.  Entries in the remote tier are assumed to outlive
+local ones.
+"""
+import hashlib
+import json
+import os
+import shutil
+from collections import Counter, OrderedDict
+
+import skill_log as log
+
+MIX_CACHE_FOLDER = '/tmp/mixes'     # mixes are rendered here to upload
+MIX_CACHE_NAMES = 10000     # names remembered, under 1 MB of memory
+
+
+def recipe_hash(recipe):
+    """Return hex key of recipe, a JSON-able dict."""
+    text = json.dumps(recipe, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+
+class FolderTier:
+    """Remote tier in a local folder, standing in for the bucket."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.folder, name))
+
+    def upload(self, fn, name, content_type=None):
+        shutil.copyfile(fn, os.path.join(self.folder, name))
+
+
+class MixCache:
+    """Local LRU of mix names in front of a remote tier.
+
+    remote -- has exists(name) and upload(fn, name, content_type)
+    `stats` counts local and remote hits, renders and evictions.
+    """
+
+    def __init__(self, remote, folder=MIX_CACHE_FOLDER,
+                 max_names=MIX_CACHE_NAMES):
+        self.remote = remote
+        self.folder = folder
+        self.max_names = max_names
+        self.stats = Counter()
+        self.names = OrderedDict()      # name: None, least recent first
+        os.makedirs(folder, exist_ok=True)
+        # left by a render or upload that didn't finish
+        for entry in os.scandir(folder):
+            if entry.is_file():
+                os.remove(entry.path)
+
+    def get(self, name, render, content_type=None):
+        """
+        Make sure mix `name` is in the remote tier, rendering on a miss.
+
+        Args:
+        name -- file name, recipe_hash of the recipe plus extension
+        render -- function(fn) writing the mix to file fn
+        content_type -- of the upload
+
+        Returns:
+        'local', 'remote' or 'rendered', where it was found
+
+        """
+        if name in self.names:
+            self.names.move_to_end(name)
+            self.stats['local'] += 1
+            return 'local'
+        if self.remote.exists(name):
+            self.stats['remote'] += 1
+            self._remember(name)
+            return 'remote'
+        fn = os.path.join(self.folder, name)
+        try:
+            render(fn)
+            self.remote.upload(fn, name, content_type)
+        finally:
+            # the bucket has the mix, or it failed and nothing is kept
+            if os.path.exists(fn):
+                os.remove(fn)
+        self.stats['rendered'] += 1
+        self._remember(name)
+        return 'rendered'
+
+    def _remember(self, name):
+        """Remember name, forgetting the least recently used past max."""
+        self.names[name] = None
+        self.names.move_to_end(name)
+        while len(self.names) > self.max_names:
+            forgotten, _ = self.names.popitem(last=False)
+            self.stats['evicted'] += 1
+            log.debug("forgot mix", name=forgotten)
+
+    def metrics(self):
+        """Return stats plus names remembered and hit rate."""
+        lookups = self.stats['local'] + self.stats['remote'] + \
+            self.stats['rendered']
+        return dict(self.stats, names=len(self.names),
+                    hit_rate=round((lookups - self.stats['rendered']) /
+                                   lookups, 3) if lookups else None)
@@ -0,0 +1,172 @@
+"""parallel_encoder.py: MP3 encoding of a mix split across several ffmpegs.
+
+tone_mixer's mp3_chunks feeds one ffmpeg, so a long mix encodes on one
+core while a lambda with more memory has up to six.  `ParallelEncoder`
+renders the mix in chunks of `CHUNK_SECONDS`, cut on MP3 frame
+boundaries, and encodes each chunk in its own ffmpeg, `workers` at a
+time, yielding the results in order as they finish.
+
+Encoded separately, chunks would not join: each run of the encoder starts
+from silence and pads its end.  So each chunk is encoded with
+`OVERLAP_FRAMES` frames of the audio either side of it, with the bit
+reservoir off so that every frame stands alone, and only the frames of
+the chunk itself are kept.  As every run starts on a frame boundary, its
+frame n holds the same stretch of audio as frame n of encoding the whole
+mix, and the kept frames follow one another as if encoded in one run.
+tone_mixer.mp3_chunks uses the same settings, so both encoders make the
+same bytes of a mix and its recipe hash names one file.
+
+Workers are threads by default: each waits on its ffmpeg, which does the
+encoding, and lambda has no /dev/shm for a ProcessPoolExecutor's locks.
+`encode_pcm` is a plain function of bytes, so a ProcessPoolExecutor can
+be passed in where there is one.
+"""
+import os
+import subprocess
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import tone_mixer
+from tone_mixer import MixError
+
+ENCODE_WORKERS = os.cpu_count() or 1
+CHUNK_SECONDS = 30      # of audio encoded by one ffmpeg
+OVERLAP_FRAMES = 4      # MP3 frames encoded either side of a chunk, dropped
+
+# MPEG version bits: (sample rates, layer III bitrates in kbit/s,
+#   bytes per frame per bit/s / rate)
+MPEG_VERSIONS = {
+    3: ((44100, 48000, 32000), (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160,
+                                192, 224, 256, 320), 144),
+    2: ((22050, 24000, 16000), (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112,
+                                128, 144, 160), 72),
+    0: ((11025, 12000, 8000), (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112,
+                               128, 144, 160), 72),
+}
+
+
+def frame_samples(rate):
+    """Return samples per MP3 (layer III) frame at rate."""
+    return 1152 if rate >= 32000 else 576
+
+
+def mp3_frames(data):
+    """Return [(start, end)] byte ranges of the MP3 frames in data."""
+    frames = []
+    position = 0
+    while position + 4 <= len(data):
+        header = int.from_bytes(data[position:position + 4], 'big')
+        version = header >> 19 & 3
+        bitrate = header >> 12 & 15
+        rate = header >> 10 & 3
+        if header >> 21 != 0x7ff or version not in MPEG_VERSIONS or \
+                header >> 17 & 3 != 1 or bitrate in (0, 15) or rate == 3:
+            raise MixError(f"no MP3 frame at byte {position}")
+        rates, bitrates, factor = MPEG_VERSIONS[version]
+        size = factor * bitrates[bitrate] * 1000 // rates[rate] + \
+            (header >> 9 & 1)
+        frames.append((position, position + size))
+        position += size
+    if position != len(data):
+        raise MixError(f"partial MP3 frame at byte {position}")
+    return frames
+
+
+def encode_pcm(pcm, rate, channels, bitrate=tone_mixer.MP3_BITRATE):
+    """Return 16 bit PCM bytes encoded as MP3 by tone_mixer.mp3_command."""
+    try:
+        result = subprocess.run(tone_mixer.mp3_command(rate, channels,
+                                                       bitrate),
+                                input=pcm, capture_output=True)
+    except FileNotFoundError:
+        raise MixError(f"no {tone_mixer.FFMPEG} to encode MP3")
+    if result.returncode:
+        raise MixError(f"{tone_mixer.FFMPEG} exited {result.returncode}: "
+                       f"{result.stderr.decode(errors='replace')}")
+    return result.stdout
+
+
+class ParallelEncoder:
+    """Encoder of mixes to MP3 with chunks encoded side by side.
+
+    Call it like tone_mixer.mp3_chunks: encoder(mix, block_seconds).
+    executor -- runs encode_pcm, default a ThreadPoolExecutor of workers
+    `stats` adds up seconds of audio, wall seconds, chunks and bytes of
+    every mix encoded.
+    """
+
+    def __init__(self, workers=ENCODE_WORKERS, chunk_seconds=CHUNK_SECONDS,
+                 bitrate=tone_mixer.MP3_BITRATE, executor=None):
+        self.workers = max(1, workers)
+        self.chunk_seconds = chunk_seconds
+        self.bitrate = bitrate
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix='encode')
+        self.stats = Counter()
+
+    def chunks(self, mix):
+        """Return [(start, end)] mix frames of each chunk."""
+        step = frame_samples(mix.rate)
+        size = max(1, round(self.chunk_seconds * mix.rate / step)) * step
+        return [(start, min(start + size, mix.frames))
+                for start in range(0, mix.frames, size)]
+
+    def __call__(self, mix, block_seconds=tone_mixer.BLOCK_SECONDS):
+        """Yield mix encoded as MP3, a chunk at a time.
+
+        At most workers + 1 chunks are rendered ahead of the one yielded,
+        so memory grows with workers, not with the mix length.
+        """
+        started = time.perf_counter()
+        chunks = self.chunks(mix)
+        overlap = OVERLAP_FRAMES * frame_samples(mix.rate)
+        pending = deque()
+        size = 0
+        try:
+            for number, (start, end) in enumerate(chunks):
+                while len(pending) > self.workers:
+                    data = self._kept(*pending.popleft())
+                    size += len(data)
+                    yield data
+                pending.append(self._submit(mix, start, end, overlap,
+                                            number == len(chunks) - 1))
+            while pending:
+                data = self._kept(*pending.popleft())
+                size += len(data)
+                yield data
+        finally:
+            for future, _, _ in pending:
+                future.cancel()
+        self.stats.update(mixes=1, chunks=len(chunks), bytes=size,
+                          seconds=mix.seconds,
+                          wall=time.perf_counter() - started)
+
+    def _submit(self, mix, start, end, overlap, last):
+        """Return (future, frames to drop, frames to keep or None for all)
+        of encoding frames start to end of mix with overlap either side."""
+        step = frame_samples(mix.rate)
+        lead = min(start, overlap)
+        pcm = tone_mixer.pcm16(mix.render(start - lead,
+                                          min(end + overlap, mix.frames)))
+        future = self.executor.submit(encode_pcm, pcm, mix.rate,
+                                      mix.channels, self.bitrate)
+        return future, lead // step, None if last else (end - start) // step
+
+    @staticmethod
+    def _kept(future, drop, keep):
+        """Return the encoded frames of a chunk without its overlap."""
+        data = future.result()
+        frames = mp3_frames(data)[drop:]
+        if keep is not None:
+            if len(frames) < keep:
+                raise MixError(f"chunk has {len(frames)} frames, not {keep}")
+            frames = frames[:keep]
+        return data[frames[0][0]:frames[-1][1]] if frames else b''
+
+    def metrics(self):
+        """Return stats plus seconds of audio encoded per wall second."""
+        wall = self.stats['wall']
+        return dict(self.stats, wall=round(wall, 3),
+                    realtime=round(self.stats['seconds'] / wall, 1)
+                    if wall else None)
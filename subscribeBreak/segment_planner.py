@@ -0,0 +1,107 @@
+"""segment_planner.py: long sessions as a queue of mixes made just in time.
+
+One SSML response can play at most 240 s of audio, so a TimeIntent
+session (`PT1H` from the AMAZON.DURATION slot) is played through the
+AudioPlayer instead, as a `SegmentPlan` of fixed-length segments.  Only
+the first segment is rendered before playback starts (and it can be made
+shorter than the rest to start sooner); each later one is rendered when
+Alexa sends PlaybackNearlyFinished for the one before and is enqueued
+behind it.
+
+Everything needed to make the next segment is in the AudioPlayer token
+(`SegmentPlan.token` / `from_token`), so the requests in between need no
+session and no database read.
+"""
+import math
+import re
+
+SEGMENT_SECONDS = 300   # length of each segment but the first and last
+MIN_TAIL = 30           # a shorter last segment is added to the one before
+MAX_SECONDS = 8 * 3600  # longest session planned
+TOKEN_PREFIX = 'segments:1:'    # version 1 of the token layout
+
+_NUMBER = r'(\d+(?:[.,]\d+)?)'
+DURATION_PATTERN = re.compile(
+    rf'P(?:{_NUMBER}Y)?(?:{_NUMBER}M)?(?:{_NUMBER}W)?(?:{_NUMBER}D)?'
+    rf'(?:T(?:{_NUMBER}H)?(?:{_NUMBER}M)?(?:{_NUMBER}S)?)?')
+UNIT_SECONDS = (None, None, 7 * 86400, 86400, 3600, 60, 1)
+
+
+def parse_duration(text):
+    """
+    Return seconds in ISO 8601 duration text, e.g. 'PT1H30M' -> 5400.
+
+    Raises ValueError for text that isn't a duration, for years and
+    months (which have no fixed length) and for under a second, which
+    would plan an empty segment.
+    """
+    match = DURATION_PATTERN.fullmatch(text or '')
+    if not match or not any(match.groups()) or (text or '').endswith('T'):
+        raise ValueError(f"not an ISO 8601 duration: {text!r}")
+    if match.group(1) or match.group(2):
+        raise ValueError(f"years and months are not supported: {text!r}")
+    seconds = sum(float(value.replace(',', '.')) * unit
+                  for value, unit in zip(match.groups(), UNIT_SECONDS)
+                  if value)
+    if seconds < 1:
+        raise ValueError(f"duration under a second: {text!r}")
+    return seconds
+
+
+class SegmentPlan:
+    """Lengths of the segments that make up a session of total seconds.
+
+    base -- number of the first segment's mix (the user's MIX_INDEX), each
+        later segment using the next number
+    first_seconds -- length of the first segment, default segment_seconds
+    """
+
+    def __init__(self, total, segment_seconds=SEGMENT_SECONDS, base=0,
+                 first_seconds=None):
+        self.total = min(int(round(total)), MAX_SECONDS)
+        self.segment_seconds = int(segment_seconds)
+        self.first_seconds = int(first_seconds or segment_seconds)
+        self.base = int(base)
+        first = min(self.first_seconds, self.total)
+        rest = self.total - first
+        count = math.ceil(rest / self.segment_seconds) if rest else 0
+        self.lengths = [first] + [self.segment_seconds] * count
+        if count:
+            self.lengths[-1] = rest - (count - 1) * self.segment_seconds
+        if len(self.lengths) > 1 and self.lengths[-1] < MIN_TAIL:
+            tail = self.lengths.pop()
+            self.lengths[-1] += tail
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        return self.lengths[index]
+
+    def offset(self, index):
+        """Return seconds into the session at which segment index starts."""
+        return sum(self.lengths[:index])
+
+    def mix_index(self, index):
+        """Return the MIX_INDEX of segment index's mix."""
+        return self.base + index
+
+    def token(self, index):
+        """Return AudioPlayer token of segment index."""
+        return (f'{TOKEN_PREFIX}{self.base}:{index}:{self.total}:'
+                f'{self.segment_seconds}:{self.first_seconds}')
+
+    @classmethod
+    def from_token(cls, token):
+        """Return (plan, index) from a token, or (None, None)."""
+        if not token or not token.startswith(TOKEN_PREFIX):
+            return None, None
+        try:
+            base, index, total, segment, first = (
+                int(part) for part in token[len(TOKEN_PREFIX):].split(':'))
+        except ValueError:
+            return None, None
+        return cls(total, segment, base, first), index
+
+    def __repr__(self):
+        return f"SegmentPlan({self.total}, lengths={self.lengths})"
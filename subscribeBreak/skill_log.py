@@ -0,0 +1,91 @@
+"""skill_log.py: level-gated JSON line logging for the lambda.
+
+    import skill_log as log
+    log.debug("in lambda_handler", event=event)
+
+Each enabled call prints one compact JSON object to stdout (CloudWatch).
+Nothing is formatted for a disabled level, and a field whose value is
+callable is only called when the line is actually written, so expensive
+values cost nothing in production.  Tokens are redacted and ids shortened
+wherever they appear in field values.
+
+Settings (lambda environment variables):
+LOG_LEVEL -- DEBUG, INFO, WARNING or ERROR (default INFO)
+LOG_DEBUG_SAMPLE -- fraction of invocations that log DEBUG lines when
+    LOG_LEVEL is DEBUG (default 1.0)
+"""
+import json
+import os
+import random
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING',
+               ERROR: 'ERROR'}
+
+LOG_LEVEL = {v: k for k, v in LEVEL_NAMES.items()}.get(
+    os.environ.get('LOG_LEVEL', 'INFO').upper(), INFO)
+DEBUG_SAMPLE = float(os.environ.get('LOG_DEBUG_SAMPLE', '1.0'))
+
+REDACTED_KEYS = frozenset(('apiAccessToken', 'consentToken', 'accessToken',
+                           'Authorization'))
+SHORTENED_KEYS = frozenset(('userId', 'deviceId', 'personId'))
+ID_CHARS = 12       # trailing characters kept of shortened ids
+
+_ENCODER = json.JSONEncoder(separators=(',', ':'), default=str)
+_debug_enabled = LOG_LEVEL <= DEBUG
+
+
+def start_invocation():
+    """Decide whether this invocation is sampled for DEBUG lines."""
+    global _debug_enabled
+    _debug_enabled = (LOG_LEVEL <= DEBUG and
+                      (DEBUG_SAMPLE >= 1.0 or random.random() < DEBUG_SAMPLE))
+
+
+def debug(msg, **fields):
+    """Log msg at DEBUG."""
+    if _debug_enabled:
+        _write(DEBUG, msg, fields)
+
+
+def info(msg, **fields):
+    """Log msg at INFO."""
+    if LOG_LEVEL <= INFO:
+        _write(INFO, msg, fields)
+
+
+def warning(msg, **fields):
+    """Log msg at WARNING."""
+    if LOG_LEVEL <= WARNING:
+        _write(WARNING, msg, fields)
+
+
+def error(msg, **fields):
+    """Log msg at ERROR."""
+    _write(ERROR, msg, fields)
+
+
+def _write(level, msg, fields):
+    """Print one JSON line."""
+    line = {'level': LEVEL_NAMES[level], 'msg': msg}
+    for key, value in fields.items():
+        if callable(value):
+            value = value()
+        line[key] = redact(value, key)
+    print(_ENCODER.encode(line))
+
+
+def redact(value, key=None):
+    """Return value with tokens removed and ids shortened."""
+    if key in REDACTED_KEYS:
+        return '[redacted]'
+    if key in SHORTENED_KEYS and isinstance(value, str):
+        return '...' + value[-ID_CHARS:]
+    if isinstance(value, dict):
+        return {k: redact(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return value
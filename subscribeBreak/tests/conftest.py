@@ -0,0 +1,13 @@
+"""conftest.py: import the lambda's modules, and bench's fakes, as the
+bench scripts do.
+
+Run from subscribeBreak:
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
@@ -0,0 +1,59 @@
+"""test_audio_player.py: AudioPlayer requests of a segmented session."""
+import pytest
+
+import events
+import lambda_function
+import user_store
+
+TOKEN = events.AUDIO_TOKEN
+
+
+class NoStore(user_store.UserStore):
+    """Store that fails the test on any read or write."""
+
+    def get(self, id):
+        pytest.fail("user record read")
+
+    def update(self, id, update):
+        pytest.fail("user record written")
+
+
+@pytest.fixture(autouse=True)
+def no_store(monkeypatch):
+    monkeypatch.setattr(lambda_function, 'STORE', NoStore())
+    monkeypatch.setattr(lambda_function, 'mix_url',
+                        lambda index, seconds, seed: (f'mix{index}', 'hash'))
+
+
+def audio_event(request, activity='PLAYING', session=None):
+    event = events.base_event(request, new=True)
+    if session is None:
+        del event['session']
+    event['context']['AudioPlayer'] = {'token': TOKEN,
+                                       'offsetInMilliseconds': 55000,
+                                       'playerActivity': activity}
+    return event
+
+
+def directives(response):
+    return response['response'].get('directives', [])
+
+
+def test_next_segment_needs_no_record():
+    event = audio_event({'type': 'AudioPlayer.PlaybackNearlyFinished',
+                         'token': TOKEN})
+    (play,) = directives(lambda_function.lambda_handler(event, None))
+    assert play['playBehavior'] == 'ENQUEUE'
+    item = play['audioItem']['stream']
+    assert item['url'] == 'mix1' and item['expectedPreviousToken'] == TOKEN
+
+
+@pytest.mark.parametrize('intent', ['AMAZON.StopIntent',
+                                    'AMAZON.CancelIntent',
+                                    'AMAZON.PauseIntent'])
+def test_stop_while_playing(intent):
+    event = audio_event({'type': 'IntentRequest',
+                         'intent': {'name': intent}}, session=True)
+    response = lambda_function.lambda_handler(event, None)
+    assert directives(response) == [{'type': 'AudioPlayer.Stop'}]
+    assert response['response']['shouldEndSession'] is True
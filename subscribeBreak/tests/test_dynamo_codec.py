@@ -0,0 +1,85 @@
+"""test_dynamo_codec.py: conversions, deep trees, and inputs left alone."""
+import copy
+import sys
+from decimal import Decimal
+
+import pytest
+
+from dynamo_codec import EMPTY_STRING, decode, encode
+
+TREE = {'state': 'start', 'empty': '', 'count': 3, 'ratio': 0.1,
+        'flag': True, 'none': None,
+        'tones': [1.5, '', 'source/a.mp3', [2.25, {'gain': -0.5}]],
+        'same': {'name': 'x', 'list': [1, 2]}}
+STORED = {'state': 'start', 'empty': EMPTY_STRING, 'count': 3,
+          'ratio': Decimal('0.1'), 'flag': True, 'none': None,
+          'tones': [Decimal('1.5'), EMPTY_STRING, 'source/a.mp3',
+                    [Decimal('2.25'), {'gain': Decimal('-0.5')}]],
+          'same': {'name': 'x', 'list': [1, 2]}}
+
+
+def test_encode():
+    assert encode(TREE) == STORED
+    assert type(encode(TREE)['flag']) is bool
+
+
+def test_decode():
+    # get_item returns every number as a Decimal
+    stored = dict(STORED, count=Decimal(3))
+    decoded = decode(stored)
+    assert decoded == TREE
+    assert type(decoded['count']) is int
+    assert type(decoded['tones'][0]) is float
+
+
+@pytest.mark.parametrize('value', [0.1, 1 / 3, -2.5e-7, 1.5e-300, 12345.678])
+def test_float_round_trip(value):
+    assert decode(encode([value])) == [value]
+
+
+def test_whole_float_comes_back_int():
+    (value,) = decode(encode([2.0]))
+    assert value == 2 and type(value) is int
+
+
+def test_scalars():
+    assert encode('') == EMPTY_STRING and decode(EMPTY_STRING) == ''
+    assert encode(0.5) == Decimal('0.5') and decode(Decimal('2')) == 2
+    assert encode('a') == 'a' and decode(None) is None
+
+
+def test_input_not_modified():
+    tree = copy.deepcopy(TREE)
+    stored = copy.deepcopy(STORED)
+    encoded, decoded = encode(tree), decode(stored)
+    assert tree == TREE and stored == STORED
+    # copies only where something changed, the rest shared
+    assert encoded is not tree and encoded['tones'] is not tree['tones']
+    assert encoded['same'] is tree['same']
+    assert decoded['same'] is stored['same']
+
+
+def test_nothing_to_change():
+    tree = {'a': ['x', {'b': 1}], 'c': True}
+    assert encode(tree) is tree
+    assert decode(tree) is tree
+
+
+def test_deeper_than_recursion_limit():
+    depth = sys.getrecursionlimit() * 2
+    tree = leaf = {}
+    for i in range(depth):
+        leaf['next'] = [{}, i + 0.5]
+        leaf = leaf['next'][0]
+    leaf['end'] = ''
+    stored = encode(tree)
+    node = stored
+    for i in range(depth):
+        assert node['next'][1] == Decimal(repr(i + 0.5))
+        node = node['next'][0]
+    assert node == {'end': EMPTY_STRING}
+    assert tree['next'][1] == 0.5       # the input still holds floats
+    node = decode(stored)
+    for i in range(depth):
+        node = node['next'][0]
+    assert node == {'end': ''}
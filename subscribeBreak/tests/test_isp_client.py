@@ -0,0 +1,106 @@
+"""test_isp_client.py: get_products answers and the circuit breaker."""
+import pytest
+import requests
+
+import fakes
+import isp_client
+from isp_client import CircuitBreaker
+
+USER = 'amzn1.ask.account.TEST'
+
+
+class Clock:
+    """time.monotonic that moves only when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(isp_client.time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def fresh(monkeypatch):
+    monkeypatch.setattr(isp_client, 'BREAKER', CircuitBreaker(3, 30.0))
+    monkeypatch.setattr(isp_client, '_ENTITLEMENTS', {})
+
+
+def products(session, monkeypatch):
+    monkeypatch.setattr(isp_client, 'SESSION', session)
+    return isp_client.get_products('https://api', 'token', 'en-US', USER)
+
+
+def test_answers(monkeypatch):
+    session = fakes.FakeISPSession(status_code=200)
+    answer = products(session, monkeypatch)
+    assert answer['inSkillProducts'][0]['productId'] == session.product_id
+    # cached for the user from then on
+    assert products(session, monkeypatch) == answer
+    assert session.calls['get'] == 1
+
+
+@pytest.mark.parametrize('session, expected', [
+    (fakes.FakeISPSession(status_code=403), {}),
+    (fakes.FakeISPSession(status_code=404), {}),
+    (fakes.FakeISPSession(status_code=503), None),
+    (fakes.FakeISPSession(error=requests.exceptions.Timeout()), None),
+    (fakes.FakeISPSession(error=requests.exceptions.ConnectionError()),
+     None),
+], ids=['403', '404', '503', 'timeout', 'connection'])
+def test_failures(monkeypatch, session, expected):
+    """4xx: the user has no products; 5xx and timeouts: unknown."""
+    assert products(session, monkeypatch) == expected
+    failed = expected is None
+    assert isp_client.BREAKER.failures == failed
+    assert products(session, monkeypatch) == expected
+    assert session.calls['get'] == 2    # neither answer is cached
+
+
+def test_circuit_opens_and_closes(monkeypatch, clock):
+    down = fakes.FakeISPSession(status_code=503)
+    for _ in range(3):
+        assert products(down, monkeypatch) is None
+    assert isp_client.BREAKER.opened == clock.now
+    # open: no calls until the cooldown is over
+    clock.now += 29
+    assert products(down, monkeypatch) is None
+    assert down.calls['get'] == 3
+    # half open: one trial call, which fails, so another cooldown
+    clock.now += 1
+    assert products(down, monkeypatch) is None
+    assert down.calls['get'] == 4
+    clock.now += 29
+    assert products(down, monkeypatch) is None
+    assert down.calls['get'] == 4
+    # the next trial call works and closes the circuit
+    clock.now += 1
+    up = fakes.FakeISPSession(status_code=200)
+    assert products(up, monkeypatch)['inSkillProducts']
+    assert isp_client.BREAKER.opened is None
+    assert isp_client.BREAKER.failures == 0
+
+
+def test_one_trial_call(clock):
+    breaker = CircuitBreaker(2, 30.0)
+    breaker.failure()
+    assert breaker.allow() and breaker.opened is None
+    breaker.failure()
+    clock.now += 30
+    assert breaker.allow()
+    assert not breaker.allow()      # the others wait out another cooldown
+
+
+def test_client_error_resets_failures(monkeypatch):
+    products(fakes.FakeISPSession(status_code=503), monkeypatch)
+    products(fakes.FakeISPSession(status_code=503), monkeypatch)
+    products(fakes.FakeISPSession(status_code=403), monkeypatch)
+    products(fakes.FakeISPSession(status_code=503), monkeypatch)
+    assert isp_client.BREAKER.failures == 1
+    assert isp_client.BREAKER.opened is None
@@ -0,0 +1,104 @@
+"""test_mix_cache.py: lookups in the two tiers and forgetting names."""
+import os
+
+import pytest
+
+import events
+import lambda_function
+from mix_cache import FolderTier, MixCache, recipe_hash
+
+
+class Renders:
+    """render function for MixCache.get writing size bytes, counting."""
+
+    def __init__(self, size=100):
+        self.size = size
+        self.count = 0
+
+    def __call__(self, fn):
+        self.count += 1
+        with open(fn, 'wb') as f:
+            f.write(b'\0' * self.size)
+
+
+@pytest.fixture
+def remote(tmp_path):
+    return FolderTier(str(tmp_path / 'bucket'))
+
+
+def make_cache(remote, tmp_path, max_names=2):
+    return MixCache(remote, str(tmp_path / 'mixes'), max_names)
+
+
+def test_tiers(remote, tmp_path):
+    cache = make_cache(remote, tmp_path)
+    render = Renders()
+    assert cache.get('a.mp3', render) == 'rendered'
+    assert remote.exists('a.mp3')
+    assert cache.get('a.mp3', render) == 'local'
+    # another container's cache finds the upload, then remembers it
+    other = MixCache(remote, str(tmp_path / 'other'))
+    assert other.get('a.mp3', render) == 'remote'
+    assert other.get('a.mp3', render) == 'local'
+    assert render.count == 1
+    assert cache.metrics()['hit_rate'] == 0.5
+
+
+def test_rendered_file_removed_after_upload(remote, tmp_path):
+    cache = make_cache(remote, tmp_path)
+    for name in ('a.mp3', 'b.mp3', 'c.mp3'):
+        cache.get(name, Renders(1000))
+    assert os.listdir(cache.folder) == []
+    assert sorted(os.listdir(remote.folder)) == ['a.mp3', 'b.mp3', 'c.mp3']
+
+
+def test_least_recently_used_forgotten(remote, tmp_path):
+    cache = make_cache(remote, tmp_path)
+    render = Renders()
+    cache.get('a.mp3', render)
+    cache.get('b.mp3', render)
+    cache.get('a.mp3', render)      # b is now least recently used
+    cache.get('c.mp3', render)
+    assert list(cache.names) == ['a.mp3', 'c.mp3']
+    assert cache.stats['evicted'] == 1
+    # forgotten locally, still in the remote tier
+    assert cache.get('b.mp3', render) == 'remote'
+    assert render.count == 3
+    assert cache.metrics()['names'] == 2
+
+
+def test_leftovers_removed_on_start(remote, tmp_path):
+    folder = tmp_path / 'mixes'
+    folder.mkdir()
+    (folder / 'torn.mp3').write_bytes(b'\0' * 100)
+    cache = make_cache(remote, tmp_path)
+    assert os.listdir(folder) == [] and not cache.names
+
+
+def test_failed_render_or_upload_keeps_nothing(remote, tmp_path):
+    cache = make_cache(remote, tmp_path)
+
+    def broken(fn):
+        Renders()(fn)
+        raise OSError("encoder died")
+
+    with pytest.raises(OSError):
+        cache.get('a.mp3', broken)
+    remote.upload = lambda fn, name, content_type=None: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        cache.get('b.mp3', Renders())
+    assert os.listdir(cache.folder) == [] and not cache.names
+    assert cache.stats['rendered'] == 0
+
+
+def test_recipe_hash():
+    recipe = {'tones': ['source/a.mp3', 'source/b.mp3'], 'seconds': 60}
+    assert recipe_hash(recipe) == recipe_hash(dict(reversed(recipe.items())))
+    assert recipe_hash(recipe) != recipe_hash(dict(recipe, seconds=61))
+
+
+def test_users_share_seeds(monkeypatch):
+    monkeypatch.setattr(lambda_function, 'MIX_SEEDS', 4)
+    seeds = {lambda_function.mix_seed(events.base_event(
+        {'type': 'LaunchRequest'}, user_id=f'user{i}')) for i in range(100)}
+    assert seeds == {0, 1, 2, 3}
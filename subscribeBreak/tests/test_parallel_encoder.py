@@ -0,0 +1,84 @@
+"""test_parallel_encoder.py: chunked MP3 encoding joins like one run."""
+import hashlib
+import math
+import shutil
+
+import numpy as np
+import pytest
+
+import parallel_encoder
+import tone_mixer
+
+RATE = 24000
+DELAY = 576         # LAME's encoder delay, in samples
+LOOKAHEAD = 288     # samples either side of a frame its MDCT reads
+# MPEG-2 layer III, 48 kbit/s, 24000 Hz, no CRC, no padding: 144 bytes
+HEADER = bytes([0xff, 0xf3, 0x64, 0x00])
+
+
+def fake_encode_pcm(pcm, rate, channels, bitrate=None):
+    """Encode like LAME without the bit reservoir: frame n depends only on
+    the input around samples n * 576 - DELAY, zeros outside it."""
+    samples = np.frombuffer(pcm, '<i2').reshape(-1, channels)
+    step = parallel_encoder.frame_samples(rate)
+    count = math.ceil((len(samples) + DELAY) / step) + 1
+    frames = []
+    for n in range(count):
+        start = n * step - DELAY - LOOKAHEAD
+        end = (n + 1) * step - DELAY + LOOKAHEAD
+        window = np.zeros((end - start, channels), '<i2')
+        a, b = max(start, 0), min(end, len(samples))
+        if a < b:
+            window[a - start:b - start] = samples[a:b]
+        digest = hashlib.sha256(window.tobytes()).digest()
+        frames.append(HEADER + (digest * 5)[:140])
+    return b''.join(frames)
+
+
+def make_mix(seconds):
+    """Return a Mix of two sine tones, seconds long."""
+    times = np.arange(RATE * 3) / RATE
+    tones = [np.stack([np.sin(2 * np.pi * pitch * times)] * 2, axis=1)
+             .astype(np.float32) for pitch in (220, 330, 440)]
+    return tone_mixer.Mix([tones[:2], tones[2:]], seconds)
+
+
+def whole_pcm(mix):
+    return b''.join(tone_mixer.pcm16(block) for block in mix.blocks())
+
+
+@pytest.mark.parametrize('seconds', [0.5, 2, 7.3])
+@pytest.mark.parametrize('workers', [1, 3])
+def test_chunks_join_like_one_run(monkeypatch, seconds, workers):
+    monkeypatch.setattr(parallel_encoder, 'encode_pcm', fake_encode_pcm)
+    mix = make_mix(seconds)
+    encoder = parallel_encoder.ParallelEncoder(workers, chunk_seconds=1)
+    joined = b''.join(encoder(mix))
+    assert joined == fake_encode_pcm(whole_pcm(mix), mix.rate, mix.channels)
+    assert encoder.metrics()['mixes'] == 1
+
+
+def test_chunks_are_frame_aligned():
+    mix = make_mix(7.3)
+    chunks = parallel_encoder.ParallelEncoder(1, chunk_seconds=1).chunks(mix)
+    assert chunks[0][0] == 0 and chunks[-1][1] == mix.frames
+    assert all(a[1] == b[0] for a, b in zip(chunks, chunks[1:]))
+    assert all(start % 576 == 0 for start, _ in chunks)
+
+
+def test_mp3_frames():
+    data = HEADER + bytes(140)
+    assert parallel_encoder.mp3_frames(data * 3) == [(0, 144), (144, 288),
+                                                     (288, 432)]
+    with pytest.raises(tone_mixer.MixError):
+        parallel_encoder.mp3_frames(data[:100])
+    with pytest.raises(tone_mixer.MixError):
+        parallel_encoder.mp3_frames(b'ID3' + data)
+
+
+@pytest.mark.skipif(not shutil.which(tone_mixer.FFMPEG),
+                    reason="needs ffmpeg")
+def test_same_bytes_as_mp3_chunks():
+    mix = make_mix(75)
+    encoder = parallel_encoder.ParallelEncoder(3, chunk_seconds=20)
+    assert b''.join(encoder(mix)) == b''.join(tone_mixer.mp3_chunks(mix))
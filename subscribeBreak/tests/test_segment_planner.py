@@ -0,0 +1,50 @@
+"""test_segment_planner.py: durations and the plans carried in tokens."""
+import pytest
+
+import segment_planner
+from segment_planner import SegmentPlan, parse_duration
+
+
+@pytest.mark.parametrize('text, seconds', [
+    ('PT1H30M', 5400), ('PT45S', 45), ('PT1,5M', 90), ('PT0.5H', 1800),
+    ('P1DT1S', 86401), ('P1W', 7 * 86400), ('PT1S', 1)])
+def test_parse_duration(text, seconds):
+    assert parse_duration(text) == seconds
+
+
+@pytest.mark.parametrize('text', [
+    None, '', 'P', 'PT', 'P1DT', '1H', 'PT1X', 'P1Y', 'P2M', 'PT0S',
+    'PT0.4S'])
+def test_parse_duration_rejects(text):
+    with pytest.raises(ValueError):
+        parse_duration(text)
+
+
+def test_plan_lengths():
+    plan = SegmentPlan(3600, 300, first_seconds=60)
+    assert plan[0] == 60 and sum(plan.lengths) == 3600
+    assert all(length == 300 for length in plan.lengths[1:-1])
+    assert plan.offset(len(plan) - 1) + plan[-1] == 3600
+    # a last segment under MIN_TAIL joins the one before
+    assert SegmentPlan(310, 300).lengths == [310]
+    assert SegmentPlan(370, 300, first_seconds=60).lengths == [60, 310]
+    assert SegmentPlan(10 * 3600, 300).total == segment_planner.MAX_SECONDS
+
+
+@pytest.mark.parametrize('total, segment, base, first', [
+    (1, 300, 0, 60), (600, 300, 7, None), (3599, 300, 12, 60),
+    (5400, 120, 3, 45)])
+def test_token_round_trip(total, segment, base, first):
+    plan = SegmentPlan(total, segment, base, first)
+    for index in range(len(plan)):
+        again, found = SegmentPlan.from_token(plan.token(index))
+        assert found == index
+        assert again.lengths == plan.lengths
+        assert again.mix_index(index) == plan.mix_index(index)
+
+
+@pytest.mark.parametrize('token', [
+    None, '', 'other', 'segments:0:1:0:600:300:60',
+    'segments:1:1:x:600:300:60', 'segments:1:1:0:600'])
+def test_foreign_tokens(token):
+    assert SegmentPlan.from_token(token) == (None, None)
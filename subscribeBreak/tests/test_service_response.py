@@ -0,0 +1,50 @@
+"""test_service_response.py: session attributes echoed only when safe."""
+import events
+import lambda_function
+import user_store
+from lambda_function import (SESSION_ECHO_LIMIT, encoded_size, fit_session,
+                             service_response, tell_response)
+
+SMALL = {'conversation state': 'start state', 'is a subscriber': True}
+BIG = dict(SMALL, history='x' * SESSION_ECHO_LIMIT)
+
+
+def response(attributes):
+    return service_response(dict(attributes), tell_response("Hello."))
+
+
+def test_attributes_that_fit_are_echoed():
+    for saved in (True, False):
+        assert fit_session(response(SMALL), saved)['sessionAttributes'] == \
+            SMALL
+
+
+def test_saved_attributes_left_out():
+    assert fit_session(response(BIG), True)['sessionAttributes'] == {}
+
+
+def test_unsaved_attributes_trimmed():
+    kept = fit_session(response(BIG), False)['sessionAttributes']
+    assert kept == SMALL
+    assert encoded_size(kept) <= SESSION_ECHO_LIMIT
+
+
+class FailingStore(user_store.MemoryStore):
+    """MemoryStore whose writes fail."""
+
+    def update(self, id, update):
+        raise user_store.StoreError("write failed")
+
+
+def test_end_turn_reports_save(monkeypatch):
+    for store, saved in ((user_store.MemoryStore(), True),
+                         (FailingStore(), False)):
+        monkeypatch.setattr(lambda_function, 'STORE', store)
+        event = events.base_event({'type': 'LaunchRequest'})
+        lambda_function.begin_turn(event)
+        lambda_function.get_attributes(event, fresh=True)['history'] = 'x'
+        assert lambda_function.end_turn(event) is saved
+
+
+def test_no_response_passes_through():
+    assert fit_session(None, True) is None
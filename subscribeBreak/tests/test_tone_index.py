@@ -0,0 +1,100 @@
+"""test_tone_index.py: the index file round trip, and damaged files."""
+import json
+import struct
+
+import pytest
+
+import tone_index
+from tone_index import ToneIndex
+
+ROWS = {
+    'source/a.mp3': dict(seconds=120.5, rate=44100, channels=2,
+                         loudness=-18.25, pitch=220.0, note=57,
+                         data_offset=45, size=1929000),
+    'source/e.mp3': dict(seconds=61.0, rate=22050, channels=1,
+                         loudness=-30.5, pitch=329.75, note=64,
+                         data_offset=0, size=488000),
+    'source/b.mp3': dict(seconds=30.0, rate=22050, channels=1,
+                         loudness=-24.0, pitch=246.875, note=59,
+                         data_offset=10, size=240000),
+    'free/noise.mp3': dict(seconds=300.0, rate=24000, channels=2,
+                           loudness=-150.0, pitch=0.0, note=-1,
+                           data_offset=0, size=1800000),
+}
+
+
+@pytest.fixture
+def index():
+    index = ToneIndex()
+    for key, values in ROWS.items():
+        index.add(key, **values)
+    return index
+
+
+@pytest.fixture
+def saved(index, tmp_path):
+    fn = str(tmp_path / 'tone_index.bin')
+    index.save(fn)
+    return fn
+
+
+def test_round_trip(index, saved):
+    loaded = ToneIndex.load(saved)
+    assert loaded.keys == index.keys
+    for key, values in ROWS.items():
+        # every value above is exact in a float32
+        assert loaded.get(key) == values
+    assert loaded.get('source/missing.mp3') is None
+
+
+def test_queries(index):
+    keys = list(ROWS)
+    assert index.select(keys, min_seconds=60) == [
+        'source/a.mp3', 'source/e.mp3', 'free/noise.mp3']
+    # A (57): E (64) is a fifth above, B (59) a tone
+    assert index.compatible('source/a.mp3', keys) == ['source/a.mp3',
+                                                      'source/e.mp3']
+    assert index.compatible('free/noise.mp3', keys) == keys
+    assert index.compatible('source/missing.mp3', keys) == []
+    assert index.gain('source/a.mp3') == pytest.approx(10 ** (-1.75 / 20))
+    assert index.gain('free/noise.mp3') == 1.0
+
+
+def test_missing_file(tmp_path):
+    assert len(ToneIndex.load(str(tmp_path / 'none.bin'))) == 0
+
+
+def test_truncated_file_loads_empty(saved):
+    with open(saved, 'rb') as f:
+        data = f.read()
+    for length in range(len(data)):
+        with open(saved, 'wb') as f:
+            f.write(data[:length])
+        assert len(ToneIndex.load(saved)) == 0, length
+
+
+@pytest.mark.parametrize('damage', [
+    lambda data: b'NOTINDEX' + data[8:],
+    lambda data: data + b'\0' * 4,
+    lambda data: header(data, fields=[['seconds', 'f']]),
+    lambda data: header(data, count=5),
+    lambda data: header(data, keys=['source/a.mp3']),
+    lambda data: header(data, keys=None),
+], ids=['magic', 'trailing bytes', 'fields', 'count', 'keys', 'no keys'])
+def test_damaged_file_loads_empty(saved, damage):
+    with open(saved, 'rb') as f:
+        data = f.read()
+    with open(saved, 'wb') as f:
+        f.write(damage(data))
+    assert len(ToneIndex.load(saved)) == 0
+
+
+def header(data, **changes):
+    """Return index file data with header fields changed."""
+    start = len(tone_index.MAGIC) + 4
+    (size,) = struct.unpack('<I', data[len(tone_index.MAGIC):start])
+    fields = json.loads(data[start:start + size])
+    fields.update(changes)
+    text = json.dumps(fields).encode()
+    return (tone_index.MAGIC + struct.pack('<I', len(text)) + text +
+            data[start + size:])
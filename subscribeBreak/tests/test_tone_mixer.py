@@ -0,0 +1,74 @@
+"""test_tone_mixer.py: block rendering, fades and the WAV encoder."""
+import wave
+
+import numpy as np
+import pytest
+
+import tone_mixer
+from tone_mixer import Mix, MixError
+
+RATE = 8000
+
+
+def constant(level, seconds, channels=2):
+    return np.full((int(seconds * RATE), channels), level, np.float32)
+
+
+def make_mix(seconds=10, **kwargs):
+    layers = [[constant(0.5, 3), constant(0.25, 2)], [constant(0.1, 1.5)]]
+    return Mix(layers, seconds, RATE, crossfade=1, fade=1, **kwargs)
+
+
+@pytest.mark.parametrize('block_seconds', [0.3, 1, 4, 60])
+def test_blocks_join_like_one_render(block_seconds):
+    mix = make_mix()
+    blocks = list(mix.blocks(block_seconds))
+    assert all(len(b) == int(block_seconds * RATE) for b in blocks[:-1])
+    assert np.array_equal(np.concatenate(blocks), mix.render(0, mix.frames))
+
+
+def test_turns_fill_the_mix():
+    mix = make_mix()
+    first, second, other = mix.segments
+    assert first.start == 0 and second.end == other.end == mix.frames
+    # the second tone of a layer fades in while the first fades out
+    assert second.start == first.end - RATE
+    assert second.fade_in == first.fade_out == RATE
+
+
+def test_levels():
+    mix = make_mix(gains=[[1.0, 1.0], [2.0]])
+    out = mix.render(0, mix.frames)
+    assert np.all(out[0] == 0) and np.allclose(out[-1], 0, atol=1e-4)
+    # past the fade in, before the crossfade: (0.5 + 0.1 * 2) / sqrt(2)
+    middle = out[int(1.5 * RATE)]
+    assert np.allclose(middle, 0.7 / np.sqrt(2))
+
+
+def test_no_tones():
+    with pytest.raises(MixError):
+        Mix([[], []], 10, RATE)
+    with pytest.raises(MixError):
+        Mix([[constant(0.5, 0)]], 10, RATE)
+
+
+def test_write_wav(tmp_path):
+    mix = make_mix()
+    fn = str(tmp_path / 'mix.wav')
+    size = tone_mixer.write(mix, fn, 'wav', block_seconds=0.7)
+    with wave.open(fn, 'rb') as w:
+        assert (w.getnframes(), w.getnchannels(), w.getframerate()) == (
+            mix.frames, 2, RATE)
+    samples, rate = tone_mixer.read_wav(fn)
+    assert size == 44 + mix.frames * 2 * 2 and rate == RATE
+    # pcm16 truncates to 32767ths, read_wav divides by 32768
+    assert np.allclose(samples, mix.render(0, mix.frames), rtol=0,
+                       atol=2 / 32767)
+
+
+def test_conform():
+    stereo = np.stack([np.linspace(-1, 1, 100)] * 2, axis=1) \
+        .astype(np.float32)
+    mono = tone_mixer.conform(stereo, RATE, RATE, 1)
+    assert mono.shape == (100, 1) and np.allclose(mono[:, 0], stereo[:, 0])
+    assert len(tone_mixer.conform(stereo, RATE, 2 * RATE, 2)) == 200
@@ -0,0 +1,70 @@
+"""test_update_dbdata.py: a write that loses a race is merged and retried."""
+import pytest
+
+import lambda_function
+import user_store
+from lambda_function import (RECORD_VERSION, VISIT_COUNT, read_record,
+                             update_dbdata)
+
+ID = 'amzn1.ask.account.TEST'
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(lambda_function, 'OCC_BACKOFF', (0, 0))
+
+
+def read(store):
+    return read_record(store.get(ID))[0]
+
+
+def test_conflict_merges_onto_the_record_as_it_is_now():
+    store = user_store.MemoryStore()
+    update_dbdata(store, ID, {'a': '1', 'b': '1', 'c': '1', VISIT_COUNT: 5,
+                              RECORD_VERSION: 0}, None, {VISIT_COUNT: 5})
+    # two containers read version 1 of the record
+    mine, theirs = read(store), read(store)
+    assert mine[RECORD_VERSION] == 1
+    original = dict(mine)
+    other = dict(theirs)
+    other.update(b='B', **{VISIT_COUNT: 6})
+    assert update_dbdata(store, ID, other, theirs, {VISIT_COUNT: 1}) == {}
+    mine.update(a='A', **{VISIT_COUNT: 6})
+    del mine['c']
+    assert update_dbdata(store, ID, mine, original, {VISIT_COUNT: 1}) == {}
+    # one conflict, then the merged write
+    assert store.calls['update'] == 4
+    record = read(store)
+    assert {k: record.get(k) for k in 'abc'} == {'a': 'A', 'b': 'B',
+                                                 'c': None}
+    assert record[VISIT_COUNT] == 7
+    assert record[RECORD_VERSION] == mine[RECORD_VERSION] == 3
+
+
+class ConflictingStore(user_store.MemoryStore):
+    """MemoryStore whose versioned updates, or all if always, lose a race."""
+
+    def __init__(self, always=False):
+        super().__init__()
+        self.always = always
+
+    def update(self, id, update):
+        if self.always or update.version is not None:
+            self.calls['update'] += 1
+            raise user_store.ConditionFailed("item version changed")
+        return super().update(id, update)
+
+
+def test_last_attempt_writes_whatever_the_version():
+    store = ConflictingStore()
+    data = {'a': '1', VISIT_COUNT: 1, RECORD_VERSION: 0}
+    assert update_dbdata(store, ID, data, None, {VISIT_COUNT: 1}) == {}
+    assert store.calls['update'] == lambda_function.OCC_RETRIES + 1
+    assert read(store)['a'] == '1' and read(store)[VISIT_COUNT] == 1
+
+
+def test_gives_up_when_every_attempt_conflicts():
+    store = ConflictingStore(always=True)
+    data = {'a': '1', RECORD_VERSION: 0}
+    assert update_dbdata(store, ID, data, None) == "version conflict"
+    assert read(store) == {RECORD_VERSION: 0}
@@ -0,0 +1,182 @@
+"""test_user_store.py: DynamoDBStore's expressions do what Update.apply does.
+
+MemoryStore and FileStore apply an Update in Python; DynamoDBStore turns
+it into an update_item expression.  Each case is run both ways, on
+fakes.FakeTable's evaluation of the expression, and must leave the same
+item or fail the same condition.
+"""
+import copy
+import json
+import re
+
+import pytest
+
+import fakes
+from user_store import (DATA, EXPIRES, USERID, VERSION, CachedStore,
+                        ConditionFailed, DynamoDBStore, FileStore, MemoryStore,
+                        Update)
+
+ID = 'amzn1.ask.account.TEST'
+RECORD = {USERID: ID, DATA: {'state': 'start', 'tones': [1, 2]},
+          'timestamp': '2026-01-01', VERSION: 3, 'launches': 7}
+
+CASES = {
+    'new record': ({}, Update('t', {'state': 'start'}, replace=True,
+                              version=0)),
+    'replace': (RECORD, Update('t', {'state': 'b'}, replace=True,
+                               version=3)),
+    'set, remove, add': (RECORD, Update('t', {'state': 'b', 'new': {'x': 1}},
+                                        removes=['tones'],
+                                        adds={'launches': 1, 'buys': 2},
+                                        version=3)),
+    'counters only': (RECORD, Update('t', adds={'launches': 1}, version=3)),
+    'counters, no record': ({}, Update('t', adds={'launches': 1})),
+    'expires': (RECORD, Update('t', {'state': 'b'}, expires=1900000000,
+                               version=3)),
+    'any version': (RECORD, Update('t', {'state': 'b'})),
+    'expect holds': (RECORD, Update('t', {'state': 'b'},
+                                    expect={'state': 'start'}, version=3)),
+    'expect fails': (RECORD, Update('t', {'state': 'b'},
+                                    expect={'state': 'other'})),
+    'version changed': (RECORD, Update('t', {'state': 'b'}, version=2)),
+    'record exists': (RECORD, Update('t', {'state': 'b'}, replace=True,
+                                     version=0)),
+    'no DATA': ({USERID: ID, 'launches': 1},
+                Update('t', {'state': 'b'}, version=0)),
+}
+
+
+def dynamodb_store(item):
+    store = DynamoDBStore('users', dynamodb=fakes.FakeDynamoDB())
+    if item:
+        store.table.items[ID] = copy.deepcopy(item)
+    return store
+
+
+def memory_store(item):
+    store = MemoryStore()
+    if item:
+        store.items[ID] = copy.deepcopy(item)
+    return store
+
+
+def outcome(store, update):
+    try:
+        store.update(ID, update)
+    except ConditionFailed:
+        return ConditionFailed
+    return fakes.as_stored(store.get(ID))
+
+
+@pytest.mark.parametrize('name', CASES)
+def test_expression_matches_apply(name):
+    item, update = CASES[name]
+    expected = outcome(memory_store(item), update)
+    assert outcome(dynamodb_store(item), update) == expected
+    if expected is not ConditionFailed:
+        assert expected[VERSION] == item.get(VERSION, 0) + 1
+        assert (EXPIRES in expected) == (EXPIRES in item or
+                                         update.expires is not None)
+
+
+@pytest.mark.parametrize('name', CASES)
+def test_expression_uses_every_name_and_value(name):
+    """DynamoDB rejects names or values the expressions don't use."""
+    item, update = CASES[name]
+    store = dynamodb_store(item)
+    sent = {}
+
+    def update_item(**kwargs):
+        sent.update(kwargs)
+        return {}
+
+    store.table.update_item = update_item
+    store.update(ID, update)
+    text = ' '.join((sent['UpdateExpression'],
+                     sent.get('ConditionExpression', '')))
+    used = set(re.findall(r'[#:]\w+', text))
+    assert used == (set(sent['ExpressionAttributeNames']) |
+                    set(sent['ExpressionAttributeValues']))
+
+
+def test_file_store_skips_bad_lines(tmp_path):
+    fn = tmp_path / 'users.jsonl'
+    lines = ['{"userId": "other", "version": 1}', '{"userId": "other", "ver',
+             '[1, 2]', '"text"', '{"data": {}}', '{"userId": ["a"]}',
+             json.dumps(RECORD)]
+    fn.write_text('\n'.join(lines) + '\n')
+    store = FileStore(str(fn))
+    assert store.get(ID) == RECORD
+    assert sorted(store.index) == [ID, 'other']
+    store.update(ID, Update('t', adds={'launches': 1}, version=3))
+    assert FileStore(str(fn)).get(ID)['launches'] == 8
+
+
+# --------------- CachedStore -----------------
+
+def cached_store(item, **kwargs):
+    store = memory_store(item)
+    return store, CachedStore(store, **kwargs)
+
+
+def written_elsewhere(store):
+    """Another container's write: the record's VERSION moves past 3."""
+    store.update(ID, Update('t', {'state': 'elsewhere'}, version=3))
+
+
+def test_cached_read():
+    store, cache = cached_store(RECORD)
+    assert cache.get(ID) == RECORD
+    cache.get(ID)[DATA]['state'] = 'changed'    # callers get copies
+    assert cache.get(ID) == RECORD
+    assert store.calls['get'] == 1
+    assert cache.stats['hits'] == 2 and cache.stats['misses'] == 1
+
+
+def test_missing_record_cached():
+    store, cache = cached_store({})
+    assert cache.get(ID) == {} and cache.get(ID) == {}
+    assert store.calls['get'] == 1
+    # the first write creates the record in the cached copy too
+    cache.update(ID, Update('t', {'state': 'start'}, replace=True, version=0))
+    assert cache.get(ID) == store.get(ID)
+    assert cache.get(ID)[VERSION] == 1
+
+
+def test_write_applied_to_cached_copy():
+    store, cache = cached_store(RECORD)
+    cache.get(ID)
+    cache.update(ID, Update('t', {'state': 'b'}, adds={'launches': 1},
+                            version=3))
+    assert cache.get(ID) == store.get(ID)
+    assert store.calls['get'] == 2      # only the check just above
+    assert cache.stats['misses'] == 1
+
+
+def test_condition_failed_drops_entry():
+    store, cache = cached_store(RECORD)
+    cache.get(ID)
+    written_elsewhere(store)
+    with pytest.raises(ConditionFailed):
+        cache.update(ID, Update('t', {'state': 'b'}, version=3))
+    assert ID not in cache.entries and cache.stats['stale'] == 1
+    assert cache.get(ID)[DATA]['state'] == 'elsewhere'
+
+
+def test_version_mismatch_drops_entry():
+    store, cache = cached_store(RECORD)
+    cache.get(ID)
+    written_elsewhere(store)
+    # the write holds in the store (VERSION 4) but not on the cached copy (3)
+    cache.update(ID, Update('t', {'state': 'b'}, version=4))
+    assert ID not in cache.entries and cache.stats['stale'] == 1
+    assert cache.get(ID) == store.get(ID)
+    assert cache.get(ID)[VERSION] == 5
+
+
+def test_expired_entry_read_again():
+    store, cache = cached_store(RECORD, ttl=0)
+    cache.get(ID)
+    written_elsewhere(store)
+    assert cache.get(ID)[DATA]['state'] == 'elsewhere'
+    assert cache.stats['expired'] == 1 and store.calls['get'] == 2
@@ -0,0 +1,169 @@
+"""tone_catalog.py: lazy, cached listing of tone files on S3.
+
+The free and source tone lists almost never change, so they are loaded on
+first use, kept for `ttl` seconds and shared across warm invocations.  A
+bundled manifest file (see `write_manifest`) can seed the lists so a cold
+start never has to page through the bucket at all.
+
+`fetch` downloads a tone to local disk once per container, `exists` checks
+for a file with one HEAD request and `upload` puts a file (e.g. a rendered
+mix) under the catalog's prefix.
+"""
+import json
+import os
+import time
+
+import skill_log as log
+
+# --------------- catalog settings -----------------
+TONE_BUCKET_NAME = 'solutonetherapytones'
+# bundled next to lambda_function (and this module), wherever it runs from
+TONE_MANIFEST_FN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'tone_manifest.json')
+CATALOG_TTL = 6 * 60 * 60                 # seconds before re-listing S3
+TONE_FOLDER = '/tmp/tones'                # fetched tones, kept while warm
+
+
+class TransferError(OSError):
+    """A tone that could not be downloaded or a file not uploaded."""
+
+
+class ToneCatalog:
+    """List of tone filenames under `prefix` in a bucket, loaded on demand.
+
+    Behaves like a read-only list (len, iteration, indexing, `in`) so code
+    that used the old module-level lists keeps working.
+    """
+
+    def __init__(self, prefix, bucket_name=TONE_BUCKET_NAME,
+                 manifest_fn=TONE_MANIFEST_FN, ttl=CATALOG_TTL):
+        self.prefix = prefix
+        self.bucket_name = bucket_name
+        self.manifest_fn = manifest_fn
+        self.ttl = ttl
+        self._keys = None
+        self._expires = 0.0
+        self._bucket = None
+
+    # --------------- loading -----------------
+    def keys(self):
+        """Return list of filenames, loading or refreshing as needed."""
+        now = time.monotonic()
+        if self._keys is None:
+            self._keys = self._from_manifest()
+            if self._keys is not None:
+                self._expires = now + self.ttl
+        if self._keys is None or now >= self._expires:
+            self._keys = self._from_bucket()
+            self._expires = now + self.ttl
+        return self._keys
+
+    def invalidate(self):
+        """Force the next access to re-list the bucket."""
+        self._expires = 0.0
+
+    def _from_manifest(self):
+        """Return filenames from the bundled manifest, or None."""
+        if not self.manifest_fn or not os.path.exists(self.manifest_fn):
+            return None
+        try:
+            with open(self.manifest_fn) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning("unreadable tone manifest", error=e)
+            return None
+        if self.prefix not in manifest:
+            return None
+        return list(manifest[self.prefix])
+
+    @property
+    def bucket(self):
+        """Return the S3 Bucket resource, creating it on first use."""
+        if self._bucket is None:
+            import boto3
+            self._bucket = boto3.resource('s3').Bucket(self.bucket_name)
+        return self._bucket
+
+    def _from_bucket(self):
+        """Return filenames listed from S3 under `prefix`."""
+        folder = self.prefix + '/'
+        keys = [x.key[len(folder):]
+                for x in self.bucket.objects.filter(Prefix=self.prefix)
+                if x.key != folder]
+        log.debug("listed tones", folder=folder, count=len(keys))
+        return keys
+
+    # --------------- files -----------------
+    def fetch(self, name, folder=TONE_FOLDER):
+        """Return local path of tone `name`, downloading it if not there."""
+        fn = os.path.join(folder, self.prefix, name)
+        if not os.path.exists(fn):
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            partial = fn + '.part'
+            from botocore.exceptions import BotoCoreError, ClientError
+            try:
+                self.bucket.download_file(f'{self.prefix}/{name}', partial)
+            except (BotoCoreError, ClientError) as e:
+                raise TransferError(f"{self.prefix}/{name}: {e}")
+            os.replace(partial, fn)
+            log.debug("fetched tone", key=f'{self.prefix}/{name}')
+        return fn
+
+    def exists(self, name):
+        """Return True if `name` is under `prefix`, with a HEAD request."""
+        from botocore.exceptions import BotoCoreError, ClientError
+        try:
+            self.bucket.Object(f'{self.prefix}/{name}').load()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey',
+                                               'NotFound'):
+                return False
+            raise TransferError(f"{self.prefix}/{name}: {e}")
+        except BotoCoreError as e:
+            raise TransferError(f"{self.prefix}/{name}: {e}")
+        return True
+
+    def upload(self, fn, name, content_type=None):
+        """Upload local file fn as `name` under `prefix`."""
+        from boto3.exceptions import S3UploadFailedError
+        from botocore.exceptions import BotoCoreError
+        extra = {'ContentType': content_type} if content_type else None
+        try:
+            self.bucket.upload_file(fn, f'{self.prefix}/{name}',
+                                    ExtraArgs=extra)
+        except (BotoCoreError, S3UploadFailedError) as e:
+            raise TransferError(f"{self.prefix}/{name}: {e}")
+        log.debug("uploaded", key=f'{self.prefix}/{name}')
+
+    # --------------- list behaviour -----------------
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getitem__(self, index):
+        return self.keys()[index]
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def __repr__(self):
+        return f"ToneCatalog({self.prefix!r}, {self._keys!r})"
+
+
+def write_manifest(catalogs, fn=TONE_MANIFEST_FN):
+    """Save current bucket listings of `catalogs` to manifest `fn`.
+
+    Run before zipping the lambda so the manifest ships with the code:
+    `python tone_catalog.py`
+    """
+    manifest = {c.prefix: c._from_bucket() for c in catalogs}
+    with open(fn, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+if __name__ == '__main__':
+    print(write_manifest([ToneCatalog('free', manifest_fn=None),
+                          ToneCatalog('source', manifest_fn=None)]))
@@ -0,0 +1,261 @@
+"""tone_index.py: precomputed metadata of every tone, in one compact file.
+
+For each tone (`free/...` and `source/...` keys) the index holds its length,
+stored sample rate and channels, RMS loudness, dominant pitch and nearest
+note, and the byte offset and size of its audio data.  Columns are stdlib
+`array`s written one after another behind a small JSON header, so the
+file is a few bytes per tone and loads with no NumPy and no parsing per
+row.  The lambda loads it once per container (`ToneIndex.load`) and picks
+and levels tones from memory instead of downloading or probing them.
+
+Tones are measured by downloading and decoding each one, so build the
+index before zipping the lambda, after tones are added to the bucket:
+    python tone_index.py
+    python tone_index.py --folder tones/    # local free/, source/ folders
+"""
+import array
+import json
+import math
+import os
+import struct
+
+import skill_log as log
+
+# bundled next to lambda_function (and this module), wherever it runs from
+TONE_INDEX_FN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'tone_index.bin')
+MAGIC = b'TONEIDX1'
+# name, array typecode
+FIELDS = (('seconds', 'f'), ('rate', 'I'), ('channels', 'B'),
+          ('loudness', 'f'),    # RMS, dB below full scale
+          ('pitch', 'f'),       # strongest frequency, Hz, 0 if none
+          ('note', 'b'),        # MIDI note nearest pitch, -1 if none
+          ('data_offset', 'I'), ('size', 'I'))
+CONSONANT = (0, 5, 7)   # semitones between notes that sound well together
+TARGET_LOUDNESS = -20.0     # dBFS tones are levelled to
+PITCH_SECONDS = 10      # of each tone analysed for pitch
+
+
+class ToneIndex:
+    """Columns of tone metadata, a row per key ('source/tone1.mp3')."""
+
+    def __init__(self, keys=(), columns=None):
+        self.keys = list(keys)
+        self.columns = columns or {name: array.array(code)
+                                   for name, code in FIELDS}
+        self.rows = {key: i for i, key in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def add(self, key, **values):
+        """Append row for key with a value for every field."""
+        self.rows[key] = len(self.keys)
+        self.keys.append(key)
+        for name, _ in FIELDS:
+            self.columns[name].append(values[name])
+
+    def get(self, key):
+        """Return {field: value} of key, or None if it isn't indexed."""
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        return {name: self.columns[name][row] for name, _ in FIELDS}
+
+    # --------------- queries -----------------
+    def select(self, keys, min_seconds=0, notes=None):
+        """Return those of keys that are indexed and match.
+
+        notes -- pitch classes (0-11) allowed, None for any
+        """
+        seconds = self.columns['seconds']
+        note = self.columns['note']
+        selected = []
+        for key in keys:
+            row = self.rows.get(key)
+            if row is None or seconds[row] < min_seconds:
+                continue
+            if notes is not None and (note[row] < 0 or
+                                      note[row] % 12 not in notes):
+                continue
+            selected.append(key)
+        return selected
+
+    def compatible(self, key, keys, intervals=CONSONANT):
+        """Return those of keys whose note is consonant with key's.
+
+        Every indexed key is compatible with a tone of no pitch, and none
+        with a key that isn't indexed.
+        """
+        row = self.rows.get(key)
+        if row is None:
+            return []
+        root = self.columns['note'][row]
+        if root < 0:
+            return self.select(keys)
+        notes = {(root + i) % 12 for i in intervals} | \
+            {(root - i) % 12 for i in intervals}
+        return self.select(keys, notes=notes)
+
+    def gain(self, key, target=TARGET_LOUDNESS):
+        """Return gain bringing key to target loudness, 1 if unknown."""
+        row = self.rows.get(key)
+        if row is None or self.columns['loudness'][row] <= -120:
+            return 1.0
+        return 10 ** ((target - self.columns['loudness'][row]) / 20)
+
+    # --------------- file -----------------
+    def save(self, fn=TONE_INDEX_FN):
+        """Write index to fn, return its size in bytes."""
+        header = json.dumps({'count': len(self.keys), 'keys': self.keys,
+                             'fields': FIELDS}).encode()
+        with open(fn, 'wb') as f:
+            f.write(MAGIC + struct.pack('<I', len(header)) + header)
+            for name, _ in FIELDS:
+                column = self.columns[name]
+                if struct.pack('=H', 1) != struct.pack('<H', 1):
+                    column = array.array(column.typecode, column)
+                    column.byteswap()
+                f.write(column.tobytes())
+            return f.tell()
+
+    @classmethod
+    def load(cls, fn=TONE_INDEX_FN):
+        """Return index read from fn, empty if there is no usable file."""
+        try:
+            with open(fn, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return cls()
+        try:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError("not a tone index")
+            start = len(MAGIC) + 4
+            (size,) = struct.unpack('<I', data[len(MAGIC):start])
+            header = json.loads(data[start:start + size])
+            if [tuple(f) for f in header['fields']] != list(FIELDS):
+                raise ValueError("fields differ from this version")
+            if len(header['keys']) != header['count']:
+                raise ValueError("key count differs from header")
+            position = start + size
+            columns = {}
+            for name, code in FIELDS:
+                column = array.array(code)
+                end = position + column.itemsize * header['count']
+                if end > len(data):
+                    raise ValueError(f"truncated in column {name}")
+                column.frombytes(data[position:end])
+                if struct.pack('=H', 1) != struct.pack('<H', 1):
+                    column.byteswap()
+                columns[name] = column
+                position = end
+            if position != len(data):
+                raise ValueError("bytes after the last column")
+        except (ValueError, KeyError, TypeError, struct.error) as e:
+            log.warning("unusable tone index", fn=fn, error=str(e))
+            return cls()
+        return cls(header['keys'], columns)
+
+
+# --------------- measuring -----------------
+def measure(fn):
+    """Return {field: value} of tone file fn."""
+    import numpy as np
+    import tone_mixer
+    rate, channels, frames = tone_mixer.probe(fn)
+    samples = tone_mixer.decode(fn, channels=1)[:, 0]
+    rms = float(np.sqrt(np.mean(np.square(samples, dtype=np.float64)))) \
+        if len(samples) else 0.0
+    pitch = dominant_pitch(samples[:PITCH_SECONDS * tone_mixer.SAMPLE_RATE],
+                           tone_mixer.SAMPLE_RATE)
+    return {'seconds': frames / rate, 'rate': rate, 'channels': channels,
+            'loudness': 20 * math.log10(rms) if rms > 1e-6 else -120.0,
+            'pitch': pitch,
+            'note': round(69 + 12 * math.log2(pitch / 440)) if pitch else -1,
+            'data_offset': data_offset(fn), 'size': os.path.getsize(fn)}
+
+
+def dominant_pitch(samples, rate, lowest=20.0):
+    """Return strongest frequency in samples above lowest Hz, 0 if none."""
+    import numpy as np
+    if len(samples) < rate // 10:
+        return 0.0
+    spectrum = np.abs(np.fft.rfft(samples * np.hanning(len(samples))))
+    frequencies = np.fft.rfftfreq(len(samples), 1 / rate)
+    spectrum[frequencies < lowest] = 0
+    peak = int(np.argmax(spectrum))
+    if spectrum[peak] <= 1e-3 * len(samples):
+        return 0.0
+    if 0 < peak < len(spectrum) - 1:
+        # centre of a parabola through the peak bin and its neighbours
+        a, b, c = np.log(spectrum[peak - 1:peak + 2] + 1e-12)
+        peak += 0.5 * (a - c) / (a - 2 * b + c)
+    return float(peak * rate / len(samples))
+
+
+def data_offset(fn):
+    """Return byte offset of the audio data in fn (WAV data chunk, MP3
+    after any ID3v2 tag), 0 if unknown."""
+    with open(fn, 'rb') as f:
+        head = f.read(12)
+        if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+            while True:
+                chunk = f.read(8)
+                if len(chunk) < 8:
+                    return 0
+                name, size = struct.unpack('<4sI', chunk)
+                if name == b'data':
+                    return f.tell()
+                f.seek(size + size % 2, os.SEEK_CUR)
+    if head[:3] == b'ID3':
+        size = 0
+        for byte in head[6:10]:
+            size = size << 7 | (byte & 0x7f)
+        return 10 + size
+    return 0
+
+
+def build_index(files):
+    """Return ToneIndex of files, an iterable of (key, local path)."""
+    index = ToneIndex()
+    for key, fn in files:
+        try:
+            index.add(key, **measure(fn))
+        except Exception as e:
+            log.warning("tone not indexed", key=key, error=str(e))
+    return index
+
+
+def catalog_files(catalogs):
+    """Yield (key, local path) of every tone in catalogs, downloading."""
+    for catalog in catalogs:
+        for name in catalog:
+            yield f'{catalog.prefix}/{name}', catalog.fetch(name)
+
+
+def folder_files(folder):
+    """Yield (key, path) of files in the subfolders of folder."""
+    for prefix in sorted(os.listdir(folder)):
+        path = os.path.join(folder, prefix)
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                yield f'{prefix}/{name}', os.path.join(path, name)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="index tone metadata")
+    parser.add_argument('--folder', help="index local folders, not S3")
+    parser.add_argument('--output', default=TONE_INDEX_FN)
+    args = parser.parse_args()
+    if args.folder:
+        files = folder_files(args.folder)
+    else:
+        from tone_catalog import ToneCatalog
+        files = catalog_files([ToneCatalog('free', manifest_fn=None),
+                               ToneCatalog('source', manifest_fn=None)])
+    index = build_index(files)
+    print(len(index), "tones,", index.save(args.output), "bytes")
@@ -0,0 +1,375 @@
+"""tone_mixer.py: layered, crossfaded tone mixes rendered as a stream.
+
+A `Mix` is made of layers, each a list of decoded source tones played one
+after another (each looped to fill its turn, equal-power crossfaded into
+the next); the layers play at once.  The mix is rendered in blocks of a
+second or so with NumPy and each block encoded as soon as it is made, so
+memory stays the same whatever the duration: only the source tones and
+one block are ever held.
+
+Sources are decoded with `wave` when they are WAV files and with ffmpeg
+(`FFMPEG`, e.g. from a lambda layer) otherwise.  Output is MP3, through
+an ffmpeg pipe, for Alexa, or WAV, which needs no ffmpeg.  NumPy is
+imported on first use, not with the module.
+
+Mix local files to listen to:
+    python tone_mixer.py out.wav a.wav b.mp3 c.wav --seconds 60
+"""
+import json
+import math
+import os
+import struct
+import subprocess
+import threading
+import wave
+from functools import lru_cache
+
+# --------------- output settings -----------------
+SAMPLE_RATE = 24000     # Alexa plays MP3 at 16000, 22050 or 24000 Hz
+CHANNELS = 2
+MP3_BITRATE = '48k'     # Alexa's SSML audio limit
+BLOCK_SECONDS = 1.0     # audio rendered and encoded at a time
+CHUNK_BYTES = 64 * 1024     # encoded bytes read from ffmpeg at a time
+CROSSFADE = 4.0     # seconds one tone of a layer fades into the next
+FADE = 2.0          # seconds the whole mix fades in and out
+FFMPEG = os.environ.get('FFMPEG', 'ffmpeg')
+FFPROBE = os.environ.get('FFPROBE', 'ffprobe')
+SOURCE_CACHE = 8    # decoded source tones kept across warm invocations
+MIXER_VERSION = 2   # raise when the same recipe would sound different
+
+
+class MixError(Exception):
+    """A source that can't be decoded or a mix that can't be encoded."""
+
+
+# --------------- decoding -----------------
+@lru_cache(maxsize=SOURCE_CACHE)
+def load(fn, rate=SAMPLE_RATE, channels=CHANNELS):
+    """Return decoded fn, cached.  Callers must not change the array."""
+    return decode(fn, rate, channels)
+
+
+def decode(fn, rate=SAMPLE_RATE, channels=CHANNELS):
+    """Return fn as float32 array of frames x channels at rate."""
+    with open(fn, 'rb') as f:
+        head = f.read(12)
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        samples, source_rate = read_wav(fn)
+        return conform(samples, source_rate, rate, channels)
+    return ffmpeg_decode(fn, rate, channels)
+
+
+def probe(fn):
+    """Return (rate, channels, frames) of fn as stored, without decoding."""
+    with open(fn, 'rb') as f:
+        head = f.read(12)
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        try:
+            with wave.open(fn, 'rb') as w:
+                return w.getframerate(), w.getnchannels(), w.getnframes()
+        except (wave.Error, EOFError) as e:
+            raise MixError(f"{fn}: {e}")
+    command = [FFPROBE, '-v', 'error', '-select_streams', 'a:0',
+               '-show_entries', 'stream=sample_rate,channels,duration',
+               '-of', 'json', fn]
+    try:
+        result = subprocess.run(command, capture_output=True)
+    except FileNotFoundError:
+        raise MixError(f"no {FFPROBE} to probe {fn}")
+    try:
+        stream = json.loads(result.stdout)['streams'][0]
+        rate = int(stream['sample_rate'])
+        return rate, int(stream['channels']), \
+            int(float(stream['duration']) * rate)
+    except (ValueError, KeyError, IndexError):
+        raise MixError(f"{fn}: {result.stderr.decode(errors='replace')}")
+
+
+def read_wav(fn):
+    """Return (float32 frames x channels array, rate) of PCM WAV fn."""
+    import numpy as np
+    try:
+        with wave.open(fn, 'rb') as w:
+            width = w.getsampwidth()
+            source_channels = w.getnchannels()
+            rate = w.getframerate()
+            raw = w.readframes(w.getnframes())
+    except (wave.Error, EOFError) as e:
+        raise MixError(f"{fn}: {e}")
+    if width == 1:
+        samples = (np.frombuffer(raw, np.uint8).astype(np.float32) - 128) \
+            / 128
+    elif width == 3:
+        b = np.frombuffer(raw, np.uint8).reshape(-1, 3).astype(np.int32)
+        ints = b[:, 0] | b[:, 1] << 8 | b[:, 2] << 16
+        ints = np.where(ints >= 1 << 23, ints - (1 << 24), ints)
+        samples = ints.astype(np.float32) / (1 << 23)
+    elif width in (2, 4):
+        samples = np.frombuffer(raw, f'<i{width}').astype(np.float32) \
+            / (1 << (8 * width - 1))
+    else:
+        raise MixError(f"{fn}: {width} byte samples")
+    return samples.reshape(-1, source_channels), rate
+
+
+def conform(samples, source_rate, rate, channels):
+    """Return samples resampled to rate (linear) with channels channels."""
+    import numpy as np
+    if samples.shape[1] != channels:
+        if channels == 1:
+            samples = samples.mean(axis=1, keepdims=True)
+        else:
+            samples = samples[:, np.arange(channels) % samples.shape[1]]
+    if source_rate != rate and len(samples):
+        count = int(round(len(samples) * rate / source_rate))
+        times = np.arange(count) * (source_rate / rate)
+        positions = np.arange(len(samples))
+        samples = np.stack([np.interp(times, positions, samples[:, c])
+                            for c in range(channels)], axis=1)
+    return np.ascontiguousarray(samples, dtype=np.float32)
+
+
+def ffmpeg_decode(fn, rate=SAMPLE_RATE, channels=CHANNELS):
+    """Return fn decoded by ffmpeg as float32 frames x channels."""
+    import numpy as np
+    command = [FFMPEG, '-v', 'error', '-i', fn, '-f', 'f32le',
+               '-ac', str(channels), '-ar', str(rate), '-']
+    try:
+        result = subprocess.run(command, capture_output=True)
+    except FileNotFoundError:
+        raise MixError(f"no {FFMPEG} to decode {fn}")
+    if result.returncode:
+        raise MixError(f"{fn}: {result.stderr.decode(errors='replace')}")
+    return np.frombuffer(result.stdout, np.float32).reshape(-1, channels)
+
+
+# --------------- mixing -----------------
+class Segment:
+    """One tone's turn in a layer: frames start to end of the mix."""
+
+    def __init__(self, tone, start, end, fade_in, fade_out, gain=1.0):
+        self.tone = tone
+        self.start = start
+        self.end = end
+        self.fade_in = fade_in
+        self.fade_out = fade_out
+        self.gain = gain
+
+    def render(self, start, end, out):
+        """Add frames start to end (of the mix) of this turn to out."""
+        import numpy as np
+        positions = np.arange(start - self.start, end - self.start)
+        samples = np.take(self.tone, positions % len(self.tone), axis=0)
+        gain = np.full(len(positions), self.gain, np.float32)
+        if self.fade_in:
+            gain *= np.sin(np.pi / 2 * np.clip(positions / self.fade_in,
+                                               0, 1))
+        if self.fade_out:
+            left = self.end - self.start - positions
+            gain *= np.sin(np.pi / 2 * np.clip(left / self.fade_out, 0, 1))
+        out += samples * gain[:, None]
+
+
+class Mix:
+    """Layers of tones rendered block by block.
+
+    layers -- list of layers, each a list of decoded tones (float32
+        frames x channels arrays at rate) to play in turn
+    seconds -- length of the mix
+    gains -- like layers, a gain for each tone (e.g. to even out their
+        loudness), default 1
+    """
+
+    def __init__(self, layers, seconds, rate=SAMPLE_RATE, crossfade=CROSSFADE,
+                 fade=FADE, gains=None):
+        if gains is None:
+            gains = [[1.0] * len(layer) for layer in layers]
+        gains = [g for g, layer in zip(gains, layers) if layer]
+        layers = [layer for layer in layers if layer]
+        if not layers:
+            raise MixError("no tones to mix")
+        self.rate = rate
+        self.channels = layers[0][0].shape[1]
+        self.frames = int(seconds * rate)
+        self.fade = min(int(fade * rate), self.frames // 2)
+        self.gain = 1 / math.sqrt(len(layers))
+        self.segments = []
+        for tones, tone_gains in zip(layers, gains):
+            self.segments.extend(self._turns(tones, tone_gains,
+                                             int(crossfade * rate)))
+
+    @property
+    def seconds(self):
+        """Return length of the mix in seconds."""
+        return self.frames / self.rate
+
+    def _turns(self, tones, gains, crossfade):
+        """Return Segments of tones filling the mix, crossfaded."""
+        count = len(tones)
+        crossfade = min(crossfade, self.frames // (2 * count))
+        length = (self.frames + (count - 1) * crossfade) / count
+        segments = []
+        for i, (tone, gain) in enumerate(zip(tones, gains)):
+            if not len(tone):
+                raise MixError("empty tone")
+            start = int(round(i * (length - crossfade)))
+            end = self.frames if i == count - 1 else \
+                int(round(start + length))
+            segments.append(Segment(tone, start, end,
+                                    crossfade if i else 0,
+                                    crossfade if i < count - 1 else 0, gain))
+        return segments
+
+    def render(self, start, end):
+        """Return float32 frames start to end of the mix."""
+        import numpy as np
+        out = np.zeros((end - start, self.channels), np.float32)
+        for segment in self.segments:
+            a, b = max(start, segment.start), min(end, segment.end)
+            if a < b:
+                segment.render(a, b, out[a - start:b - start])
+        out *= self.gain
+        if self.fade:
+            positions = np.arange(start, end)
+            gain = np.clip(np.minimum(positions, self.frames - positions) /
+                           self.fade, 0, 1)
+            out *= gain[:, None].astype(np.float32)
+        return out
+
+    def blocks(self, block_seconds=BLOCK_SECONDS):
+        """Yield the mix as float32 arrays of block_seconds each."""
+        size = max(1, int(block_seconds * self.rate))
+        for start in range(0, self.frames, size):
+            yield self.render(start, min(start + size, self.frames))
+
+
+# --------------- encoding -----------------
+def pcm16(block):
+    """Return block as little-endian 16 bit PCM bytes."""
+    import numpy as np
+    return (np.clip(block, -1, 1) * 32767).astype('<i2').tobytes()
+
+
+def wav_header(frames, channels, rate, width=2):
+    """Return the 44 byte header of a PCM WAV file of frames frames."""
+    size = frames * channels * width
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + size, b'WAVE',
+                       b'fmt ', 16, 1, channels, rate, rate * channels * width,
+                       channels * width, width * 8, b'data', size)
+
+
+def wav_chunks(mix, block_seconds=BLOCK_SECONDS):
+    """Yield mix as a WAV file, header first, a block at a time."""
+    yield wav_header(mix.frames, mix.channels, mix.rate)
+    for block in mix.blocks(block_seconds):
+        yield pcm16(block)
+
+
+def mp3_command(rate, channels, bitrate=MP3_BITRATE):
+    """Return ffmpeg command encoding 16 bit PCM on stdin to MP3 on stdout.
+
+    The output is bare frames, with no tags, no Xing frame and no bit
+    reservoir, so that frames can be cut apart and joined (see
+    parallel_encoder) and either encoder makes the same bytes of a mix.
+    """
+    return [FFMPEG, '-v', 'error', '-f', 's16le', '-ar', str(rate),
+            '-ac', str(channels), '-i', '-', '-b:a', bitrate,
+            '-reservoir', '0', '-f', 'mp3', '-id3v2_version', '0',
+            '-write_xing', '0', '-']
+
+
+def mp3_chunks(mix, block_seconds=BLOCK_SECONDS, bitrate=MP3_BITRATE,
+               chunk_bytes=CHUNK_BYTES):
+    """Yield mix encoded as MP3 by ffmpeg, chunk_bytes at a time.
+
+    A thread feeds ffmpeg blocks as they are rendered while this reads its
+    output, so neither side waits on a full pipe.
+    """
+    try:
+        process = subprocess.Popen(mp3_command(mix.rate, mix.channels,
+                                               bitrate), stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise MixError(f"no {FFMPEG} to encode MP3")
+    errors = []
+
+    def feed():
+        try:
+            for block in mix.blocks(block_seconds):
+                process.stdin.write(pcm16(block))
+        except BrokenPipeError:
+            pass    # ffmpeg stopped, its exit code says why
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    finished = False
+    try:
+        while True:
+            chunk = process.stdout.read(chunk_bytes)
+            if not chunk:
+                break
+            yield chunk
+        finished = True
+    finally:
+        if not finished:
+            process.kill()
+        feeder.join()
+        code = process.wait()
+        stderr = process.stderr.read().decode(errors='replace')
+        process.stdout.close()
+        process.stderr.close()
+    if errors:
+        raise MixError(f"rendering failed: {errors[0]}")
+    if code:
+        raise MixError(f"{FFMPEG} exited {code}: {stderr}")
+
+
+ENCODERS = {'mp3': mp3_chunks, 'wav': wav_chunks}
+CONTENT_TYPES = {'mp3': 'audio/mpeg', 'wav': 'audio/wav'}
+
+
+def encode(mix, fmt='mp3', block_seconds=BLOCK_SECONDS, encoder=None):
+    """Return iterator of mix encoded as fmt ('mp3' or 'wav') bytes.
+
+    encoder -- function(mix, block_seconds) yielding the bytes, in place
+        of ENCODERS[fmt] (e.g. a parallel_encoder.ParallelEncoder)
+    """
+    if encoder is None:
+        try:
+            encoder = ENCODERS[fmt]
+        except KeyError:
+            raise MixError(f"unknown format {fmt!r}")
+    return encoder(mix, block_seconds)
+
+
+def write(mix, fn, fmt='mp3', block_seconds=BLOCK_SECONDS, encoder=None):
+    """Write mix encoded as fmt to fn a chunk at a time, return bytes."""
+    size = 0
+    with open(fn, 'wb') as f:
+        for chunk in encode(mix, fmt, block_seconds, encoder):
+            f.write(chunk)
+            size += len(chunk)
+    return size
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="mix tone files")
+    parser.add_argument('output', help="file to write, .mp3 or .wav")
+    parser.add_argument('sources', nargs='+', help="tones, WAV or MP3")
+    parser.add_argument('--seconds', type=float, default=60)
+    parser.add_argument('--layers', type=int, default=2)
+    args = parser.parse_args()
+    tones = [load(fn) for fn in args.sources]
+    mix = Mix([tones[i::args.layers] for i in range(args.layers)],
+              args.seconds)
+    fmt = os.path.splitext(args.output)[1].lstrip('.').lower()
+    print(write(mix, args.output, fmt), "bytes")
@@ -0,0 +1,527 @@
+"""user_store.py: where user records are kept.
+
+A record is one item: the key (`USERID`), the attribute map (`DATA`), a
+`TIMESTAMP`, a `VERSION` number that every write adds one to, an optional
+`EXPIRES` time and any top-level counters.  lambda_function decides what
+to write and describes it as an `Update`; a store applies it.  Three stores
+share the interface of `UserStore`:
+
+- `DynamoDBStore`: the table, through boto3 (imported on first use).
+- `MemoryStore`: a thread-safe LRU dict in the process, for tests, load
+  tests and the replay harness.  Nothing survives the process.
+- `FileStore`: an append-only JSON lines file with an in-memory index, so
+  records survive restarts of a local run without any service.
+
+`CachedStore` wraps any of them with a read-through LRU of recent records
+that lives across warm invocations.
+
+All stores raise `ConditionFailed` when an Update's condition doesn't
+hold and `StoreError` for anything else that stops a read or write.
+
+The DynamoDB table is made before deploying, never by a request (a
+missing table is a `StoreError` like any other).  Create it, or bring an
+existing one up to date, with:
+    python user_store.py [--billing PROVISIONED] [--endpoint URL]
+"""
+import copy
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+from decimal import Decimal
+
+import skill_log as log
+
+# --------------- record names -----------------
+USERID = 'userId'   # table key
+DATA = 'data'       # table record
+TIMESTAMP = 'timestamp'       # table record
+VERSION = 'version'     # table record, +1 on every write
+EXPIRES = 'expires'     # table record, epoch seconds, the table's TTL
+
+# --------------- table settings -----------------
+BILLING_MODE = 'PAY_PER_REQUEST'    # or 'PROVISIONED' with CAPACITY
+CAPACITY = (5, 5)       # read, write capacity units if PROVISIONED
+
+
+class StoreError(Exception):
+    """A read or write the store could not do."""
+
+
+class ConditionFailed(StoreError):
+    """An Update whose condition did not hold; nothing was written."""
+
+
+class Update:
+    """One write to a user record.
+
+    timestamp -- saved as TIMESTAMP
+    sets -- {DATA key: value} to set inside DATA, or the whole new DATA
+        map if replace
+    removes -- DATA keys to remove
+    adds -- {top-level attribute: amount} to add to
+    expect -- {DATA key: value} DATA must still hold for the write to
+        happen
+    replace -- True to replace DATA with sets instead of changing keys
+    version -- VERSION the item must still have (0: no item or an item
+        without one), or None to write whatever the version
+    expires -- EXPIRES to save, or None to leave it as it is
+
+    Unless replace, an Update that touches DATA needs DATA to exist.
+    """
+
+    def __init__(self, timestamp, sets=None, removes=(), adds=None,
+                 expect=None, replace=False, version=None, expires=None):
+        self.timestamp = timestamp
+        self.sets = sets or {}
+        self.removes = list(removes)
+        self.adds = adds or {}
+        self.expect = expect or {}
+        self.replace = replace
+        self.version = version
+        self.expires = expires
+
+    @property
+    def needs_data(self):
+        """Return True if DATA must exist for this Update."""
+        return not self.replace and bool(self.sets or self.removes or
+                                         self.expect)
+
+    def apply(self, item):
+        """Return item with this Update applied, raise ConditionFailed."""
+        item = copy.deepcopy(item)
+        data = item.get(DATA)
+        if self.version is not None and item.get(VERSION, 0) != self.version:
+            raise ConditionFailed("item version changed")
+        if self.needs_data:
+            if not isinstance(data, dict):
+                raise ConditionFailed("no DATA map")
+            for key, value in self.expect.items():
+                if key not in data or data[key] != value:
+                    raise ConditionFailed(f"DATA {key!r} changed")
+        if self.replace:
+            item[DATA] = copy.deepcopy(self.sets)
+        elif self.needs_data:
+            data.update(copy.deepcopy(self.sets))
+            for key in self.removes:
+                data.pop(key, None)
+        for name, amount in self.adds.items():
+            item[name] = item.get(name, 0) + amount
+        item[TIMESTAMP] = self.timestamp
+        if self.expires is not None:
+            item[EXPIRES] = self.expires
+        item[VERSION] = item.get(VERSION, 0) + 1
+        return item
+
+
+# --------------- stores -----------------
+class UserStore(ABC):
+    """Interface of the stores.  `calls` counts operations by name."""
+
+    def __init__(self):
+        self.calls = Counter()
+
+    @abstractmethod
+    def get(self, id):
+        """Return the item for user id, {} if there is none."""
+
+    @abstractmethod
+    def update(self, id, update):
+        """Apply Update to the item for user id, creating it if needed."""
+
+
+class DynamoDBStore(UserStore):
+    """Records in a DynamoDB table.
+
+    dynamodb -- service resource to use instead of creating one
+    """
+
+    def __init__(self, table_name, region=None, endpoint=None,
+                 dynamodb=None):
+        super().__init__()
+        self.table_name = table_name
+        self.region = region
+        self.endpoint = endpoint
+        self._dynamodb = dynamodb
+        self._table = None
+
+    @property
+    def dynamodb(self):
+        """Return DynamoDB service resource, creating it on first use."""
+        if self._dynamodb is None:
+            import boto3
+            self._dynamodb = boto3.resource('dynamodb',
+                                            region_name=self.region,
+                                            endpoint_url=self.endpoint)
+        return self._dynamodb
+
+    @property
+    def table(self):
+        """Return the table resource, creating it on first use."""
+        if self._table is None:
+            self._table = self.dynamodb.Table(self.table_name)
+        return self._table
+
+    def get(self, id):
+        """Return the item from get_item, {} if there is none."""
+        from botocore.exceptions import ClientError
+        self.calls['get'] += 1
+        try:
+            response = self.table.get_item(Key={USERID: id})
+        except ClientError as e:
+            error = e.response['Error']
+            if error['Code'] == 'ResourceNotFoundException':
+                log.error("no table, run python user_store.py",
+                          table=self.table_name)
+            raise StoreError(error['Message'])
+        return response.get('Item', {})
+
+    def update(self, id, update):
+        """Send update as one update_item, its conditions included."""
+        from botocore.exceptions import ClientError
+        self.calls['update'] += 1
+        names = {'#ts': TIMESTAMP, '#ver': VERSION}
+        values = {':ts': update.timestamp, ':one': 1}
+        sets = ['#ts = :ts']
+        removes = []
+        conditions = []
+        if update.version is None:
+            values[':zero'] = 0
+            sets.append('#ver = if_not_exists(#ver, :zero) + :one')
+        else:
+            values[':ver'] = update.version
+            sets.append('#ver = :ver + :one')
+            conditions.append('attribute_not_exists(#ver)'
+                              if update.version == 0 else '#ver = :ver')
+        if update.expires is not None:
+            names['#exp'] = EXPIRES
+            values[':exp'] = update.expires
+            sets.append('#exp = :exp')
+        if update.replace:
+            values[':data'] = update.sets
+            sets.insert(0, '#data = :data')
+        for i, (key, value) in enumerate(
+                {} if update.replace else update.sets.items()):
+            names[f'#k{i}'] = key
+            values[f':v{i}'] = value
+            sets.append(f'#data.#k{i} = :v{i}')
+        for i, key in enumerate(update.removes):
+            names[f'#r{i}'] = key
+            removes.append(f'#data.#r{i}')
+        if update.needs_data:
+            conditions.append('attribute_exists(#data)')
+        for i, (key, value) in enumerate(update.expect.items()):
+            names[f'#e{i}'] = key
+            values[f':e{i}'] = value
+            conditions.append(f'#data.#e{i} = :e{i}')
+        expression = 'SET ' + ', '.join(sets)
+        if removes:
+            expression += ' REMOVE ' + ', '.join(removes)
+        if update.adds:
+            adds = []
+            for i, (name, amount) in enumerate(update.adds.items()):
+                names[f'#c{i}'] = name
+                values[f':c{i}'] = amount
+                adds.append(f'#c{i} :c{i}')
+            expression += ' ADD ' + ', '.join(adds)
+        if update.replace or update.needs_data:
+            names['#data'] = DATA
+        kwargs = {}
+        if conditions:
+            kwargs['ConditionExpression'] = ' AND '.join(conditions)
+        try:
+            return self.table.update_item(
+                Key={USERID: id},
+                UpdateExpression=expression,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                **kwargs
+            )
+        except ClientError as e:
+            error = e.response['Error']
+            if error['Code'] == 'ConditionalCheckFailedException':
+                raise ConditionFailed(error['Message'])
+            raise StoreError(error['Message'])
+
+    def provision(self, billing=BILLING_MODE, capacity=CAPACITY,
+                  ttl_attribute=EXPIRES):
+        """
+        Make the table ready, changing only what isn't already so.
+
+        Creates the table if there is none and waits for it to be ACTIVE,
+        sets the billing mode (and capacity if PROVISIONED), and turns on
+        time to live on ttl_attribute.  Safe to run on every deploy.
+
+        Returns:
+        list of what was changed
+
+        """
+        from botocore.exceptions import ClientError
+        client = self.dynamodb.meta.client
+        throughput = {'ReadCapacityUnits': capacity[0],
+                      'WriteCapacityUnits': capacity[1]}
+        billing_args = {'BillingMode': billing}
+        if billing == 'PROVISIONED':
+            billing_args['ProvisionedThroughput'] = throughput
+        changes = []
+        try:
+            table = client.describe_table(TableName=self.table_name)['Table']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
+            client.create_table(
+                TableName=self.table_name,
+                KeySchema=[{'AttributeName': USERID, 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': USERID,
+                                       'AttributeType': 'S'}],
+                **billing_args)
+            changes.append(f"created {self.table_name} ({billing})")
+        else:
+            current = table.get('BillingModeSummary', {}).get(
+                'BillingMode', 'PROVISIONED')
+            provisioned = table.get('ProvisionedThroughput', {})
+            if current != billing or (billing == 'PROVISIONED' and any(
+                    provisioned.get(k) != v for k, v in throughput.items())):
+                client.get_waiter('table_exists').wait(
+                    TableName=self.table_name)
+                client.update_table(TableName=self.table_name,
+                                    **billing_args)
+                changes.append(f"billing {current} -> {billing}")
+        client.get_waiter('table_exists').wait(TableName=self.table_name)
+        ttl = client.describe_time_to_live(TableName=self.table_name)[
+            'TimeToLiveDescription']
+        if ttl_attribute and (ttl.get('AttributeName') != ttl_attribute or
+                              ttl['TimeToLiveStatus'] not in ('ENABLED',
+                                                              'ENABLING')):
+            client.update_time_to_live(
+                TableName=self.table_name,
+                TimeToLiveSpecification={'Enabled': True,
+                                         'AttributeName': ttl_attribute})
+            changes.append(f"time to live on {ttl_attribute}")
+        return changes
+
+
+class MemoryStore(UserStore):
+    """Records in a dict, least recently used dropped past max_items."""
+
+    def __init__(self, max_items=100000):
+        super().__init__()
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, id):
+        """Return a copy of the item held, {} if there is none."""
+        with self.lock:
+            self.calls['get'] += 1
+            if id not in self.items:
+                return {}
+            self.items.move_to_end(id)
+            return copy.deepcopy(self.items[id])
+
+    def update(self, id, update):
+        """Apply update to the item held, creating it if needed."""
+        with self.lock:
+            self.calls['update'] += 1
+            item = update.apply(self.items.get(id, {USERID: id}))
+            self._keep(id, item)
+        return {}
+
+    def _keep(self, id, item):
+        """Store item as most recently used, dropping the least."""
+        self.items[id] = item
+        self.items.move_to_end(id)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+
+class FileStore(UserStore):
+    """Records in an append-only file of JSON lines.
+
+    Every write appends the whole new item; the last line for a user
+    wins.  The file is read once, into an index, when the store is
+    created, and `compact` rewrites it with one line per user.
+    """
+
+    def __init__(self, fn):
+        super().__init__()
+        self.fn = fn
+        self.index = {}
+        self.lock = threading.Lock()
+        self._read()
+        self._file = open(fn, 'a', encoding='utf-8')
+
+    def _read(self):
+        """Fill the index from the file, skipping torn or foreign lines."""
+        if not os.path.exists(self.fn):
+            return
+        with open(self.fn, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    item = None
+                if not isinstance(item, dict) or \
+                        not isinstance(item.get(USERID), str):
+                    log.warning("bad line in user file", fn=self.fn)
+                    continue
+                self.index[item[USERID]] = item
+
+    def _append(self, item):
+        """Write item as the latest line for its user."""
+        self._file.write(json.dumps(item, default=_number) + '\n')
+        self._file.flush()
+        self.index[item[USERID]] = item
+
+    def get(self, id):
+        """Return a copy of the latest line for user id, {} if none."""
+        with self.lock:
+            self.calls['get'] += 1
+            return copy.deepcopy(self.index.get(id, {}))
+
+    def update(self, id, update):
+        """Apply update to the latest item and append the result."""
+        with self.lock:
+            self.calls['update'] += 1
+            self._append(update.apply(self.index.get(id, {USERID: id})))
+        return {}
+
+    def compact(self):
+        """Rewrite the file with only the latest line for each user."""
+        with self.lock:
+            self._file.close()
+            with open(self.fn + '.tmp', 'w', encoding='utf-8') as f:
+                for item in self.index.values():
+                    f.write(json.dumps(item, default=_number) + '\n')
+            os.replace(self.fn + '.tmp', self.fn)
+            self._file = open(self.fn, 'a', encoding='utf-8')
+
+    def close(self):
+        """Close the file."""
+        self._file.close()
+
+
+class CachedStore(UserStore):
+    """Read-through LRU cache of records in front of another store.
+
+    Keeps up to max_items records for ttl seconds.  A write to a cached
+    record is applied to the cached copy too.  A write that fails its
+    VERSION condition means another container wrote the record since, so
+    the entry is dropped as stale (and ConditionFailed raised for the
+    caller to merge and retry); so is an entry whose VERSION doesn't match
+    a write that succeeded.
+
+    `stats` counts hits, misses, expired, stale and evicted entries.
+    """
+
+    def __init__(self, store, max_items=1000, ttl=300.0):
+        super().__init__()
+        self.store = store
+        self.max_items = max_items
+        self.ttl = ttl
+        self.entries = OrderedDict()    # id: (expires, item)
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def _entry(self, id):
+        """Return cached item for id, None if missing or expired."""
+        with self.lock:
+            entry = self.entries.get(id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[id]
+                self.stats['expired'] += 1
+                return None
+            self.entries.move_to_end(id)
+            return entry[1]
+
+    def _keep(self, id, item):
+        """Cache item as most recently used, dropping the least."""
+        with self.lock:
+            self.entries[id] = (time.monotonic() + self.ttl, item)
+            self.entries.move_to_end(id)
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+                self.stats['evicted'] += 1
+
+    def invalidate(self, id=None):
+        """Drop the cached record of id, or every record."""
+        with self.lock:
+            if id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(id, None)
+
+    def get(self, id):
+        """Return the cached item, reading the store on a miss."""
+        self.calls['get'] += 1
+        item = self._entry(id)
+        if item is not None:
+            self.stats['hits'] += 1
+            return copy.deepcopy(item)
+        self.stats['misses'] += 1
+        item = self.store.get(id)
+        self._keep(id, copy.deepcopy(item))
+        return item
+
+    def update(self, id, update):
+        """Update the store, then the cached item or drop it."""
+        self.calls['update'] += 1
+        cached = self._entry(id)
+        try:
+            response = self.store.update(id, update)
+        except ConditionFailed:
+            self.stats['stale'] += 1
+            self.invalidate(id)
+            raise
+        except StoreError:
+            self.invalidate(id)
+            raise
+        if cached is not None:
+            # a cached {} is a missing record: start it as the store does
+            self._applied(id, cached or {USERID: id}, update)
+        return response
+
+    def _applied(self, id, cached, update):
+        """Cache cached with update applied, or drop it if that fails."""
+        try:
+            self._keep(id, update.apply(cached))
+        except ConditionFailed:
+            self.stats['stale'] += 1
+            self.invalidate(id)
+
+    def metrics(self):
+        """Return stats with size and hit_rate."""
+        with self.lock:
+            metrics = dict(self.stats, size=len(self.entries))
+        lookups = self.stats['hits'] + self.stats['misses']
+        metrics['hit_rate'] = (round(self.stats['hits'] / lookups, 3)
+                               if lookups else None)
+        return metrics
+
+
+def _number(value):
+    """Return JSON number for Decimal value (json.dumps default)."""
+    if isinstance(value, Decimal):
+        if value == value.to_integral_value():
+            return int(value)
+        return float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+if __name__ == '__main__':
+    import argparse
+    from lambda_function import DB_TABLE_NAME, DB_REGION, DB_ENDPOINT
+    parser = argparse.ArgumentParser(description="create or update the "
+                                     "user table")
+    parser.add_argument('--table', default=DB_TABLE_NAME)
+    parser.add_argument('--region', default=DB_REGION)
+    parser.add_argument('--endpoint', default=DB_ENDPOINT)
+    parser.add_argument('--billing', default=BILLING_MODE,
+                        choices=('PAY_PER_REQUEST', 'PROVISIONED'))
+    args = parser.parse_args()
+    store = DynamoDBStore(args.table, args.region, args.endpoint)
+    print(store.provision(args.billing) or "nothing to change")